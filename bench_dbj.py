@@ -1,73 +1,800 @@
+"""
+dbj benchmark suite.
+
+Every scenario runs on generated datasets of each size and document shape,
+repeated to report percentiles, plus one extra run under tracemalloc to
+report the memory allocated by the operation.
+
+Examples:
+    python3 bench_dbj.py
+    python3 bench_dbj.py --sizes 1000,100000 --shapes flat,text --repeat 7
+    python3 bench_dbj.py --only find --output results.json
+    python3 bench_dbj.py --output new.json --compare baseline.json
+"""
+
+import argparse
+import json
 import os
+import platform
+import random
 import resource
-import timeit
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import dbj as dbj_module
+from dbj import DbjClient, dbj
+
+CITIES = ["Porto", "Lisboa", "Braga", "Coimbra", "Faro", "São Paulo", "Curitiba", "Belém"]
+STATUSES = ["new", "open", "pending", "closed"]
+WORDS = ["red", "blue", "shoes", "hat", "car", "coffee", "café", "cheap", "fast", "light", "small", "large"]
+
+
+def doc_small(i, rand):
+    return {"index": i}
+
+
+def doc_flat(i, rand):
+    return {
+        "name": "".join(rand.choice(string.ascii_lowercase) for _ in range(8)),
+        "age": rand.randint(0, 99),
+        "city": rand.choice(CITIES),
+        "status": rand.choice(STATUSES),
+        "score": round(rand.random() * 100, 2),
+    }
+
+
+def doc_nested(i, rand):
+    return {
+        "name": "".join(rand.choice(string.ascii_lowercase) for _ in range(8)),
+        "address": {"city": rand.choice(CITIES), "zip": str(rand.randint(1000, 9999))},
+        "stats": {"score": round(rand.random() * 100, 2), "visits": rand.randint(0, 1000)},
+        "tags": rand.sample(STATUSES, 2),
+    }
+
+
+def doc_text(i, rand):
+    return {
+        "title": " ".join(rand.choice(WORDS) for _ in range(4)),
+        "description": " ".join(rand.choice(WORDS) for _ in range(40)),
+        "age": rand.randint(0, 99),
+        "city": rand.choice(CITIES),
+    }
+
+
+SHAPES = {"small": doc_small, "flat": doc_flat, "nested": doc_nested, "text": doc_text}
+
+# Fields used by the search, interning and schema scenarios for each shape
+FIELDS = {
+    "small": {"text": None, "number": "index", "intern": [], "schema": {"index": int}},
+    "flat": {
+        "text": "city",
+        "number": "age",
+        "intern": ["city", "status"],
+        "schema": {"name": str, "age": int, "city": str, "status": str, "score": float},
+    },
+    "nested": {
+        "text": "address.city",
+        "number": "stats.score",
+        "intern": ["address.city", "tags"],
+        "schema": {"name": str, "address": dict, "stats": dict, "tags": list},
+    },
+    "text": {
+        "text": "description",
+        "number": "age",
+        "intern": ["city"],
+        "schema": {"title": str, "description": str, "age": int, "city": str},
+    },
+}
+
+
+class Context:
+    """
+    Dataset and scratch files shared by the scenarios of a size and shape.
+    """
+
+    def __init__(self, size, shape, workdir, seed=1):
+        rand = random.Random(seed)
+        self.size = size
+        self.shape = shape
+        self.workdir = workdir
+        self.path = os.path.join(workdir, "bench_{}_{}.json".format(shape, size))
+        self.docs = [SHAPES[shape](i, rand) for i in range(size)]
+        self.keys = [str(i) for i in range(size)]
+        self.text_field = FIELDS[shape]["text"]
+        self.number_field = FIELDS[shape]["number"]
+        self.intern_fields = FIELDS[shape]["intern"]
+        self.schema = FIELDS[shape]["schema"]
+        self.server = None
+
+    def db(self, fill=True, **kwargs):
+        """
+        Return a new database, filled with the dataset by default.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        db = dbj(self.path, **kwargs)
+        if fill:
+            for key, doc in zip(self.keys, self.docs):
+                db.insert(dict(doc), key)
+        return db
+
+    def saved(self, **kwargs):
+        """
+        Return the path of a saved database holding the dataset.
+        """
+        self.db(**kwargs).save()
+        return self.path
+
+    def exported(self, kind):
+        """
+        Return the path of the dataset exported as jsonl or csv, with the
+        keys on the "_id" field.
+        """
+        path = os.path.join(self.workdir, "bench_{}_{}.{}".format(self.shape, self.size, kind))
+        if not os.path.exists(path):
+            getattr(self.db(), "export_" + kind)(path, key="_id")
+        return path
 
-from dbj import dbj
+    def client(self):
+        """
+        Return a client of a server process holding the dataset, started on
+        the first call.
+        """
+        if self.server is None:
+            name = os.path.join(self.workdir, "server_{}_{}".format(self.shape, self.size))
+            db = dbj(name + ".json")
+            for key, doc in zip(self.keys, self.docs):
+                db.insert(dict(doc), key)
+            db.save()
+            module_dir = os.path.dirname(os.path.abspath(dbj_module.__file__))
+            command = [sys.executable, "-m", "dbj", "serve", name + ".json", "--socket", name + ".sock"]
+            self.server = (subprocess.Popen(command, cwd=module_dir), DbjClient(name + ".sock"))
+            while not os.path.exists(name + ".sock"):
+                time.sleep(0.01)
+        return self.server[1]
 
-db = dbj("bench_database.json")
-n = 100_000
+    def close(self):
+        """
+        Stop the server process.
+        """
+        if self.server is not None:
+            process, client = self.server
+            client.close()
+            process.terminate()
+            process.wait()
+            self.server = None
 
 
-def insert_auto():
-    for i in range(n):
-        db.insert({"index": i})
+SCENARIOS = []
 
 
-def insert_sup():
-    for i in range(n):
-        db.insert({"index": i}, str(i))
+def scenario(name, setup=None, ops=None, shapes=None, max_size=None):
+    """
+    Register a benchmark scenario.
 
+    Args:
+        name (str): Scenario name.
+        setup (callable, optional): setup(ctx) returning the state passed to
+            the scenario, not timed. Defaults to a filled database.
+        ops (callable, optional): ops(ctx) returning the number of
+            operations of a run, used to report ops/s. Defaults to the size.
+        shapes (tuple, optional): Only run on these shapes.
+        max_size (int, optional): Run on at most this many documents, for
+            scenarios with quadratic cost like autosave.
+    """
 
-def retrieve_all():
-    for key in db.getallkeys():
+    def register(func):
+        SCENARIOS.append(
+            {
+                "name": name,
+                "run": func,
+                "setup": setup or (lambda ctx: ctx.db()),
+                "ops": ops or (lambda ctx: ctx.size),
+                "shapes": shapes,
+                "max_size": max_size,
+            }
+        )
+        return func
+
+    return register
+
+
+def empty_db(ctx):
+    return ctx.db(fill=False)
+
+
+def one(ctx):
+    return 1
+
+
+def ten(ctx):
+    return 10
+
+
+@scenario("insert_auto_key", setup=empty_db)
+def bench_insert_auto_key(ctx, db):
+    for doc in ctx.docs:
+        db.insert(dict(doc))
+
+
+@scenario("insert_key", setup=empty_db)
+def bench_insert_key(ctx, db):
+    for key, doc in zip(ctx.keys, ctx.docs):
+        db.insert(dict(doc), key)
+
+
+@scenario("insertmany", setup=empty_db)
+def bench_insertmany(ctx, db):
+    db.insertmany([dict(doc) for doc in ctx.docs])
+
+
+@scenario("insert_autosave", setup=lambda ctx: ctx.db(fill=False, autosave=True), max_size=200)
+def bench_insert_autosave(ctx, db):
+    for key, doc in zip(ctx.keys, ctx.docs):
+        db.insert(dict(doc), key)
+
+
+@scenario("get")
+def bench_get(ctx, db):
+    for key in ctx.keys:
         db.get(key)
 
 
-def delete_all():
-    for key in db.getallkeys():
+@scenario("getmany")
+def bench_getmany(ctx, db):
+    db.getmany(ctx.keys)
+
+
+@scenario("getall")
+def bench_getall(ctx, db):
+    db.getall()
+
+
+@scenario("getrandom", ops=lambda ctx: 100)
+def bench_getrandom(ctx, db):
+    for _ in range(100):
+        db.getrandom()
+
+
+@scenario("exists")
+def bench_exists(ctx, db):
+    for key in ctx.keys:
+        db.exists(key)
+
+
+@scenario("update")
+def bench_update(ctx, db):
+    for key in ctx.keys:
+        db.update(key, {"updated": True})
+
+
+@scenario("updatemany")
+def bench_updatemany(ctx, db):
+    db.updatemany(ctx.keys, {"updated": True})
+
+
+@scenario("delete")
+def bench_delete(ctx, db):
+    for key in ctx.keys:
         db.delete(key)
 
 
-print("\n" + "-" * 32)
-print("\nInserting {} documents using auto generated uuid1 key...".format(n))
-spent_time = timeit.timeit(insert_auto, number=1)
-print(
-    "Done! Time spent: {:.2f}s\nInserted: {}\nRate: {} ops/s".format(spent_time, db.size(), int(db.size() / spent_time))
-)
-
-print("\n" + "-" * 32)
-print("\nClearing the database...")
-db.clear()
-print("Done!")
-
-print("\n" + "-" * 32)
-print("\nInserting {} documents using a supplied key...".format(n))
-spent_time = timeit.timeit(insert_sup, number=1)
-print(
-    "Done! Time spent: {:.2f}s\nInserted: {}\nRate: {} ops/s".format(spent_time, db.size(), int(db.size() / spent_time))
-)
-
-print("\n" + "-" * 32)
-print("\nRetrieving {} documents one at a time...".format(db.size()))
-spent_time = timeit.timeit(retrieve_all, number=1)
-print(
-    "Done! Time spent: {:.2f}s\nRetrieved: {}\nRate: {} ops/s".format(
-        spent_time, db.size(), int(db.size() / spent_time)
+@scenario("deletemany")
+def bench_deletemany(ctx, db):
+    db.deletemany(ctx.keys)
+
+
+@scenario("pop")
+def bench_pop(ctx, db):
+    for key in ctx.keys:
+        db.pop(key)
+
+
+@scenario("popfirst")
+def bench_popfirst(ctx, db):
+    for _ in ctx.keys:
+        db.popfirst()
+
+
+@scenario("poplast")
+def bench_poplast(ctx, db):
+    for _ in ctx.keys:
+        db.poplast()
+
+
+@scenario("clear", ops=one)
+def bench_clear(ctx, db):
+    db.clear()
+
+
+@scenario("sort", ops=one)
+def bench_sort(ctx, db):
+    db.sort(ctx.keys, ctx.number_field)
+
+
+@scenario("sort_fields", ops=one, shapes=("flat", "nested", "text"))
+def bench_sort_fields(ctx, db):
+    db.sort(ctx.keys, [(ctx.text_field, "asc"), (ctx.number_field, "desc")])
+
+
+@scenario("sort_repeat", ops=ten, shapes=("flat", "nested", "text"))
+def bench_sort_repeat(ctx, db):
+    # The same dashboard sort on unchanged data, served from the cache
+    # after the second run
+    sortby = [(ctx.text_field, "asc"), (ctx.number_field, "desc")]
+    for _ in range(10):
+        db.sort(ctx.keys[:100], sortby)
+
+
+@scenario("findtext", ops=ten, shapes=("flat", "nested", "text"))
+def bench_findtext(ctx, db):
+    for word in CITIES[:5] + WORDS[:5]:
+        db.findtext(ctx.text_field, word)
+
+
+@scenario("findnum", ops=ten)
+def bench_findnum(ctx, db):
+    for i in range(10):
+        db.findnum("{} >= {}".format(ctx.number_field, i * 10))
+
+
+@scenario("find", ops=ten, shapes=("flat", "nested", "text"))
+def bench_find(ctx, db):
+    query = '{} ?= "o" and {} < 50 or {} == "faro"'.format(ctx.text_field, ctx.number_field, ctx.text_field)
+    for _ in range(10):
+        db.find(query)
+
+
+@scenario("find_sortby", ops=one, shapes=("flat", "nested", "text"))
+def bench_find_sortby(ctx, db):
+    db.find("{} >= 0".format(ctx.number_field), sortby=ctx.number_field)
+
+
+@scenario("save", ops=one)
+def bench_save(ctx, db):
+    db.save()
+    return {"file_size": os.path.getsize(db.path)}
+
+
+@scenario("save_indent", ops=one)
+def bench_save_indent(ctx, db):
+    db.save(indent=2)
+
+
+def saved_db(ctx):
+    return dbj(ctx.saved())
+
+
+@scenario("load", setup=saved_db, ops=one)
+def bench_load(ctx, db):
+    db.load()
+
+
+@scenario("open", setup=lambda ctx: ctx.saved(), ops=one)
+def bench_open(ctx, path):
+    dbj(path)
+
+
+@scenario("open_lazy_get", setup=lambda ctx: ctx.saved(), ops=one)
+def bench_open_lazy_get(ctx, path):
+    dbj(path, lazy=True).get(ctx.keys[-1])
+
+
+@scenario("peek", setup=lambda ctx: ctx.saved(), ops=one)
+def bench_peek(ctx, path):
+    dbj(path, lazy=True).peek()
+
+
+@scenario("import", ops=one, shapes=("small",), setup=lambda ctx: None)
+def bench_import(ctx, state):
+    # Interpreter start included, compare with "python -c pass"
+    module_dir = os.path.dirname(os.path.abspath(dbj_module.__file__))
+    subprocess.run([sys.executable, "-c", "import dbj"], cwd=module_dir, check=True)
+
+
+@scenario("save_blocks", setup=lambda ctx: ctx.db(blocks=True), ops=one)
+def bench_save_blocks(ctx, db):
+    db.save()
+    return {"file_size": os.path.getsize(db.path)}
+
+
+@scenario("load_blocks", setup=lambda ctx: dbj(ctx.saved(blocks=True)), ops=one)
+def bench_load_blocks(ctx, db):
+    db.load()
+
+
+@scenario("verify", setup=lambda ctx: dbj(ctx.saved(), lazy=True), ops=one)
+def bench_verify(ctx, db):
+    db.verify()
+
+
+@scenario("verify_blocks", setup=lambda ctx: dbj(ctx.saved(blocks=True), lazy=True), ops=one)
+def bench_verify_blocks(ctx, db):
+    db.verify()
+
+
+@scenario("peek_blocks", setup=lambda ctx: ctx.saved(blocks=True), ops=one)
+def bench_peek_blocks(ctx, path):
+    dbj(path, lazy=True).peek()
+
+
+@scenario("open_interned", setup=lambda ctx: ctx.saved(), ops=one)
+def bench_open_interned(ctx, path):
+    dbj(path, intern=ctx.intern_fields)
+
+
+def literal(value):
+    """
+    Return the source of a keyword argument value, types by name.
+    """
+    if isinstance(value, type):
+        return value.__name__
+    if isinstance(value, dict):
+        return "{" + ", ".join("{!r}: {}".format(k, literal(v)) for k, v in value.items()) + "}"
+    return repr(value)
+
+
+def open_rss(path, **kwargs):
+    """
+    Open the database on a new process and return its resident memory.
+    """
+    module_dir = os.path.dirname(os.path.abspath(dbj_module.__file__))
+    # ru_maxrss is inherited from the parent process, read the resident
+    # memory after opening from /proc (Linux). Freed strings stay on the
+    # allocator arenas, the live python heap is also reported.
+    code = "import sys, tracemalloc; from dbj import dbj; tracemalloc.start(); db = dbj(sys.argv[1], **{}); "
+    code += "print([line.split()[1] for line in open('/proc/self/status') if line.startswith('VmRSS')][0]); "
+    code += "print(tracemalloc.get_traced_memory()[0])"
+    output = subprocess.run(
+        [sys.executable, "-c", code.format(literal(kwargs)), path], cwd=module_dir, check=True, stdout=subprocess.PIPE
+    ).stdout
+    rss, heap = output.split()
+    return {"rss": "{:.2f}MB".format(int(rss) / 1024.0), "heap": "{:.2f}MB".format(int(heap) / 1024.0 / 1024.0)}
+
+
+@scenario("open_rss", setup=lambda ctx: ctx.saved(), ops=one)
+def bench_open_rss(ctx, path):
+    return open_rss(path)
+
+
+@scenario("open_rss_interned", setup=lambda ctx: ctx.saved(), ops=one)
+def bench_open_rss_interned(ctx, path):
+    return open_rss(path, intern=ctx.intern_fields)
+
+
+@scenario("schema_insert", setup=lambda ctx: ctx.db(fill=False, schema=ctx.schema))
+def bench_schema_insert(ctx, db):
+    for key, doc in zip(ctx.keys, ctx.docs):
+        db.insert(dict(doc), key)
+
+
+@scenario("schema_get", setup=lambda ctx: ctx.db(schema=ctx.schema))
+def bench_schema_get(ctx, db):
+    for key in ctx.keys:
+        db.get(key)
+
+
+@scenario("schema_findnum", setup=lambda ctx: ctx.db(schema=ctx.schema), ops=ten)
+def bench_schema_findnum(ctx, db):
+    for i in range(10):
+        db.findnum("{} > {}".format(ctx.number_field, i * 10))
+
+
+@scenario("open_rss_schema", setup=lambda ctx: ctx.saved(), ops=one)
+def bench_open_rss_schema(ctx, path):
+    return open_rss(path, schema=ctx.schema)
+
+
+def bounded_db(ctx, fill=True):
+    return ctx.db(fill=fill, max_documents=max(ctx.size // 10, 1))
+
+
+@scenario("bounded_insert", setup=lambda ctx: bounded_db(ctx, fill=False))
+def bench_bounded_insert(ctx, db):
+    for key, doc in zip(ctx.keys, ctx.docs):
+        db.insert(dict(doc), key)
+
+
+@scenario("bounded_get", setup=bounded_db)
+def bench_bounded_get(ctx, db):
+    for key in ctx.keys:
+        db.get(key)
+
+
+@scenario("bounded_find", setup=bounded_db, ops=one)
+def bench_bounded_find(ctx, db):
+    db.findnum("{} > 0".format(ctx.number_field))
+
+
+def compressed_db(ctx, fill=True, compression="zlib"):
+    db = ctx.db(fill=False, compression=compression)
+    # Compress the whole text dataset
+    db.compression_threshold = 256
+    if fill:
+        for key, doc in zip(ctx.keys, ctx.docs):
+            db.insert(dict(doc), key)
+    return db
+
+
+@scenario("compressed_insert", setup=lambda ctx: compressed_db(ctx, fill=False), shapes=("text",))
+def bench_compressed_insert(ctx, db):
+    for key, doc in zip(ctx.keys, ctx.docs):
+        db.insert(dict(doc), key)
+
+
+@scenario("compressed_get", setup=compressed_db, shapes=("text",))
+def bench_compressed_get(ctx, db):
+    for key in ctx.keys:
+        db.get(key)
+
+
+@scenario("compressed_find", setup=compressed_db, ops=ten, shapes=("text",))
+def bench_compressed_find(ctx, db):
+    for word in WORDS[:10]:
+        db.find('{} ?= "{}"'.format(ctx.text_field, word))
+
+
+@scenario("compressed_save", setup=compressed_db, ops=one, shapes=("text",))
+def bench_compressed_save(ctx, db):
+    db.save()
+    return {"file_size": os.path.getsize(db.path)}
+
+
+@scenario("compressed_save_lzma", setup=lambda ctx: compressed_db(ctx, compression="lzma"), ops=one, shapes=("text",))
+def bench_compressed_save_lzma(ctx, db):
+    db.save()
+    return {"file_size": os.path.getsize(db.path)}
+
+
+def import_state(ctx, kind):
+    return ctx.exported(kind), ctx.db(fill=False)
+
+
+@scenario("import_insertmany", setup=lambda ctx: import_state(ctx, "jsonl"))
+def bench_import_insertmany(ctx, state):
+    # Reading the file and inserting the documents without the import helper
+    path, db = state
+    with open(path) as f:
+        docs = [json.loads(line) for line in f]
+    db.insertmany(docs)
+
+
+@scenario("import_jsonl", setup=lambda ctx: import_state(ctx, "jsonl"))
+def bench_import_jsonl(ctx, state):
+    path, db = state
+    db.import_jsonl(path, key="_id", workers=1)
+
+
+@scenario("import_jsonl_workers", setup=lambda ctx: import_state(ctx, "jsonl"))
+def bench_import_jsonl_workers(ctx, state):
+    path, db = state
+    db.import_jsonl(path, key="_id", workers=max(2, os.cpu_count() or 1))
+
+
+@scenario("import_csv", setup=lambda ctx: import_state(ctx, "csv"), shapes=("small", "flat", "text"))
+def bench_import_csv(ctx, state):
+    path, db = state
+    db.import_csv(path, key="_id", types={ctx.number_field: int}, workers=1)
+
+
+@scenario("export_getall")
+def bench_export_getall(ctx, db):
+    # Dumping the getall list without the export helper
+    with open(ctx.path + ".out", "w") as f:
+        json.dump(db.getall(), f)
+
+
+@scenario("export_jsonl")
+def bench_export_jsonl(ctx, db):
+    db.export_jsonl(ctx.path + ".out")
+
+
+@scenario("export_csv", shapes=("small", "flat", "text"))
+def bench_export_csv(ctx, db):
+    db.export_csv(ctx.path + ".out")
+
+
+@scenario("server_get", setup=lambda ctx: ctx.client())
+def bench_server_get(ctx, client):
+    latencies = []
+    for key in ctx.keys:
+        start = time.perf_counter()
+        client.get(key)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "p50": "{:.1f}us".format(percentile(latencies, 50) * 1e6),
+        "p99": "{:.1f}us".format(percentile(latencies, 99) * 1e6),
+    }
+
+
+@scenario("server_batch_get", setup=lambda ctx: ctx.client())
+def bench_server_batch_get(ctx, client):
+    for start in range(0, ctx.size, 100):
+        client.batch([("get", [key]) for key in ctx.keys[start : start + 100]])
+
+
+@scenario("server_update", setup=lambda ctx: ctx.client())
+def bench_server_update(ctx, client):
+    for key in ctx.keys:
+        client.update(key, {"updated": True})
+
+
+@scenario("server_find", setup=lambda ctx: ctx.client(), ops=ten, shapes=("flat", "nested", "text"))
+def bench_server_find(ctx, client):
+    query = '{} ?= "o" and {} < 50 or {} == "faro"'.format(ctx.text_field, ctx.number_field, ctx.text_field)
+    for _ in range(10):
+        client.find(query)
+
+
+def percentile(values, p):
+    """
+    Return the p percentile (0-100) of the values, linear interpolation.
+    """
+    values = sorted(values)
+    if len(values) == 1:
+        return values[0]
+    pos = (len(values) - 1) * p / 100.0
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def measure(item, ctx, repeat):
+    """
+    Run a scenario repeat times and once more under tracemalloc.
+    """
+    times = []
+    for _ in range(repeat):
+        state = item["setup"](ctx)
+        start = time.perf_counter()
+        item["run"](ctx, state)
+        times.append(time.perf_counter() - start)
+    state = item["setup"](ctx)
+    tracemalloc.start()
+    tracemalloc.clear_traces()
+    extra = item["run"](ctx, state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    ops = item["ops"](ctx)
+    median = percentile(times, 50)
+    return {
+        "name": item["name"],
+        "shape": ctx.shape,
+        "size": ctx.size,
+        "ops": ops,
+        "times": times,
+        "min": min(times),
+        "median": median,
+        "p95": percentile(times, 95),
+        "mean": sum(times) / len(times),
+        "ops_per_sec": ops / median if median else None,
+        "peak_memory": peak,
+        # Other measures returned by the scenario, like the file size
+        "extra": extra or {},
+    }
+
+
+def run(sizes, shapes, repeat, only=None, out=sys.stdout):
+    """
+    Run the selected scenarios and return the results list.
+    """
+    results = []
+    workdir = tempfile.mkdtemp(prefix="bench_dbj_")
+    header = "{:<20} {:<7} {:>8} {:>11} {:>11} {:>11} {:>13} {:>11}"
+    print(header.format("scenario", "shape", "size", "min", "median", "p95", "ops/s", "peak mem"), file=out)
+    contexts = {}
+    try:
+        for shape in shapes:
+            for size in sizes:
+                for ctx in contexts.values():
+                    ctx.close()
+                contexts = {}
+                for item in SCENARIOS:
+                    if only and not any(name in item["name"] for name in only):
+                        continue
+                    if item["shapes"] and shape not in item["shapes"]:
+                        continue
+                    item_size = min(size, item["max_size"] or size)
+                    if item_size not in contexts:
+                        contexts[item_size] = Context(item_size, shape, workdir)
+                    result = measure(item, contexts[item_size], repeat)
+                    results.append(result)
+                    print(
+                        header.format(
+                            result["name"],
+                            shape,
+                            item_size,
+                            "{:.4f}s".format(result["min"]),
+                            "{:.4f}s".format(result["median"]),
+                            "{:.4f}s".format(result["p95"]),
+                            int(result["ops_per_sec"] or 0),
+                            "{:.2f}MB".format(result["peak_memory"] / 1024.0 / 1024.0),
+                        )
+                        + "".join(" {}={}".format(name, value) for name, value in result["extra"].items()),
+                        file=out,
+                    )
+    finally:
+        for ctx in contexts.values():
+            ctx.close()
+        shutil.rmtree(workdir)
+    return results
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    """
+    Compare the medians against a baseline, return the regressions list.
+    """
+    previous = {(r["name"], r["shape"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    print(
+        "\n{:<20} {:<7} {:>8} {:>11} {:>11} {:>8}".format("scenario", "shape", "size", "baseline", "now", "ratio"),
+        file=out,
     )
-)
-
-print("\n" + "-" * 32)
-print("\nSaving database to disk...")
-spent_time = timeit.timeit(db.save, number=1)
-print("Done! Time spent: {:.2f}s".format(spent_time))
-
-print("\n" + "-" * 32)
-print("\nDeleting {} documents one at a time...".format(db.size()))
-spent_time = timeit.timeit(delete_all, number=1)
-print("Done! Time spent: {:.2f}s\nDeleted: {}\nRate: {} ops/s".format(spent_time, n, int(n / spent_time)))
-
-print("\n" + "-" * 32)
-print("\nRemoving file...")
-os.remove("bench_database.json")
-used_mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-print("Done!\n\nPeak memory usage: {:.2f} MB\n".format(used_mem / 1024.0))
+    for result in results:
+        old = previous.get((result["name"], result["shape"], result["size"]))
+        if old is None or not old["median"]:
+            continue
+        ratio = result["median"] / old["median"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = " REGRESSION"
+            regressions.append(dict(result, ratio=ratio))
+        print(
+            "{:<20} {:<7} {:>8} {:>10.4f}s {:>10.4f}s {:>7.2f}x{}".format(
+                result["name"], result["shape"], result["size"], old["median"], result["median"], ratio, flag
+            ),
+            file=out,
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="dbj benchmark suite")
+    parser.add_argument("--sizes", default="1000,10000", help="comma separated dataset sizes (default: 1000,10000)")
+    parser.add_argument("--shapes", default="small,flat,nested,text", help="comma separated document shapes")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per scenario (default: 5)")
+    parser.add_argument("--only", help="comma separated scenario name filters")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--compare", help="compare against a baseline json file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown ratio (default: 0.1)")
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    shapes = args.shapes.split(",")
+    for shape in shapes:
+        if shape not in SHAPES:
+            parser.error("unknown shape: {}".format(shape))
+    only = args.only.split(",") if args.only else None
+    results = run(sizes, shapes, args.repeat, only)
+    used_mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("\nPeak memory usage (ru_maxrss): {:.2f} MB".format(used_mem / 1024.0))
+    report = {
+        "meta": {
+            "dbj": dbj_module.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": args.repeat,
+            "ru_maxrss": used_mem,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "wt") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, "rt") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\n{} regression(s) above {:.0%}".format(len(regressions), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,16 +5,183 @@
 # email: pedro@bigode.net
 # date: 2024-10-02
 
+import heapq
 import json
+import math
 import os
-import random
-import signal
+import re
 import sys
-import unicodedata
-import uuid
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from itertools import chain, compress, islice
+from operator import eq, ge, gt, itemgetter, le, lt, ne
 
 __version__ = "0.2.0"
 
+# The argparse, asyncio, base64, logging, lzma, random, selectors, signal,
+# socket, stat, tempfile, threading, unicodedata, uuid and zlib modules are
+# imported where they are used, keeping the import and open time low
+
+# Sentinel returned by field getters when the field does not exist
+_MISSING = object()
+# Placeholder of the documents evicted to the spill segment
+_SPILLED = object()
+# Field holding the codec name of the compressed documents saved as json
+_COMPRESSED = "$compressed"
+# Block format file header and index footer magic, see dbj.save
+_BLOCKS_MAGIC = b"DBJB1\n"
+_INDEX_MAGIC = b"DBJI"
+
+_NUMBER_OPERATORS = {"==": eq, "!=": ne, "<": lt, "<=": le, ">": gt, ">=": ge}
+_STRING_OPERATORS = ("==", "!=", "?=", "startswith", "regex")
+_LOGICAL_OPERATORS = ("and", "or")
+_UPDATE_OPERATORS = ("$set", "$unset", "$inc", "$push", "$max")
+_AGGREGATES = ("count", "sum", "min", "max", "avg")
+_WORD = re.compile(r"\w+")
+
+# Methods timed when metrics are enabled and the ones logged as slow queries
+_METERED = (
+    "load",
+    "peek",
+    "save",
+    "insert",
+    "insertmany",
+    "get",
+    "getmany",
+    "getall",
+    "pop",
+    "popfirst",
+    "poplast",
+    "delete",
+    "deletemany",
+    "clear",
+    "update",
+    "updatemany",
+    "sort",
+    "findtext",
+    "findnum",
+    "find",
+    "findall",
+    "count",
+    "distinct",
+    "groupby",
+    "min",
+    "max",
+    "sum",
+    "avg",
+)
+_QUERIES = (
+    "sort",
+    "findtext",
+    "findnum",
+    "find",
+    "findall",
+    "count",
+    "distinct",
+    "groupby",
+    "min",
+    "max",
+    "sum",
+    "avg",
+)
+# Methods callable through the server, the ones taking callbacks are local
+_SERVED = _METERED + (
+    "getallkeys",
+    "getrandom",
+    "getfirst",
+    "getlast",
+    "getfirstkey",
+    "getlastkey",
+    "size",
+    "exists",
+    "explain",
+    "createindex",
+    "dropindex",
+    "getindexes",
+    "createcolumn",
+    "dropcolumn",
+    "getcolumns",
+    "createtextindex",
+    "droptextindex",
+    "gettextindexes",
+    "stats",
+    "resetstats",
+    "internstats",
+    "changes",
+    "getttl",
+    "setttl",
+)
+# Conversion of the csv values of typed fields
+_CSV_TYPES = {str: str, int: int, float: float, bool: lambda value: _csv_bool(value)}
+# Exceptions raised again by the client, others are raised as RuntimeError
+_SERVER_ERRORS = {"TypeError": TypeError, "ValueError": ValueError, "KeyError": KeyError}
+# Latency histogram upper bounds in seconds
+_LATENCY_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0, float("inf"))
+
+
+def _compile_path(field):
+    """
+    Return a function that extracts the field value from a document.
+
+    Dotted fields like "address.city" walk nested dicts, a top level field
+    containing a literal dot takes precedence. Missing values are returned as
+    _MISSING.
+    """
+    if "." not in field:
+
+        def getter(document):
+            return document.get(field, _MISSING)
+
+        return getter
+    first, *parts = field.split(".")
+
+    def getter(document):
+        value = document.get(field, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = document.get(first, _MISSING)
+        for part in parts:
+            if not isinstance(value, dict):
+                return _MISSING
+            value = value.get(part, _MISSING)
+            if value is _MISSING:
+                return _MISSING
+        return value
+
+    return getter
+
+
+def _orderkey(value):
+    """
+    Sort key of any json value, so values of different types never compare:
+    None, numbers (bools included), strings, lists and dicts.
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, (list, tuple)):
+        return (3, tuple(map(_orderkey, value)))
+    if isinstance(value, Mapping):
+        return (4, tuple(sorted((name, _orderkey(item)) for name, item in value.items())))
+    return (5, str(value))
+
+
+def _sortkey(values):
+    """
+    Return the sort key function for the values, None if they compare
+    natively (only numbers or only strings).
+    """
+    kinds = set(map(type, values))
+    if kinds <= {int, float, bool} or kinds == {str}:
+        return None
+    return _orderkey
+
 
 class KillProtected:
     """
@@ -27,703 +194,4663 @@ class KillProtected:
     def kill_handler(self, signum, frame):
         self.killed = True
 
-    # The signal.signal() returns the previous handler
-    def __enter__(self):
-        self.prev_sigint = signal.signal(signal.SIGINT, self.kill_handler)
-        self.prev_sigterm = signal.signal(signal.SIGTERM, self.kill_handler)
+    # The signal.signal() returns the previous handler
+    def __enter__(self):
+        import signal
+
+        self.prev_sigint = signal.signal(signal.SIGINT, self.kill_handler)
+        self.prev_sigterm = signal.signal(signal.SIGTERM, self.kill_handler)
+
+    def __exit__(self, type, value, traceback):
+        import signal
+
+        if self.killed:
+            sys.exit(0)
+        signal.signal(signal.SIGINT, self.prev_sigint)
+        signal.signal(signal.SIGTERM, self.prev_sigterm)
+
+
+def _compile_projection(fields):
+    """
+    Return a function that copies only the provided fields of a document.
+
+    Dotted fields keep their nesting, e.g., "address.city" results in
+    {"address": {"city": ...}}.
+    """
+    specs = [(field, field.split("."), _compile_path(field)) for field in fields]
+
+    def project(document):
+        projected = {}
+        for field, parts, getter in specs:
+            value = getter(document)
+            if value is _MISSING:
+                continue
+            if len(parts) == 1 or field in document:
+                projected[field] = value
+                continue
+            target = projected
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+        return projected
+
+    return project
+
+
+def _to_number(value):
+    """
+    Convert the value to a number like findnum does, None if it is not a
+    number.
+    """
+    if type(value) in (int, float):
+        number = value
+    else:
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+    # NaN can not be ordered or summed
+    if number != number:
+        return None
+    return number
+
+
+def _is_nan(value):
+    """
+    Check if the value converts to NaN like findnum does.
+    """
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return False
+    return number != number
+
+
+def _ascii(text):
+    if text.isascii():
+        return text
+    import unicodedata
+
+    text_nfkd = unicodedata.normalize("NFKD", text)
+    return text_nfkd.encode("ASCII", "ignore").decode()
+
+
+def _ascii_lower(text):
+    return _ascii(text).lower()
+
+
+def _same(text):
+    return text
+
+
+# Text normalization used before matching, by (sens, asc)
+_FOLDERS = {
+    (False, False): str.lower,
+    (False, True): _ascii_lower,
+    (True, False): _same,
+    (True, True): _ascii,
+}
+
+
+def _folder(sens, asc):
+    """
+    Return the function used to normalize text before matching.
+    """
+    return _FOLDERS[(sens, asc)]
+
+
+class FieldIndex:
+    """
+    Hash index mapping the values of a field (dotted paths allowed) to the
+    keys of the documents holding them.
+
+    Sorted and normalized views of the distinct values are built on demand
+    for range, prefix and case insensitive lookups, and rebuilt only when a
+    distinct value is added or removed.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.getter = _compile_path(field)
+        self.postings = {}
+        # The indexed value of each key, documents may be mutated in place so
+        # the removal can not rely on the current document content
+        self.values = {}
+        # Keys holding unhashable values (list, dict), those never match a
+        # text or number search
+        self.other = {}
+        self.version = 0
+        self.views = {}
+
+    def add(self, key, document):
+        value = self.getter(document)
+        if value is _MISSING:
+            return
+        self.values[key] = value
+        try:
+            keys = self.postings.get(value)
+        except TypeError:
+            self.other[key] = None
+            return
+        if keys is None:
+            keys = self.postings[value] = {}
+            self.version += 1
+        keys[key] = None
+
+    def remove(self, key):
+        value = self.values.pop(key, _MISSING)
+        if value is _MISSING:
+            return
+        try:
+            keys = self.postings[value]
+        except TypeError:
+            self.other.pop(key, None)
+            return
+        except KeyError:
+            return
+        keys.pop(key, None)
+        if not keys:
+            del self.postings[value]
+            self.version += 1
+
+    def clear(self):
+        self.postings.clear()
+        self.values.clear()
+        self.other.clear()
+        self.version += 1
+
+    def match(self, predicate):
+        """
+        Return the keys whose value satisfies the predicate, testing each
+        distinct value only once.
+        """
+        match_list = []
+        for value, keys in self.postings.items():
+            if predicate(value):
+                match_list.extend(keys)
+        return match_list
+
+    def keys(self, values):
+        """
+        Return the keys of the documents holding the values.
+        """
+        match_list = []
+        for value in dict.fromkeys(values):
+            match_list.extend(self.postings[value])
+        return match_list
+
+    def present(self):
+        """
+        Return the keys of the documents where the field exists.
+        """
+        return list(self.values)
+
+    def text_values(self, fold, texts):
+        """
+        Return the string values equal to any of the normalized texts.
+        """
+        view = self._view(("text", fold), lambda: self._build_texts(fold))
+        return [value for text in texts for value in view.get(text, ())]
+
+    def prefix_values(self, fold, prefix):
+        """
+        Return the string values starting with the normalized prefix.
+        """
+        folded, values = self._view(("sorted", fold), lambda: self._build_sorted_texts(fold))
+        match_list = []
+        for i in range(bisect_left(folded, prefix), len(folded)):
+            if not folded[i].startswith(prefix):
+                break
+            match_list.append(values[i])
+        return match_list
+
+    def number_values(self, low=None, high=None, low_open=False, high_open=False):
+        """
+        Return the values that converted to float lie between low and high,
+        None means unbounded.
+        """
+        # Nothing compares to a NaN bound, bisect would match everything
+        if low != low or high != high:
+            return []
+        numbers, values = self.number_values_view()
+        start = 0
+        end = len(numbers)
+        if low is not None:
+            start = bisect_right(numbers, low) if low_open else bisect_left(numbers, low)
+        if high is not None:
+            end = bisect_left(numbers, high) if high_open else bisect_right(numbers, high)
+        return values[start:end]
+
+    def number_values_view(self):
+        """
+        Return the lists (numbers, values) of the values that can be
+        converted to float, sorted by number.
+        """
+        return self._view("number", self._build_numbers)
+
+    def _view(self, name, build):
+        view = self.views.get(name)
+        if view is None or view[0] != self.version:
+            view = (self.version, build())
+            self.views[name] = view
+        return view[1]
+
+    def _build_texts(self, fold):
+        texts = {}
+        for value in self.postings:
+            if isinstance(value, str):
+                texts.setdefault(fold(value), []).append(value)
+        return texts
+
+    def _build_sorted_texts(self, fold):
+        pairs = sorted((fold(value), value) for value in self.postings if isinstance(value, str))
+        return [pair[0] for pair in pairs], [pair[1] for pair in pairs]
+
+    def _build_numbers(self):
+        pairs = []
+        for value in self.postings:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                continue
+            # NaN can not be ordered and never matches a comparison
+            if number == number:
+                pairs.append((number, value))
+        pairs.sort(key=lambda pair: pair[0])
+        return [pair[0] for pair in pairs], [pair[1] for pair in pairs]
+
+
+class NumericColumn:
+    """
+    Columnar cache of a numeric field (dotted paths allowed).
+
+    The numbers are stored in an array("d") aligned with a list of keys and a
+    presence mask, so comparisons run over unboxed floats instead of walking
+    every document and calling float(). A sorted permutation is cached for
+    range queries and sorting until the column changes.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.getter = _compile_path(field)
+        self.keys = []
+        self.numbers = array("d")
+        self.mask = bytearray()
+        self.slots = {}
+        self.free = []
+        # Keys holding a value that sorts differently from its float, like
+        # numeric strings or booleans, the column can not be used to sort
+        self.mixed = {}
+        # Keys holding NaN, left out of the array but not equal to any number
+        self.nan = {}
+        self.version = 0
+        self.order = None
+        self.queried = None
+
+    def add(self, key, document):
+        value = self.getter(document)
+        if value is _MISSING:
+            return
+        number = _to_number(value)
+        if type(value) not in (int, float) or number is None or number != value:
+            self.mixed[key] = None
+        if number is None:
+            if _is_nan(value):
+                self.nan[key] = None
+            return
+        if self.free:
+            slot = self.free.pop()
+            self.keys[slot] = key
+            self.numbers[slot] = number
+            self.mask[slot] = 1
+        else:
+            slot = len(self.keys)
+            self.keys.append(key)
+            self.numbers.append(number)
+            self.mask.append(1)
+        self.slots[key] = slot
+        self.version += 1
+
+    def remove(self, key):
+        self.mixed.pop(key, None)
+        self.nan.pop(key, None)
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        self.keys[slot] = None
+        self.mask[slot] = 0
+        self.free.append(slot)
+        self.version += 1
+
+    def clear(self):
+        self.keys = []
+        self.numbers = array("d")
+        self.mask = bytearray()
+        self.slots.clear()
+        self.free = []
+        self.mixed.clear()
+        self.nan.clear()
+        self.version += 1
+
+    def select(self, low=None, high=None, low_open=False, high_open=False):
+        """
+        Return the keys whose number lies between low and high, None means
+        unbounded.
+
+        The first query after a change scans the array, a repeated query on
+        the same data builds the sorted permutation and uses binary search.
+        """
+        # Nothing compares to a NaN bound, bisect would match everything
+        if low != low or high != high:
+            return []
+        if self.order is None or self.order[0] != self.version:
+            if self.queried != self.version:
+                self.queried = self.version
+                return self._scan(low, high, low_open, high_open)
+            self.sorted_keys()
+        _, keys, numbers = self.order
+        start = 0
+        end = len(keys)
+        if low is not None:
+            start = bisect_right(numbers, low) if low_open else bisect_left(numbers, low)
+        if high is not None:
+            end = bisect_left(numbers, high) if high_open else bisect_right(numbers, high)
+        return keys[start:end]
+
+    def select_not(self, number):
+        """
+        Return the keys whose number is not equal to the provided one, NaN
+        included.
+        """
+        keys = [key for key, value, present in zip(self.keys, self.numbers, self.mask) if present and value != number]
+        keys.extend(self.nan)
+        return keys
+
+    def sorted_keys(self):
+        """
+        Return the keys sorted by (number, key), cached until the column
+        changes.
+        """
+        if self.order is None or self.order[0] != self.version:
+            pairs = sorted(zip(compress(self.numbers, self.mask), compress(self.keys, self.mask)))
+            self.order = (self.version, [pair[1] for pair in pairs], array("d", [pair[0] for pair in pairs]))
+        return self.order[1]
+
+    def present(self):
+        """
+        Return the list of numbers, without the free slots.
+        """
+        return list(compress(self.numbers, self.mask))
+
+    def _scan(self, low, high, low_open, high_open):
+        low_compare = gt if low_open else ge
+        high_compare = lt if high_open else le
+        match_list = []
+        append = match_list.append
+        for key, value, present in zip(self.keys, self.numbers, self.mask):
+            if not present:
+                continue
+            if low is not None and not low_compare(value, low):
+                continue
+            if high is not None and not high_compare(value, high):
+                continue
+            append(key)
+        return match_list
+
+
+def _trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class TextIndex:
+    """
+    Inverted index of a text field (dotted paths allowed) for substring and
+    word searches.
+
+    Values are normalized like a case insensitive ascii search, words map to
+    the keys holding them with their frequency (used for ranking) and
+    trigrams map to the keys whose text contains them. A substring search
+    only checks the keys holding all the trigrams of the searched text.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.getter = _compile_path(field)
+        self.texts = {}
+        self.words = {}
+        self.grams = {}
+
+    def add(self, key, document):
+        value = self.getter(document)
+        if not isinstance(value, str):
+            return
+        text = _ascii_lower(value)
+        self.texts[key] = text
+        for word, count in Counter(_WORD.findall(text)).items():
+            self.words.setdefault(word, {})[key] = count
+        grams = self.grams
+        for gram in _trigrams(text):
+            keys = grams.get(gram)
+            if keys is None:
+                grams[gram] = {key: None}
+            else:
+                keys[key] = None
+
+    def remove(self, key):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for postings, tokens in ((self.words, set(_WORD.findall(text))), (self.grams, _trigrams(text))):
+            for token in tokens:
+                keys = postings[token]
+                del keys[key]
+                if not keys:
+                    del postings[token]
+
+    def clear(self):
+        self.texts.clear()
+        self.words.clear()
+        self.grams.clear()
+
+    def candidates(self, text):
+        """
+        Return the keys whose text may contain the searched text, a superset
+        of the keys matching any case or ascii conversion option.
+        """
+        grams = _trigrams(_ascii_lower(text))
+        if not grams:
+            return list(self.texts)
+        postings = sorted((self.grams.get(gram, {}) for gram in grams), key=len)
+        rest = postings[1:]
+        return [key for key in postings[0] if all(key in keys for keys in rest)]
+
+    def rank(self, keys, text):
+        """
+        Sort the keys by the tf-idf score of the searched words.
+        """
+        total = len(self.texts)
+        weights = []
+        for word in set(_WORD.findall(_ascii_lower(text))):
+            postings = self.words.get(word)
+            if postings:
+                weights.append((postings, math.log(1 + total / len(postings))))
+
+        def score(key):
+            return sum(postings.get(key, 0) * weight for postings, weight in weights)
+
+        return sorted(keys, key=score, reverse=True)
+
+    def dump(self):
+        return {"texts": self.texts, "words": self.words, "grams": self.grams}
+
+    def restore(self, data):
+        self.texts = data["texts"]
+        self.words = data["words"]
+        self.grams = data["grams"]
+
+
+class Codec:
+    """
+    Compression codec of the compressed documents, zlib and lzma are
+    available by name. The name is saved with the documents and compress and
+    decompress are functions of bytes.
+    """
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _codec(codec):
+    """
+    Return the codec or the stdlib codec with that name.
+    """
+    if isinstance(codec, Codec):
+        return codec
+    if codec == "zlib":
+        import zlib
+
+        return Codec("zlib", zlib.compress, zlib.decompress)
+    if codec == "lzma":
+        import lzma
+
+        return Codec("lzma", lzma.compress, lzma.decompress)
+    raise TypeError('invalid compression codec: "{}"'.format(codec))
+
+
+class Compressed:
+    """
+    Document stored as compressed json, decoded on every access.
+    """
+
+    __slots__ = ("codec", "data")
+
+    def __init__(self, codec, data):
+        self.codec = codec
+        self.data = data
+
+    def decode(self):
+        return json.loads(self.codec.decompress(self.data))
+
+    def dump(self):
+        import base64
+
+        return {_COMPRESSED: self.codec.name, "data": base64.b64encode(self.data).decode()}
+
+
+def _serializable(value):
+    try:
+        json.dumps(value)
+    except (TypeError, OverflowError):
+        return False
+    return True
+
+
+class Record(Mapping):
+    """
+    Read only document following a database schema, the values are stored on
+    a tuple in the schema field order and missing optional fields hold
+    _MISSING. Each schema has a subclass defining the fields and positions.
+    """
+
+    __slots__ = ("values",)
+    fields = ()
+    positions = {}
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, name):
+        value = self.values[self.positions[name]]
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        position = self.positions.get(name)
+        if position is None:
+            return default
+        value = self.values[position]
+        return default if value is _MISSING else value
+
+    def __contains__(self, name):
+        position = self.positions.get(name)
+        return position is not None and self.values[position] is not _MISSING
+
+    def __iter__(self):
+        return (name for name, value in zip(self.fields, self.values) if value is not _MISSING)
+
+    def __len__(self):
+        return len(self.values) - self.values.count(_MISSING)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class Schema:
+    """
+    Compiled validator and record layout of the database documents.
+
+    The schema maps each field to its type, str, int, float, bool, list, dict
+    or object for any json value, or to a (type, required) tuple. Fields are
+    required by default and other fields are allowed. Documents holding only
+    schema fields are stored as records.
+    """
+
+    def __init__(self, schema):
+        if not isinstance(schema, dict) or not schema:
+            raise TypeError("schema must be a non empty dict")
+        self.types = {}
+        self.required = set()
+        for field, spec in schema.items():
+            if not isinstance(field, str):
+                raise TypeError("schema field must be string")
+            kind, required = spec if isinstance(spec, tuple) and len(spec) == 2 else (spec, True)
+            if kind not in self.checks or not isinstance(required, bool):
+                raise TypeError('invalid schema type: "{}"'.format(field))
+            self.types[field] = kind
+            if required:
+                self.required.add(field)
+        self.fields = tuple(schema)
+        self.validators = [(field, self.checks[kind], field in self.required) for field, kind in self.types.items()]
+        positions = {field: position for position, field in enumerate(self.fields)}
+        self.record = type("Record", (Record,), {"__slots__": (), "fields": self.fields, "positions": positions})
+
+    checks = {
+        str: lambda value: isinstance(value, str),
+        int: lambda value: isinstance(value, int) and value is not True and value is not False,
+        float: lambda value: isinstance(value, (int, float)) and value is not True and value is not False,
+        bool: lambda value: value is True or value is False,
+        list: lambda value: isinstance(value, list) and _serializable(value),
+        dict: lambda value: isinstance(value, dict) and _serializable(value),
+        object: _serializable,
+    }
+
+    def validate(self, document):
+        """
+        Check the schema fields of the document and return the number of
+        schema fields it holds.
+        """
+        present = 0
+        for field, check, required in self.validators:
+            value = document.get(field, _MISSING)
+            if value is _MISSING:
+                if required:
+                    raise TypeError('missing required field: "{}"'.format(field))
+                continue
+            if not check(value):
+                raise TypeError('invalid type for field "{}": expected {}'.format(field, self.types[field].__name__))
+            present += 1
+        return present
+
+    def check(self, field, value):
+        """
+        Check a changed field, _MISSING values remove the field.
+        """
+        kind = self.types.get(field)
+        if kind is None:
+            return
+        if value is _MISSING:
+            if field in self.required:
+                raise TypeError('missing required field: "{}"'.format(field))
+        elif not self.checks[kind](value):
+            raise TypeError('invalid type for field "{}": expected {}'.format(field, kind.__name__))
+
+    def pack(self, document):
+        """
+        Return the document as a record or None if it holds other fields.
+        """
+        values = tuple([document.get(field, _MISSING) for field in self.fields])
+        if len(values) - values.count(_MISSING) != len(document):
+            return None
+        return self.record(values)
+
+
+def _parse_jsonl(chunk):
+    """
+    Parse a chunk of json lines into (key, document) pairs, run by the import
+    workers.
+    """
+    start, lines, key, spec = chunk
+    schema = None if spec is None else Schema(spec)
+    pairs = []
+    for number, line in enumerate(lines, start):
+        if not line.strip():
+            continue
+        try:
+            document = json.loads(line)
+        except ValueError:
+            raise TypeError("line {}: invalid json".format(number))
+        pairs.append(_import_pair(document, key, schema, "line", number))
+    return pairs
+
+
+def _parse_csv(chunk):
+    """
+    Convert a chunk of csv rows into (key, document) pairs, empty values are
+    left out. Run by the import workers.
+    """
+    start, header, rows, key, types, spec = chunk
+    schema = None if spec is None else Schema(spec)
+    pairs = []
+    for number, row in enumerate(rows, start):
+        if len(row) != len(header):
+            raise TypeError("row {}: expected {} values".format(number, len(header)))
+        document = {}
+        for field, value in zip(header, row):
+            if value == "":
+                continue
+            kind = types.get(field)
+            if kind is not None:
+                try:
+                    value = _CSV_TYPES[kind](value)
+                except ValueError:
+                    raise TypeError('row {}: invalid {} for field "{}"'.format(number, kind.__name__, field))
+            document[field] = value
+        pairs.append(_import_pair(document, key, schema, "row", number))
+    return pairs
+
+
+def _import_pair(document, key, schema, unit, number):
+    """
+    Check an imported document and take its key out.
+    """
+    if not isinstance(document, dict) or not document:
+        raise TypeError("{} {}: document must be a non empty dict".format(unit, number))
+    if _COMPRESSED in document:
+        raise TypeError('{} {}: document field "{}" is reserved'.format(unit, number, _COMPRESSED))
+    value = None
+    if key is not None:
+        value = document.pop(key, None)
+        if not isinstance(value, str):
+            raise TypeError('{} {}: key field "{}" must be string'.format(unit, number, key))
+        if not document:
+            raise TypeError("{} {}: document must not be empty".format(unit, number))
+    if schema is not None:
+        try:
+            schema.validate(document)
+        except TypeError as e:
+            raise TypeError("{} {}: {}".format(unit, number, e))
+    return value, document
+
+
+def _csv_bool(value):
+    lowered = value.lower()
+    if lowered in ("true", "1"):
+        return True
+    if lowered in ("false", "0"):
+        return False
+    raise ValueError(value)
+
+
+def _csv_value(value):
+    """
+    Format a value as a csv cell, lists and dicts as json.
+    """
+    if isinstance(value, str):
+        return value
+    if value is None:
+        return ""
+    if value is True or value is False:
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return json.dumps(value, default=_encode)
+
+
+def _block_index(data):
+    """
+    Return the block index of a block format file as [offset, length, crc,
+    keys] lists, or None if the footer or the index is damaged.
+    """
+    if len(data) < len(_BLOCKS_MAGIC) + 20:
+        return None
+    footer = data[-20:]
+    offset = int.from_bytes(footer[:8], "big")
+    return _parse_index(footer, data[offset:-20], len(data))
+
+
+def _parse_index(footer, index, size):
+    """
+    Check the footer, {index offset: 8 bytes, index length: 4, index crc:
+    4, magic: 4}, and decode the index.
+    """
+    import zlib
+
+    offset = int.from_bytes(footer[:8], "big")
+    length = int.from_bytes(footer[8:12], "big")
+    if footer[-4:] != _INDEX_MAGIC or offset + length + 20 != size or len(index) != length:
+        return None
+    if zlib.crc32(index) != int.from_bytes(footer[12:16], "big"):
+        return None
+    try:
+        return json.loads(bytes(index))
+    except ValueError:
+        return None
+
+
+def _scan_blocks(data):
+    """
+    Return the index of the blocks found walking their headers, used when
+    the index is damaged. The keys are unknown and the walk stops at a
+    damaged header.
+    """
+    import zlib
+
+    index = []
+    offset = len(_BLOCKS_MAGIC)
+    while offset + 8 <= len(data):
+        length = int.from_bytes(data[offset : offset + 4], "big")
+        crc = int.from_bytes(data[offset + 4 : offset + 8], "big")
+        if offset + 8 + length > len(data) or zlib.crc32(data[offset + 8 : offset + 8 + length]) != crc:
+            break
+        index.append([offset, length, crc, None])
+        offset += 8 + length
+    return index
+
+
+def _block_intact(data, block):
+    """
+    Check the header and checksum of a block, without decoding it.
+    """
+    import zlib
+
+    offset, length, crc, _ = block
+    header = length.to_bytes(4, "big") + crc.to_bytes(4, "big")
+    return data[offset : offset + 8] == header and zlib.crc32(data[offset + 8 : offset + 8 + length]) == crc
+
+
+def _encode(obj):
+    """
+    Json encoder default, saves the compressed documents as json objects.
+    """
+    if isinstance(obj, Compressed):
+        return obj.dump()
+    if isinstance(obj, Record):
+        return dict(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+class SpillCache:
+    """
+    Bounded set of the documents kept in memory.
+
+    Resident keys are kept in least recently used order with their estimated
+    size (the json length, only computed when max_memory is set). Evicted
+    documents are appended to a segment file and replaced by a placeholder on
+    the database dict, so the insertion order is kept. The segment is
+    rewritten when most of it holds outdated documents.
+
+    The segment is a temporary file private to the cache, created next to
+    the database path and removed when the cache is cleared or closed, or
+    the process exits.
+    """
+
+    def __init__(self, path, max_documents=None, max_memory=None):
+        self.path = path
+        self.max_documents = max_documents
+        self.max_memory = max_memory
+        self.file = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self.resident = OrderedDict()
+        self.memory = 0
+        self.spilled = {}
+        self.end = 0
+        self.garbage = 0
+        self.close()
+
+    def close(self):
+        """
+        Close and remove the segment, the spilled documents are lost.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def add(self, key, document):
+        self.discard(key)
+        size = len(json.dumps(document, default=_encode)) if self.max_memory is not None else 0
+        self.resident[key] = size
+        self.memory += size
+
+    def discard(self, key):
+        size = self.resident.pop(key, None)
+        if size is not None:
+            self.memory -= size
+            return
+        location = self.spilled.pop(key, None)
+        if location is not None:
+            self.garbage += location[1]
+
+    def touch(self, key):
+        self.hits += 1
+        self.resident.move_to_end(key)
+
+    def raw(self, key):
+        offset, length = self.spilled[key]
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def read(self, key):
+        """
+        Read a spilled document, it stays spilled.
+        """
+        self.misses += 1
+        return json.loads(self.raw(key))
+
+    def load(self, key):
+        """
+        Read a spilled document back, making it the most recently used.
+        """
+        document = self.read(key)
+        self.add(key, document)
+        return document
+
+    def evict(self, db):
+        """
+        Spill the least recently used documents until the limits are met.
+        """
+        max_documents = self.max_documents
+        max_memory = self.max_memory
+        resident = self.resident
+        while resident and (
+            (max_documents is not None and len(resident) > max_documents)
+            or (max_memory is not None and self.memory > max_memory)
+        ):
+            key, size = resident.popitem(last=False)
+            self.memory -= size
+            self.spill(key, db[key])
+            db[key] = _SPILLED
+            self.evictions += 1
+        if self.garbage > self.compact_size and self.garbage > self.end // 2:
+            self.compact()
+
+    def spill(self, key, document):
+        if self.file is None:
+            self.file = self._segment()
+        data = json.dumps(document, default=_encode).encode()
+        self.file.seek(self.end)
+        self.file.write(data)
+        self.spilled[key] = (self.end, len(data))
+        self.end += len(data)
+
+    def compact(self):
+        """
+        Rewrite the segment with only the spilled documents.
+        """
+        segment = self._segment()
+        spilled = {}
+        end = 0
+        for key in self.spilled:
+            data = self.raw(key)
+            segment.write(data)
+            spilled[key] = (end, len(data))
+            end += len(data)
+        self.file.close()
+        self.file = segment
+        self.spilled = spilled
+        self.end = end
+        self.garbage = 0
+
+    def _segment(self):
+        """
+        Create a segment file, unique to this cache and removed on close.
+        """
+        import tempfile
+
+        directory, name = os.path.split(os.path.abspath(self.path))
+        return tempfile.TemporaryFile(suffix=".spill", prefix=name + ".", dir=directory)
+
+    def snapshot(self):
+        return {
+            "resident": len(self.resident),
+            "spilled": len(self.spilled),
+            "memory": self.memory,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    # Outdated segment bytes tolerated before compacting
+    compact_size = 1 << 20
+
+
+class _Clause:
+    """
+    A single query condition: field operator value.
+    """
+
+    def __init__(self, field, operator, value=None, sens=False, asc=True):
+        self.field = field
+        self.operator = operator
+        self.value = value
+        self.getter = _compile_path(field)
+        self.fold = _folder(sens, asc)
+        self.predicate = self._compile(sens, asc)
+
+    def match(self, document):
+        return self.predicate(self.getter(document))
+
+    def _compile(self, sens, asc):
+        operator = self.operator
+        value = self.value
+        fold = self.fold
+        if operator == "exists":
+            return lambda field_value: field_value is not _MISSING
+        if operator == "in":
+            texts = set(fold(item) for item in value if isinstance(item, str))
+            numbers = set(item for item in value if not isinstance(item, str))
+
+            def predicate(field_value):
+                if isinstance(field_value, str) and fold(field_value) in texts:
+                    return True
+                try:
+                    return float(field_value) in numbers
+                except (TypeError, ValueError):
+                    return False
+
+            return predicate
+        if operator == "between":
+            low, high = value
+
+            def predicate(field_value):
+                try:
+                    return low <= float(field_value) <= high
+                except (TypeError, ValueError):
+                    return False
+
+            return predicate
+        if not isinstance(value, str):
+            compare = _NUMBER_OPERATORS[operator]
+
+            def predicate(field_value):
+                try:
+                    return compare(float(field_value), value)
+                except (TypeError, ValueError):
+                    return False
+
+            return predicate
+        if operator == "regex":
+            try:
+                pattern = re.compile(value, 0 if sens else re.IGNORECASE)
+            except re.error:
+                raise TypeError('invalid regex: "{}"'.format(value))
+            fold = _folder(True, asc)
+            search = pattern.search
+            return lambda field_value: isinstance(field_value, str) and search(fold(field_value)) is not None
+        text = fold(value)
+        if operator == "==":
+            return lambda field_value: isinstance(field_value, str) and fold(field_value) == text
+        if operator == "!=":
+            return lambda field_value: isinstance(field_value, str) and text not in fold(field_value)
+        if operator == "?=":
+            return lambda field_value: isinstance(field_value, str) and text in fold(field_value)
+        return lambda field_value: isinstance(field_value, str) and fold(field_value).startswith(text)
+
+    def lookup(self, index):
+        """
+        Return the keys of the matching documents using the field index.
+        """
+        operator = self.operator
+        value = self.value
+        if operator == "exists":
+            return index.present()
+        if operator == "in":
+            values = index.text_values(self.fold, [self.fold(item) for item in value if isinstance(item, str)])
+            for item in value:
+                if not isinstance(item, str):
+                    values.extend(index.number_values(item, item))
+        elif operator == "between":
+            values = index.number_values(value[0], value[1])
+        elif isinstance(value, str) and operator == "==":
+            values = index.text_values(self.fold, [self.fold(value)])
+        elif operator == "startswith":
+            values = index.prefix_values(self.fold, self.fold(value))
+        elif not isinstance(value, str) and operator != "!=":
+            values = index.number_values(*self.bounds())
+        else:
+            return index.match(self.predicate)
+        return index.keys(values)
+
+    def describe(self):
+        value = self.value
+        if isinstance(value, tuple):
+            value = list(value)
+        return {"field": self.field, "operator": self.operator, "value": value}
+
+    def substring(self):
+        """
+        Check if the condition only matches text containing the value.
+        """
+        return self.operator in ("==", "?=", "startswith") and isinstance(self.value, str)
+
+    def numeric(self):
+        """
+        Check if the condition only compares numbers.
+        """
+        if self.operator == "in":
+            return not any(isinstance(item, str) for item in self.value)
+        return self.operator == "between" or (self.operator != "exists" and not isinstance(self.value, str))
+
+    def bounds(self):
+        """
+        Return the number range (low, high, low_open, high_open) of a
+        numeric comparison.
+        """
+        value = self.value
+        if self.operator == "between":
+            return (value[0], value[1], False, False)
+        return {
+            "==": (value, value, False, False),
+            "<": (None, value, False, True),
+            "<=": (None, value, False, False),
+            ">": (value, None, True, False),
+            ">=": (value, None, False, False),
+        }[self.operator]
+
+    def lookup_column(self, column):
+        """
+        Return the keys of the matching documents using the numeric column.
+        """
+        if self.operator == "in":
+            keys = []
+            for item in dict.fromkeys(self.value):
+                keys.extend(column.select(item, item))
+            return keys
+        if self.operator == "!=":
+            return column.select_not(self.value)
+        return column.select(*self.bounds())
+
+
+class _Aggregate:
+    """
+    Streaming aggregate (count, sum, min, max or avg) of a document field.
+    """
+
+    def __init__(self, function, field=None):
+        self.function = function
+        self.getter = None if field is None else _compile_path(field)
+        self.count = 0
+        self.total = 0
+        self.low = None
+        self.high = None
+
+    def add(self, document):
+        if self.getter is None:
+            self.count += 1
+            return
+        value = self.getter(document)
+        if self.function == "count":
+            if value is not _MISSING:
+                self.count += 1
+            return
+        self.add_number(_to_number(value))
+
+    def add_number(self, number, times=1):
+        if number is None:
+            return
+        self.count += times
+        self.total += number * times
+        if self.low is None or number < self.low:
+            self.low = number
+        if self.high is None or number > self.high:
+            self.high = number
+
+    def result(self):
+        if self.function == "count":
+            return self.count
+        if self.function == "sum":
+            return self.total
+        if not self.count:
+            return False
+        if self.function == "min":
+            return self.low
+        if self.function == "max":
+            return self.high
+        return self.total / self.count
+
+
+class _Logic:
+    """
+    A logical combination (and/or) of query conditions.
+    """
+
+    def __init__(self, operator, children):
+        self.operator = operator
+        self.children = children
+
+    def match(self, document):
+        if self.operator == "and":
+            for child in self.children:
+                if not child.match(document):
+                    return False
+            return True
+        for child in self.children:
+            if child.match(document):
+                return True
+        return False
+
+
+class _QueryParser:
+    """
+    Recursive descent parser building the query tree, "and" binds tighter
+    than "or" and parentheses can be used for grouping.
+    """
+
+    def __init__(self, query, tokens, sens, asc):
+        self.query = query
+        self.tokens = tokens
+        self.sens = sens
+        self.asc = asc
+        self.pos = 0
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            if token == ")":
+                raise self.error()
+            raise TypeError('invalid logical operator: "{}"'.format(token))
+        return node
+
+    def error(self):
+        return TypeError('invalid query: "{}"'.format(self.query))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise self.error()
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while (self.peek() or "").lower() == "or":
+            self.pos += 1
+            children.append(self.parse_and())
+        if len(children) == 1:
+            return children[0]
+        return _Logic("or", children)
+
+    def parse_and(self):
+        children = [self.parse_group()]
+        while (self.peek() or "").lower() == "and":
+            self.pos += 1
+            children.append(self.parse_group())
+        if len(children) == 1:
+            return children[0]
+        return _Logic("and", children)
+
+    def parse_group(self):
+        if self.peek() == "(":
+            self.pos += 1
+            node = self.parse_or()
+            if self.next() != ")":
+                raise self.error()
+            return node
+        return self.parse_clause()
+
+    def parse_clause(self):
+        field = self.next()
+        if field in ("(", ")", ",") or field[0] == '"':
+            raise self.error()
+        operator = self.next()
+        if operator == "exists":
+            value = None
+        elif operator == "in":
+            if self.next() != "(":
+                raise self.error()
+            value = [self.parse_value()]
+            while self.peek() == ",":
+                self.pos += 1
+                value.append(self.parse_value())
+            if self.next() != ")":
+                raise self.error()
+        elif operator == "between":
+            low = self.parse_number()
+            if self.next().lower() != "and":
+                raise self.error()
+            value = (low, self.parse_number())
+        else:
+            value = self.parse_value()
+            if isinstance(value, str) and operator not in _STRING_OPERATORS:
+                raise TypeError('invalid string operator: "{}"'.format(operator))
+            if not isinstance(value, str) and operator not in _NUMBER_OPERATORS:
+                raise TypeError('invalid number operator: "{}"'.format(operator))
+        return _Clause(field, operator, value, sens=self.sens, asc=self.asc)
+
+    def parse_value(self):
+        token = self.next()
+        if token[0] == '"':
+            if token[:2] == '""' and len(token) >= 4:
+                return token[2:-2]
+            return token[1:-1]
+        return self.parse_number(token)
+
+    def parse_number(self, token=None):
+        if token is None:
+            token = self.next()
+        if token in ("(", ")", ","):
+            raise self.error()
+        try:
+            return float(token)
+        except ValueError:
+            raise TypeError('invalid number: "{}"'.format(token))
+
+
+class Metrics:
+    """
+    Operation counters and latency histograms of a database.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.saves = 0
+        self.expired = 0
+        self.bytes_written = 0
+        self.last_save_bytes = 0
+        self.autosaves = 0
+        self.queries = 0
+        self.scanned = 0
+        self.matched = 0
+        self.slow_queries = 0
+
+    def record(self, method, elapsed):
+        call = self.calls.get(method)
+        if call is None:
+            call = self.calls[method] = {"count": 0, "total": 0.0, "max": 0.0, "histogram": [0] * len(_LATENCY_BUCKETS)}
+        call["count"] += 1
+        call["total"] += elapsed
+        if elapsed > call["max"]:
+            call["max"] = elapsed
+        call["histogram"][bisect_left(_LATENCY_BUCKETS, elapsed)] += 1
+
+    def record_query(self, scanned, matched):
+        self.queries += 1
+        self.scanned += scanned
+        self.matched += matched
+
+    def record_save(self, size):
+        self.saves += 1
+        self.bytes_written += size
+        self.last_save_bytes = size
+
+    def snapshot(self):
+        calls = {}
+        for method, call in self.calls.items():
+            calls[method] = {
+                "count": call["count"],
+                "total": call["total"],
+                "avg": call["total"] / call["count"],
+                "max": call["max"],
+                "histogram": dict(zip(_LATENCY_BUCKETS, call["histogram"])),
+            }
+        return {
+            "calls": calls,
+            "saves": self.saves,
+            "expired": self.expired,
+            "bytes_written": self.bytes_written,
+            "last_save_bytes": self.last_save_bytes,
+            "autosaves": self.autosaves,
+            "queries": self.queries,
+            "scanned": self.scanned,
+            "matched": self.matched,
+            "slow_queries": self.slow_queries,
+        }
+
+
+class _Lazy:
+    """
+    Mixed into the class of a lazy database until it is loaded, so only lazy
+    databases pay for __getattr__ on every attribute access.
+    """
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, a lazy database is loaded on
+        # the first access to its documents, indexes or expiration times
+        deferred = self.__dict__.get("_deferred")
+        if deferred is not None and (name == "db" or name in deferred):
+            self.load()
+            return getattr(self, name)
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).eager.__name__, name))
+
+
+# Lazy subclass of each database class, see _lazy_class
+_LAZY_CLASSES = {}
+
+
+def _lazy_class(cls):
+    """
+    Return the lazy subclass of a database class, cls.eager is restored by
+    load.
+    """
+    lazy = _LAZY_CLASSES.get(cls)
+    if lazy is None:
+        lazy = _LAZY_CLASSES[cls] = type(cls.__name__, (_Lazy, cls), {"eager": cls, "__module__": cls.__module__})
+    return lazy
+
+
+class dbj:
+    """
+    Documentation on: https://github.com/pdrb/dbj
+    """
+
+    # Expired documents removed per single key operation, queries remove all
+    purge_batch = 100
+
+    # Latest changes kept to resume the change feed
+    changelog_size = 1000
+
+    # Documents whose json is at least this long are compressed
+    compression_threshold = 1024
+
+    # Sorted permutations cached, by sort fields, and the total keys they
+    # may hold
+    sort_cache_size = 16
+    sort_cache_keys = 1 << 20
+
+    # Lines parsed per import chunk and file size from which imports use
+    # one worker process per cpu
+    import_chunk_size = 10000
+    import_parallel_size = 16 * 1024 * 1024
+
+    # Json bytes of the documents written per block in the block format
+    block_size = 64 * 1024
+
+    # Attributes holding loaded state, deferred on lazy databases
+    _loaded = ("expires", "expiry_heap", "indexes", "columns", "textindexes", "compressed")
+
+    document_type_error = TypeError("document must be dict")
+    key_type_error = TypeError("document key must be string")
+    reserved_field_error = TypeError('document field "{}" is reserved'.format(_COMPRESSED))
+    keys_type_error = TypeError("keys must be a list")
+
+    def __init__(
+        self,
+        path,
+        autosave=False,
+        indexes=None,
+        columns=None,
+        textindexes=None,
+        metrics=False,
+        slow_query=None,
+        max_documents=None,
+        max_memory=None,
+        lazy=False,
+        compression=None,
+        intern=None,
+        schema=None,
+        blocks=None,
+    ):
+        self.path = path
+        # Save in the block format, None keeps the format of the file
+        if blocks not in (None, True, False):
+            raise TypeError("blocks must be bool")
+        self.blocks = blocks
+        self.autosave = autosave
+        self.metrics = None
+        self.slow_query = slow_query
+        self.hooks = {"pre": [], "post": []}
+        # Nesting of the metered calls, only the outermost one is recorded
+        self.depth = 0
+        # Change feed sequence number, ring buffer of the latest changes as
+        # (seq, op, key, document) and the change callbacks
+        self.seq = 0
+        self.changelog = deque(maxlen=self.changelog_size)
+        # Changelog position (seq) of the stored documents it holds
+        self.shared = {}
+        self.subscribers = []
+        # Sorted permutations by sort fields (None until sorted twice) and
+        # the seq they are valid for
+        self.sorts = {}
+        self.sorts_seq = 0
+        # Expiration timestamp of the documents inserted with a ttl and a
+        # min-heap of (timestamp, key), may hold outdated entries
+        self.expires = {}
+        self.expiry_heap = []
+        self.indexes = {}
+        self.columns = {}
+        self.textindexes = {}
+        for field in indexes or []:
+            if not self._isstr(field):
+                raise TypeError("index field must be string")
+            self.indexes[field] = FieldIndex(field)
+        for field in columns or []:
+            if not self._isstr(field):
+                raise TypeError("column field must be string")
+            self.columns[field] = NumericColumn(field)
+        for field in textindexes or []:
+            if not self._isstr(field):
+                raise TypeError("text index field must be string")
+            self.textindexes[field] = TextIndex(field)
+        # Numeric schema fields are queried and sorted using columns
+        self.schema = None if schema is None else Schema(schema)
+        if self.schema is not None:
+            for field, kind in self.schema.types.items():
+                if kind in (int, float) and field not in self.columns:
+                    self.columns[field] = NumericColumn(field)
+        # Compression codec of the new documents and whether any document on
+        # database is compressed
+        self.codec = None if compression is None else _codec(compression)
+        self.compressed = False
+        # Shared strings table, the fields whose values are interned and the
+        # strings replaced by a shared one
+        self.strings = None
+        self.intern_fields = []
+        self.interned = {"replaced": 0, "bytes_saved": 0}
+        if intern is not None:
+            if intern is not True and not (isinstance(intern, list) and all(map(self._isstr, intern))):
+                raise TypeError("intern must be True or a list of strings")
+            self.strings = {}
+            if intern is not True:
+                self.intern_fields = intern
+        self.cache = None
+        for name, limit in (("max_documents", max_documents), ("max_memory", max_memory)):
+            if limit is not None and (type(limit) is not int or limit < 1):
+                raise TypeError("{} must be a positive integer".format(name))
+        if max_documents is not None or max_memory is not None:
+            self.cache = SpillCache(path, max_documents, max_memory)
+        if metrics:
+            self.metrics = Metrics()
+        if metrics or slow_query is not None:
+            self._instrument()
+        if lazy:
+            # Restored on the first access, before loading the documents
+            self._deferred = {name: self.__dict__.pop(name) for name in self._loaded}
+            self.__class__ = _lazy_class(type(self))
+        else:
+            self.load()
+
+    def load(self, recover=False):
+        """
+        Load the database or create a new one if the file does not exists.
+
+        Args:
+            recover (bool, optional): Skip the damaged blocks of a block
+                format file instead of raising ValueError. Defaults to False.
+
+        Returns:
+            List with the keys of the documents lost on damaged blocks when
+            recovering, unknown when the block index is damaged too.
+
+        Raises:
+            ValueError: If the file is damaged and not recovering.
+        """
+        # Loading a lazy database explicitly restores its deferred state and
+        # its class
+        deferred = self.__dict__.pop("_deferred", None)
+        if deferred is not None:
+            self.__dict__.update(deferred)
+            self.__class__ = type(self).eager
+        lost = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            if data.startswith(_BLOCKS_MAGIC):
+                db_data, lost = self._read_blocks(data, recover)
+                if self.blocks is None:
+                    self.blocks = True
+            else:
+                db_data = json.loads(data)
+        else:
+            db_data = dict()
+        self.compressed = False
+        self.sorts.clear()
+        for key, document in db_data.items():
+            if _COMPRESSED in document:
+                db_data[key] = self._stored(document)
+            else:
+                if self.intern_fields:
+                    self._intern_values(document)
+                if self.schema is not None:
+                    db_data[key] = self.schema.pack(document) or document
+        self.db = db_data
+        expired = self._load_expires()
+        for index in chain(self.indexes.values(), self.columns.values()):
+            self._build_index(index)
+        self._load_textindexes(expired)
+        if self.cache is not None:
+            self.cache.clear()
+            for key, document in self.db.items():
+                self.cache.add(key, document)
+            self.cache.evict(self.db)
+        if recover:
+            return lost
+
+    def _read_blocks(self, data, recover):
+        """
+        Decode the blocks of a block format file, returning the documents
+        and the keys of the damaged blocks.
+        """
+        data = memoryview(data)
+        index = _block_index(data)
+        if index is None:
+            if not recover:
+                raise ValueError("damaged block index: {}".format(self.path))
+            index = _scan_blocks(data)
+        db_data = {}
+        lost = []
+        for block in index:
+            if _block_intact(data, block):
+                offset, length, _, _ = block
+                db_data.update(json.loads(bytes(data[offset + 8 : offset + 8 + length])))
+                continue
+            if not recover:
+                raise ValueError("damaged block at offset {}: {}".format(block[0], self.path))
+            lost.extend(block[3])
+        return db_data, lost
+
+    def verify(self):
+        """
+        Check the integrity of the saved file. The blocks of a block format
+        file are checked using their checksums, without decoding them, a json
+        file is parsed.
+
+        Returns:
+            Dict with the format, whether the file is intact, and for the
+            block format the blocks count, damaged block numbers, keys of the
+            damaged blocks and whether the index is intact, or False if the
+            file does not exist.
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if not data.startswith(_BLOCKS_MAGIC):
+            try:
+                json.loads(data)
+            except ValueError:
+                return {"format": "json", "ok": False}
+            return {"format": "json", "ok": True}
+        data = memoryview(data)
+        index = _block_index(data)
+        intact = index is not None
+        if not intact:
+            index = _scan_blocks(data)
+        damaged = [number for number, block in enumerate(index) if not _block_intact(data, block)]
+        keys = [key for number in damaged for key in index[number][3]]
+        return {
+            "format": "blocks",
+            "ok": intact and not damaged,
+            "blocks": len(index),
+            "damaged": damaged,
+            "keys": keys,
+            "index": intact,
+        }
+
+    def peek(self):
+        """
+        Return the keys saved on disk without loading the documents, or the
+        database keys if it is already loaded.
+
+        Returns:
+            List with the database keys.
+        """
+        if "db" in self.__dict__:
+            return self.getallkeys()
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as f:
+            blocks = f.read(len(_BLOCKS_MAGIC)) == _BLOCKS_MAGIC
+        if blocks:
+            keys = self._peek_blocks()
+        else:
+            keys = self._peek_json()
+        if os.path.exists(self._expires_path()):
+            with open(self._expires_path(), "rt") as f:
+                expires = json.load(f)
+            now = time.time()
+            keys = [key for key in keys if expires.get(key, now + 1) > now]
+        return keys
+
+    def _peek_blocks(self):
+        """
+        Return the keys of a block format file reading only its footer and
+        index, or the intact blocks if the index is damaged.
+        """
+        with open(self.path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            index = None
+            if size >= len(_BLOCKS_MAGIC) + 20:
+                f.seek(size - 20)
+                footer = f.read(20)
+                offset = min(int.from_bytes(footer[:8], "big"), size - 20)
+                f.seek(offset)
+                index = _parse_index(footer, f.read(size - 20 - offset), size)
+            if index is None:
+                f.seek(0)
+                return list(self._read_blocks(f.read(), True)[0])
+        return [key for block in index for key in block[3]]
+
+    def _peek_json(self):
+        # Discard every object while parsing, only the top level pairs,
+        # the last ones decoded, are kept
+        last = [[]]
+
+        def keep(pairs):
+            last[0] = pairs
+
+        with open(self.path, "rt") as f:
+            json.load(f, object_pairs_hook=keep)
+        return [key for key, _ in last[0]]
+
+    def save(self, indent=None):
+        """
+        Save database to disk protecting from kill signals.
+
+        The block format (dbj(path, blocks=True)) groups the documents in
+        blocks with a CRC32 checksum followed by an index of the blocks and
+        their keys, so damaged blocks are detected by verify() and skipped by
+        load(recover=True).
+
+        Args:
+            indent (int or str, optional): If provided, save a prettified json
+                with that indent level. 0, negative or "" will only insert
+                newlines. Ignored by the block format.
+
+        Returns:
+            True if saved successful.
+        """
+        self._purge()
+        if self.blocks:
+            with open(self.path, "wb") as f:
+                with KillProtected():
+                    self._dump_blocks(f)
+        else:
+            with open(self.path, "wt") as f:
+                with KillProtected():
+                    if self.cache is not None and self.cache.spilled:
+                        self._dump(f, indent)
+                    else:
+                        json.dump(self.db, f, indent=indent, default=_encode)
+        if self.metrics is not None:
+            self.metrics.record_save(os.path.getsize(self.path))
+        if self.textindexes:
+            self._save_textindexes()
+        if self.expires or os.path.exists(self._expires_path()):
+            self._save_expires()
+        return True
+
+    def insert(self, document, key=None, ttl=None):
+        """
+        Create a new document on database.
+
+        Args:
+            document (dict): The document to be created.
+            key (str, optional): The document unique key. Defaults to uuid1.
+            ttl (int or float, optional): Remove the document after this many
+                seconds. Defaults to never.
+
+        Returns:
+            The document key.
+
+        Raises:
+            TypeError: If document is not dict, document is empty, the optional
+                key is not str, document field (dict key) is not str or is
+                the reserved "$compressed", document is not json serializable
+                or ttl is not a positive number.
+        """
+        if not isinstance(document, dict):
+            raise self.document_type_error
+        if not document:
+            raise TypeError("document must not be empty")
+        if _COMPRESSED in document:
+            raise self.reserved_field_error
+        if key is not None and not self._isstr(key):
+            raise self.key_type_error
+        if key is None:
+            import uuid
+
+            key = uuid.uuid1().hex
+        # Schema fields are checked by the schema validator, only the other
+        # fields need the generic checks
+        extra = document
+        if self.schema is not None:
+            if self.schema.validate(document) == len(document):
+                extra = None
+            else:
+                extra = {field: value for field, value in document.items() if field not in self.schema.types}
+        if extra is not None:
+            for field in extra:
+                if not self._isstr(field):
+                    raise TypeError("document field (dict key) must be string")
+            if not self._is_serializable(extra):
+                raise TypeError("document is not json serializable")
+        if ttl is not None:
+            self._check_ttl(ttl)
+        self._put(document, key, ttl)
+        self._autosave()
+        return key
+
+    def _put(self, document, key, ttl):
+        """
+        Store a valid document.
+        """
+        if self.strings is not None:
+            document = self._intern(document)
+        if self.expiry_heap:
+            self._purge(self.purge_batch)
+        if self.indexes or self.columns or self.textindexes:
+            self._unindex(key)
+            self._index(key, document)
+        op = "update" if key in self.db else "insert"
+        stored = document if self.codec is None and self.schema is None else self._pack(document)
+        self.db[key] = stored
+        if self.cache is not None:
+            self.cache.add(key, stored)
+            self.cache.evict(self.db)
+        if ttl is not None:
+            self._set_expiry(key, ttl)
+        elif self.expires:
+            self.expires.pop(key, None)
+        self._emit(op, key, document)
+
+    def insertmany(self, documents, ttl=None):
+        """
+        Insert multiple documents on database.
+
+        The documents list will be validated before the insertion, so all the
+        documents will be inserted or none.
+
+        Args:
+            documents (list): List containing the documents to insert.
+            ttl (int or float, optional): Remove the documents after this many
+                seconds. Defaults to never.
+
+        Returns:
+            Number of inserted documents.
+
+        Raises:
+            TypeError: If keys is not a list, a document is not dict or ttl is
+                not a positive number.
+        """
+        if not isinstance(documents, list):
+            raise TypeError("documents must be a list")
+        for doc in documents:
+            if not isinstance(doc, dict):
+                raise TypeError('invalid dict: "{}"'.format(doc))
+        if ttl is not None:
+            self._check_ttl(ttl)
+        for doc in documents:
+            self.insert(doc, ttl=ttl)
+        return len(documents)
+
+    def import_jsonl(self, path, key=None, workers=None):
+        """
+        Import the documents of a json lines file, one json object per line.
+
+        The file is read in chunks parsed by worker processes and the
+        documents are validated before the insertion, so all the documents
+        are imported or none. Autosave saves once, after the import.
+
+        Args:
+            path (str): The json lines file.
+            key (str, optional): Field holding the document key, removed from
+                the documents. Defaults to uuid1 keys.
+            workers (int, optional): Parsing processes. Defaults to the cpu
+                count for files larger than import_parallel_size, else 1.
+
+        Returns:
+            Number of imported documents.
+
+        Raises:
+            TypeError: If a line is not a json object, the key field is not a
+                string or a document does not follow the schema.
+        """
+        self._check_import(key, workers)
+        with open(path, "rt", encoding="utf-8") as f:
+            spec = self._schemaspec()
+            chunks = ((start, lines, key, spec) for start, lines in self._chunks(f, 1))
+            pairs = self._parse(_parse_jsonl, chunks, self._workers(path, workers))
+        return self._import(pairs)
+
+    def import_csv(self, path, key=None, types=None, workers=None):
+        """
+        Import the rows of a csv file with a header as documents.
+
+        Values are strings unless the field has a type, empty values are
+        left out. Like import_jsonl, all the documents are imported or none.
+
+        Args:
+            path (str): The csv file.
+            key (str, optional): Column holding the document key, removed from
+                the documents. Defaults to uuid1 keys.
+            types (dict, optional): Convert the values of these fields to
+                int, float, bool ("true", "false", "1" or "0") or str.
+                Defaults to the schema types.
+            workers (int, optional): Parsing processes. Defaults to the cpu
+                count for files larger than import_parallel_size, else 1.
+
+        Returns:
+            Number of imported documents.
+
+        Raises:
+            TypeError: If types is invalid, a row has a wrong number of values
+                or value, the key column is empty or a document does not
+                follow the schema.
+        """
+        import csv
+
+        self._check_import(key, workers)
+        if types is None:
+            types = {} if self.schema is None else self.schema.types
+        if not isinstance(types, dict) or not all(map(self._isstr, types)):
+            raise TypeError("types must be a dict of field types")
+        types = {field: kind for field, kind in types.items() if kind in _CSV_TYPES and kind is not str}
+        with open(path, "rt", encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return 0
+            spec = self._schemaspec()
+            chunks = ((start, header, rows, key, types, spec) for start, rows in self._chunks(reader, 2))
+            pairs = self._parse(_parse_csv, chunks, self._workers(path, workers))
+        return self._import(pairs)
+
+    def export_jsonl(self, path, query=None, key=None):
+        """
+        Write the documents to a json lines file, one document per line.
+
+        Args:
+            path (str): The json lines file.
+            query (str, optional): Only export the documents matching the
+                query, see find. Defaults to all documents.
+            key (str, optional): Field to write the document key to, first.
+                Defaults to not writing the keys.
+
+        Returns:
+            Number of exported documents.
+
+        Raises:
+            TypeError: If query is invalid or key is not a string.
+        """
+        keys = self._export_keys(query, key)
+        with open(path, "wt", encoding="utf-8") as f:
+            for document in self._export_documents(keys, key):
+                f.write(json.dumps(document, default=_encode))
+                f.write("\n")
+        return len(keys)
+
+    def export_csv(self, path, query=None, key=None, fields=None):
+        """
+        Write the documents to a csv file with a header.
+
+        Lists and dicts are written as json, bools as true or false and
+        missing values as empty cells.
+
+        Args:
+            path (str): The csv file.
+            query (str, optional): Only export the documents matching the
+                query, see find. Defaults to all documents.
+            key (str, optional): Column to write the document key to, first.
+                Defaults to not writing the keys.
+            fields (list, optional): Columns to write, nested fields can be
+                accessed using dots. Defaults to the fields of the documents,
+                in the order they are first seen.
+
+        Returns:
+            Number of exported documents.
+
+        Raises:
+            TypeError: If query is invalid, key is not a string or fields is
+                not a list of strings.
+        """
+        import csv
+
+        keys = self._export_keys(query, key)
+        if fields is None:
+            seen = {}
+            for _, document in self._items(keys):
+                seen.update(dict.fromkeys(document))
+            fields = list(seen)
+        elif not isinstance(fields, list) or not fields or not all(map(self._isstr, fields)):
+            raise TypeError("fields must be a non empty list of strings")
+        getters = [_compile_path(field) for field in fields]
+        with open(path, "wt", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(fields if key is None else [key] + fields)
+            for name, document in self._items(keys):
+                row = [_csv_value(None if value is _MISSING else value) for value in (get(document) for get in getters)]
+                writer.writerow(row if key is None else [name] + row)
+        return len(keys)
+
+    def get(self, key, fields=None):
+        """
+        Get a document on database.
+
+        The returned document may be the stored one, treat it as read-only
+        and change it with update(), in place changes are not seen by the
+        indexes, columns and cached sorts.
+
+        Args:
+            key (str): The document key.
+            fields (list, optional): Only return these fields, nested fields
+                can be accessed using dots. Defaults to the whole document.
+
+        Returns:
+            The document or False if it does not exist.
+
+        Raises:
+            TypeError: If key is not str or fields is not a list of strings.
+        """
+        if not self._isstr(key):
+            raise self.key_type_error
+        if self.expiry_heap:
+            self._purge(self.purge_batch, key)
+        try:
+            document = self.db[key]
+        except KeyError:
+            return False
+        # Plain documents skip the slow abc instance check of Record
+        if self.cache is not None or type(document) is not dict:
+            document = self._resolve(key, document)
+            if self.cache is not None:
+                self.cache.evict(self.db)
+        if fields is not None:
+            return self._projection(fields)(document)
+        return document
+
+    def _fetch(self, key):
+        """
+        Return the document like get, False if it does not exist. A document
+        read back from the spill segment stays resident until the caller
+        evicts.
+        """
+        if self.expiry_heap:
+            self._purge(self.purge_batch, key)
+        try:
+            document = self.db[key]
+        except KeyError:
+            return False
+        return self._resolve(key, document)
+
+    def _resolve(self, key, document):
+        """
+        Return the stored document read back if spilled and decoded if
+        compressed or a record.
+        """
+        if self.cache is not None:
+            if document is _SPILLED:
+                document = self.db[key] = self._stored(self.cache.load(key))
+            else:
+                self.cache.touch(key)
+        if type(document) is dict:
+            return document
+        if isinstance(document, Compressed):
+            return document.decode()
+        if isinstance(document, Record):
+            return dict(document)
+        return document
+
+    def getmany(self, keys, fields=None):
+        """
+        Get multiple documents from database.
+
+        Args:
+            keys (list): List containing the keys of the documents to retrieve.
+            fields (list, optional): Only return these fields, nested fields
+                can be accessed using dots. Defaults to the whole documents.
+
+        Returns:
+            List of documents.
+
+        Raises:
+            TypeError: If keys is not a list or fields is not a list of
+                strings.
+        """
+        if not isinstance(keys, list):
+            raise self.keys_type_error
+        project = None if fields is None else self._projection(fields)
+        docs_list = []
+        for key in keys:
+            doc = self.get(key)
+            if not doc:
+                continue
+            if project is not None:
+                doc = project(doc)
+            docs_list.append(doc)
+        return docs_list
+
+    def getall(self, fields=None):
+        """
+        Return a list containing all documents on database.
+
+        Args:
+            fields (list, optional): Only return these fields, nested fields
+                can be accessed using dots. Defaults to the whole documents.
+        """
+        return self.getmany(self.getallkeys(), fields=fields)
+
+    def getallkeys(self):
+        """
+        Return a list containing all keys on database.
+        """
+        self._purge()
+        return list(self.db.keys())
+
+    def getrandom(self):
+        """
+        Get a random document on database.
+
+        Returns:
+            A document or False if database is empty.
+        """
+        import random
+
+        try:
+            key = random.choice(self.getallkeys())
+        except IndexError:
+            return False
+        return self.get(key)
+
+    def getfirst(self):
+        """
+        Get the first inserted document on database.
+
+        Returns:
+            The first inserted document or False if database is empty.
+        """
+        first_doc_key = self.getfirstkey()
+        if not first_doc_key:
+            return False
+        return self.get(first_doc_key)
+
+    def getlast(self):
+        """
+        Get the last inserted document on database.
+
+        Returns:
+            The last inserted document or False if database is empty.
+        """
+        last_doc_key = self.getlastkey()
+        if not last_doc_key:
+            return False
+        return self.get(last_doc_key)
+
+    def getfirstkey(self):
+        """
+        Get the first key on database.
+
+        Returns:
+            The first key or False if database is empty.
+        """
+        self._purge()
+        try:
+            key = next(iter(self.db))
+        except StopIteration:
+            return False
+        return key
+
+    def getlastkey(self):
+        """
+        Get the last key on database.
+
+        Returns:
+            The last key or False if database is empty.
+        """
+        self._purge()
+        try:
+            key = next(reversed(self.db))
+        except StopIteration:
+            return False
+        return key
+
+    def pop(self, key):
+        """
+        Get the document from database and remove it.
+
+        Args:
+            key (str): The document key.
+
+        Returns:
+            The document or False if it does not exist.
+
+        Raises:
+            TypeError: If key is not str.
+        """
+        if not self._isstr(key):
+            raise self.key_type_error
+        document = self.get(key)
+        if not document:
+            return False
+        self.delete(key)
+        return document
+
+    def popfirst(self):
+        """
+        Get the first inserted document on database and remove it.
+
+        Returns:
+            The first inserted document or False if database is empty.
+        """
+        document = self.getfirst()
+        if not document:
+            return False
+        self.delete(self.getfirstkey())
+        return document
+
+    def poplast(self):
+        """
+        Get the last inserted document on database and remove it.
+
+        Returns:
+            The last inserted document or False if database is empty.
+        """
+        document = self.getlast()
+        if not document:
+            return False
+        self.delete(self.getlastkey())
+        return document
+
+    def delete(self, key):
+        """
+        Delete a document on database.
+
+        Args:
+            key (str): The document key.
+
+        Returns:
+            True or False if it does not exist.
+
+        Raises:
+            TypeError: If key is not str.
+        """
+        if not self._isstr(key):
+            raise self.key_type_error
+        if self.expiry_heap:
+            self._purge(self.purge_batch, key)
+        try:
+            del self.db[key]
+        except KeyError:
+            return False
+        if self.indexes or self.columns or self.textindexes:
+            self._unindex(key)
+        if self.cache is not None:
+            self.cache.discard(key)
+        if self.expires:
+            self.expires.pop(key, None)
+        self._emit("delete", key)
+        self._autosave()
+        return True
+
+    def deletemany(self, keys):
+        """
+        Delete multiple documents on database.
+
+        Args:
+            keys (list): List containing the keys of the documents to delete.
+
+        Returns:
+            Number of deleted documents.
+
+        Raises:
+            TypeError: If keys is not a list.
+        """
+        if not isinstance(keys, list):
+            raise self.keys_type_error
+        deleted = 0
+        for key in keys:
+            if not self.delete(key):
+                continue
+            deleted += 1
+        return deleted
+
+    def clear(self):
+        """
+        Remove all documents from database.
+        """
+        self.db.clear()
+        self.compressed = False
+        if self.strings is not None:
+            self.strings.clear()
+        if self.cache is not None:
+            self.cache.clear()
+        self.expires.clear()
+        self.expiry_heap = []
+        for index in chain(self.indexes.values(), self.columns.values(), self.textindexes.values()):
+            index.clear()
+        self._emit("clear")
+        self._autosave()
+        return True
+
+    def size(self):
+        """
+        Return the number of documents on database.
+        """
+        self._purge()
+        return len(self.db.keys())
+
+    def exists(self, key):
+        """
+        Check if a document exists on database.
+
+        Args:
+            key (str): The document key.
+
+        Returns:
+            True or False if it does not exist.
+
+        Raises:
+            TypeError: If key is not str.
+        """
+        if not self._isstr(key):
+            raise self.key_type_error
+        if self.expiry_heap:
+            self._purge(self.purge_batch, key)
+        if key in self.db:
+            return True
+        return False
+
+    def update(self, key, values, upsert=False):
+        """
+        Add/update values on a document.
+
+        The values are the fields to set or update operators, applied in place
+        and validating only the changed fields:
+
+            {"$set": {field: value}}: Set the fields.
+            {"$unset": [field]}: Remove the fields.
+            {"$inc": {field: number}}: Add to the fields, missing fields
+                start at 0.
+            {"$push": {field: value}}: Append to the list fields, missing
+                fields start empty.
+            {"$max": {field: value}}: Set the fields if missing or lower.
+
+        Args:
+            key (str): The document key.
+            values (dict): The values to be added/updated or the operators.
+            upsert (bool, optional): Create the document if it does not
+                exist. Defaults to False.
+
+        Returns:
+            True or False if document does not exist.
+
+        Raises:
+            TypeError: If values is not dict, key is not str, a field is not
+                str or is the reserved "$compressed", a value is not json
+                serializable, an operator is invalid or does not apply to the
+                field value.
+            ValueError: If update operators are mixed with plain fields.
+        """
+        if not isinstance(values, dict):
+            raise self.document_type_error
+        if not self._isstr(key):
+            raise self.key_type_error
+        # Not evicted before the changes are stored
+        document = self._fetch(key)
+        if document is False:
+            if not upsert:
+                return False
+            document = {}
+            for field, value in self._delta(document, values).items():
+                if value is not _MISSING:
+                    document[field] = value
+            self.insert(document, key)
+            return True
+        self._unshare(key)
+        changes = self._delta(document, values)
+        for field, value in changes.items():
+            if value is _MISSING:
+                document.pop(field, None)
+            elif value is not document.get(field, _MISSING):
+                if self.strings is not None:
+                    field, value = self._share(field), self._intern_names(value)
+                document[field] = value
+        if self.intern_fields:
+            self._intern_values(document)
+        if self.indexes or self.columns or self.textindexes:
+            self._reindex(key, document, changes)
+        # Compressed documents and records are copied by get(), store the
+        # new version
+        stored = document
+        if self.compressed or self.codec is not None or self.schema is not None:
+            stored = self.db[key] = self._pack(document)
+        if self.cache is not None:
+            self.cache.add(key, stored)
+            self.cache.evict(self.db)
+        self._emit("update", key, document)
+        self._autosave()
+        return True
+
+    def updatemany(self, keys, values):
+        """
+        Add/update values on multiple documents.
+
+        Args:
+            keys (list): List containing the keys of the documents to update.
+            values (dict): The values to be added/updated.
+
+        Returns:
+            Number of updated documents.
+
+        Raises:
+            TypeError: If keys is not a list or values is not dict.
+        """
+        if not isinstance(values, dict):
+            raise self.document_type_error
+        if not isinstance(keys, list):
+            raise self.keys_type_error
+        updated = 0
+        for key in keys:
+            if not self.update(key, values):
+                continue
+            updated += 1
+        return updated
+
+    def sort(self, keys, field, reverse=False):
+        """
+        Sort the documents using the field provided.
+
+        Values of different types are ordered None, numbers, strings, lists
+        and dicts. Documents missing a sort field are left out and ties are
+        ordered by key. Repeating a sort of at least a quarter of the
+        documents on unchanged data reuses the cached sorted permutation, only
+        changes made through the database methods invalidate it.
+
+        Args:
+            keys (list): List containing the keys of the documents to sort.
+            field (str or list): Field to sort, nested fields can be accessed
+                using dots, e.g., "address.city". Or a list of fields or
+                (field, "asc" or "desc") pairs, e.g.,
+                [("city", "asc"), ("age", "desc")].
+            reverse (bool, optional): Reverse sort. Defaults to False.
+
+        Returns:
+            Sorted list with the documents keys.
+
+        Raises:
+            TypeError: If keys is not a list or field is invalid.
+        """
+        self._purge()
+        if not isinstance(keys, list):
+            raise self.keys_type_error
+        spec = self._sortspec(field, "field")
+        if len(spec) == 1:
+            field, descending = spec[0]
+            reverse = reverse is not descending
+            column = self.columns.get(field)
+            if column is not None and not column.mixed:
+                return self._sort_column(column, keys, reverse)
+            spec = ((field, False),)
+        sorted_keys = self._sort_cached(keys, spec)
+        if reverse:
+            sorted_keys.reverse()
+        return sorted_keys
+
+    def _sortspec(self, sortby, name="sortby"):
+        """
+        Return the sort fields as a tuple of (field, descending) pairs.
+        """
+        if self._isstr(sortby):
+            return ((sortby, False),)
+        error = TypeError('{} must be string or list of (field, "asc" or "desc")'.format(name))
+        if not isinstance(sortby, list) or not sortby:
+            raise error
+        spec = []
+        for item in sortby:
+            if self._isstr(item):
+                spec.append((item, False))
+                continue
+            if not isinstance(item, (list, tuple)) or len(item) != 2:
+                raise error
+            field, direction = item
+            if not self._isstr(field) or direction not in ("asc", "desc"):
+                raise error
+            spec.append((field, direction == "desc"))
+        return tuple(spec)
+
+    def _sort_cached(self, keys, spec):
+        """
+        Sort the keys. Sorts of a large share of the documents build the
+        sorted permutation of all documents when repeated on the same data,
+        then only filter it, smaller sorts sort the keys directly.
+        """
+        total = len(self.db)
+        if len(keys) * 4 < total or total > self.sort_cache_keys:
+            return self._sort_fields(keys, spec)
+        sorts = self.sorts
+        if self.sorts_seq != self.seq:
+            sorts.clear()
+            self.sorts_seq = self.seq
+        if spec not in sorts:
+            if len(sorts) >= self.sort_cache_size:
+                del sorts[next(iter(sorts))]
+            sorts[spec] = None
+            return self._sort_fields(keys, spec)
+        wanted = set(keys)
+        if len(wanted) != len(keys):
+            return self._sort_fields(keys, spec)
+        order = sorts[spec]
+        if order is None:
+            order = sorts[spec] = self._sort_fields(list(self.db), spec)
+            # Drop the oldest permutations over the cached keys limit
+            cached = sum(len(other) for other in sorts.values() if other is not None)
+            for other_spec in list(sorts):
+                if cached <= self.sort_cache_keys:
+                    break
+                if other_spec != spec and sorts[other_spec] is not None:
+                    cached -= len(sorts.pop(other_spec))
+        return [key for key in order if key in wanted]
+
+    def _sort_fields(self, keys, spec):
+        """
+        Sort the keys by each field from the last to the first, relying on
+        the sort stability.
+        """
+        db = self.db
+        plain = not self.compressed and (self.cache is None or not self.cache.spilled)
+        if len(spec) == 1:
+            # Single field, sort the (value, key) pairs at once
+            getter = _compile_path(spec[0][0])
+            pairs = []
+            for key in keys:
+                document = db.get(key)
+                if document is None:
+                    continue
+                value = getter(document if plain else self._document(key))
+                if value is not _MISSING:
+                    pairs.append((value, key))
+            try:
+                pairs.sort()
+            except TypeError:
+                pairs = sorted((_orderkey(value), key) for value, key in pairs)
+            return [pair[1] for pair in pairs]
+        getters = [_compile_path(field) for field, _ in spec]
+        rows = []
+        for key in keys:
+            document = db.get(key)
+            if document is None:
+                continue
+            if not plain:
+                document = self._document(key)
+            values = [getter(document) for getter in getters]
+            if _MISSING not in values:
+                rows.append((values, key))
+        rows.sort(key=itemgetter(1))
+        for position in range(len(spec) - 1, -1, -1):
+            orderkey = _sortkey([row[0][position] for row in rows])
+            if orderkey is None:
+                rows.sort(key=lambda row: row[0][position], reverse=spec[position][1])
+            else:
+                rows.sort(key=lambda row: orderkey(row[0][position]), reverse=spec[position][1])
+        return [row[1] for row in rows]
+
+    def _sort_column(self, column, keys, reverse):
+        """
+        Sort the keys using the numeric column, the cached sorted permutation
+        is used when sorting a large part of the column.
+        """
+        slots = column.slots
+        wanted = set(keys)
+        if len(wanted) == len(keys) and len(keys) * 4 >= len(slots):
+            sorted_keys = [key for key in column.sorted_keys() if key in wanted]
+        else:
+            numbers = column.numbers
+            pairs = sorted((numbers[slots[key]], key) for key in keys if key in slots)
+            sorted_keys = [pair[1] for pair in pairs]
+        if reverse:
+            sorted_keys.reverse()
+        return sorted_keys
+
+    def findtext(self, field, text, exact=False, sens=False, inverse=False, asc=True, rank=False):
+        """
+        Simple text search on the provided field.
+
+        Args:
+            field (str): The field to search, nested fields can be accessed
+                using dots, e.g., "address.city".
+            text (str): The value to be searched.
+            exact (bool, optional): Exact text match. Defaults to False.
+            sens (bool, optional): Case sensitive. Defaults to False.
+            inverse (bool, optional): Inverse search, return the documents that
+                do not match the search. Defaults to False.
+            asc (bool, optional): Ascii conversion before matching, this
+                matches text like 'cafe' and 'café'. Defaults to True.
+            rank (bool, optional): Sort the result by relevance, the documents
+                where the searched words are frequent and rare on the database
+                come first. Defaults to False.
+
+        Returns:
+            List with the keys of the documents that matched the search.
+
+        Raises:
+            TypeError: If field is not str, text is not str, exact is not
+                bool, sens is not bool, inverse is not bool, asc is not bool
+                or rank is not bool.
+        """
+        self._purge()
+        if not self._isstr(field) or not self._isstr(text):
+            raise TypeError("field and text must be string")
+        if (
+            not isinstance(exact, bool)
+            or not isinstance(sens, bool)
+            or not isinstance(inverse, bool)
+            or not isinstance(asc, bool)
+        ):
+            raise TypeError("exact, sens, inverse and asc must be boolean")
+        if not isinstance(rank, bool):
+            raise TypeError("rank must be boolean")
+        if not inverse:
+            clause = _Clause(field, "==" if exact else "?=", text, sens=sens, asc=asc)
+            match_list = self._execute(clause)
+            if rank:
+                match_list = self._rank(field, match_list, text)
+            return match_list
+        fold = _folder(sens, asc)
+        text = fold(text)
+        if exact:
+            return self._match(field, lambda value: isinstance(value, str) and fold(value) != text)
+        return self._match(field, lambda value: isinstance(value, str) and text not in fold(value))
+
+    def findnum(self, expression):
+        """
+        Simple number comparison search on provided field.
+
+        Args:
+            expression (str): The comparison expression to use, e.g.,
+                "age >= 18" or "stats.score < 10". The pattern is
+                'field operator number'.
+
+        Returns:
+            List with the keys of the documents that matched the search.
+
+        Raises:
+            TypeError: If expression is invalid.
+        """
+        self._purge()
+        if not self._isstr(expression):
+            raise TypeError("expression must be string")
+        tokens = expression.split(" ")
+        if len(tokens) != 3:
+            raise TypeError('invalid expression: "{}"'.format(expression))
+        field = tokens[0]
+        operator = tokens[1]
+        if operator not in _NUMBER_OPERATORS:
+            raise TypeError('invalid number operator: "{}"'.format(operator))
+        try:
+            number = float(tokens[2])
+        except ValueError:
+            raise TypeError('invalid number: "{}"'.format(tokens[2]))
+        return self._execute(_Clause(field, operator, number))
+
+    def find(self, query, sens=False, asc=True, sortby=None, reverse=False):
+        """
+        Simple query like search.
+
+        Args:
+            query (str): The query to use, examples:
+                1. age >= 18
+                2. description ?= "dbj is a"
+                3. name != "John" and age < 18
+                4. name == "Ana" or name == ""Bob "B" Lee"" and age >= 30
+                5. address.city == "Porto"
+                The pattern is:
+                    'field operator value and/or field operator value...'
+            sens (bool, optional): Case sensitive. Defaults to False.
+            asc (bool, optional): Ascii conversion before matching, this
+                matches text like 'cafe' and 'café'. Defaults to True.
+            sortby (str or list, optional): Sort using the provided field,
+                nested fields can be accessed using dots, e.g.,
+                "stats.score". Or a list of (field, "asc" or "desc") pairs,
+                see sort.
+            reverse (bool, optional): Reverse sort. Defaults to False.
+
+        Returns:
+            List with the keys of the documents that matched the search.
+
+        Raises:
+            TypeError: If query or sortby is invalid.
+        """
+        self._purge()
+        if not self._isstr(query):
+            raise TypeError("query must be string")
+        if sortby is not None:
+            self._sortspec(sortby)
+        node = self._compile_query(query, sens, asc)
+        result = self._execute(node)
+        if sortby is not None:
+            result = self.sort(result, sortby, reverse=reverse)
+        return result
+
+    def findall(self, query, fields=None, sens=False, asc=True, sortby=None, reverse=False):
+        """
+        Simple query like search returning the documents instead of the keys.
+
+        Args:
+            query (str): The query to use, see find.
+            fields (list, optional): Only return these fields, nested fields
+                can be accessed using dots. Defaults to the whole documents.
+            sens (bool, optional): Case sensitive. Defaults to False.
+            asc (bool, optional): Ascii conversion before matching, this
+                matches text like 'cafe' and 'café'. Defaults to True.
+            sortby (str or list, optional): Sort using the provided fields.
+            reverse (bool, optional): Reverse sort. Defaults to False.
+
+        Returns:
+            List with the documents that matched the search.
+
+        Raises:
+            TypeError: If query is invalid, fields is not a list of strings
+                or sortby is invalid.
+        """
+        self._purge()
+        if sortby is not None:
+            return self.getmany(self.find(query, sens, asc, sortby, reverse), fields=fields)
+        project = None if fields is None else self._projection(fields)
+        docs_list = []
+        for _, document in self._iterquery(query, sens, asc):
+            if project is not None:
+                document = project(document)
+            elif type(document) is not dict and isinstance(document, Record):
+                document = dict(document)
+            docs_list.append(document)
+        return docs_list
+
+    def count(self, query=None):
+        """
+        Count the documents matching the query.
+
+        Args:
+            query (str, optional): The query to use, see find. Defaults to
+                all documents.
+
+        Returns:
+            Number of matching documents.
+
+        Raises:
+            TypeError: If query is invalid.
+        """
+        self._purge()
+        if query is None:
+            return len(self.db)
+        node = self._compile_query(query)
+        keys, exact = self._lookup(node)
+        if exact:
+            return len(keys)
+        count = 0
+        for _ in self._select(node, keys):
+            count += 1
+        return count
+
+    def distinct(self, field, query=None):
+        """
+        Return the distinct values of a field.
+
+        Args:
+            field (str): The field, nested fields can be accessed using dots.
+            query (str, optional): Only consider the documents matching the
+                query, see find. Defaults to all documents.
+
+        Returns:
+            List with the distinct values.
+
+        Raises:
+            TypeError: If field is not str or query is invalid.
+        """
+        self._purge()
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        index = self.indexes.get(field)
+        if query is None and index is not None:
+            values = list(index.postings)
+            for key in index.other:
+                if index.values[key] not in values:
+                    values.append(index.values[key])
+            return values
+        getter = _compile_path(field)
+        values = {}
+        unhashable = []
+        for _, document in self._iterquery(query):
+            value = getter(document)
+            if value is _MISSING:
+                continue
+            try:
+                values[value] = None
+            except TypeError:
+                if value not in unhashable:
+                    unhashable.append(value)
+        return list(values) + unhashable
+
+    def groupby(self, field, agg=None, query=None):
+        """
+        Group the documents by a field and aggregate each group.
+
+        Args:
+            field (str): The field to group by, nested fields can be accessed
+                using dots. Documents without the field are ignored.
+            agg (dict, optional): The aggregates to compute, mapping the
+                result name to "count" or a tuple (function, field), function
+                is one of count, sum, min, max or avg, e.g.,
+                {"n": "count", "oldest": ("max", "age")}. Defaults to
+                {"count": "count"}.
+            query (str, optional): Only consider the documents matching the
+                query, see find. Defaults to all documents.
+
+        Returns:
+            Dict mapping each field value to a dict with the aggregates.
+
+        Raises:
+            TypeError: If field is not str, agg is invalid or query is
+                invalid.
+        """
+        self._purge()
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        if agg is None:
+            agg = {"count": "count"}
+        if not isinstance(agg, dict):
+            raise TypeError("agg must be dict")
+        specs = {}
+        for name, spec in agg.items():
+            if spec == "count":
+                spec = ("count", None)
+            if not isinstance(spec, tuple) or len(spec) != 2 or not self._isstr(spec[0]):
+                raise TypeError('invalid aggregate: "{}"'.format(name))
+            if spec[1] is not None and not self._isstr(spec[1]):
+                raise TypeError('invalid aggregate: "{}"'.format(name))
+            if spec[0] not in _AGGREGATES:
+                raise TypeError('invalid aggregate function: "{}"'.format(spec[0]))
+            specs[name] = spec
+        index = self.indexes.get(field)
+        if query is None and index is not None and all(spec == ("count", None) for spec in specs.values()):
+            return {value: {name: len(keys) for name in specs} for value, keys in index.postings.items()}
+        getter = _compile_path(field)
+        groups = {}
+        for _, document in self._iterquery(query):
+            value = getter(document)
+            if value is _MISSING:
+                continue
+            try:
+                aggregates = groups.get(value)
+            except TypeError:
+                continue
+            if aggregates is None:
+                aggregates = groups[value] = [(name, _Aggregate(*spec)) for name, spec in specs.items()]
+            for _, aggregate in aggregates:
+                aggregate.add(document)
+        return {
+            value: {name: aggregate.result() for name, aggregate in aggregates} for value, aggregates in groups.items()
+        }
+
+    def min(self, field, query=None):
+        """
+        Return the minimum number of a field.
+
+        Values are converted to float like findnum, values that are not
+        numbers are ignored.
+
+        Args:
+            field (str): The field, nested fields can be accessed using dots.
+            query (str, optional): Only consider the documents matching the
+                query, see find. Defaults to all documents.
+
+        Returns:
+            The minimum number or False if there are no numbers.
+
+        Raises:
+            TypeError: If field is not str or query is invalid.
+        """
+        return self._aggregate("min", field, query)
+
+    def max(self, field, query=None):
+        """
+        Return the maximum number of a field.
+
+        Values are converted to float like findnum, values that are not
+        numbers are ignored.
+
+        Args:
+            field (str): The field, nested fields can be accessed using dots.
+            query (str, optional): Only consider the documents matching the
+                query, see find. Defaults to all documents.
+
+        Returns:
+            The maximum number or False if there are no numbers.
+
+        Raises:
+            TypeError: If field is not str or query is invalid.
+        """
+        return self._aggregate("max", field, query)
+
+    def sum(self, field, query=None):
+        """
+        Return the sum of the numbers of a field.
+
+        Values are converted to float like findnum, values that are not
+        numbers are ignored.
+
+        Args:
+            field (str): The field, nested fields can be accessed using dots.
+            query (str, optional): Only consider the documents matching the
+                query, see find. Defaults to all documents.
+
+        Returns:
+            The sum, 0 if there are no numbers.
+
+        Raises:
+            TypeError: If field is not str or query is invalid.
+        """
+        return self._aggregate("sum", field, query)
+
+    def avg(self, field, query=None):
+        """
+        Return the average of the numbers of a field.
+
+        Values are converted to float like findnum, values that are not
+        numbers are ignored.
+
+        Args:
+            field (str): The field, nested fields can be accessed using dots.
+            query (str, optional): Only consider the documents matching the
+                query, see find. Defaults to all documents.
+
+        Returns:
+            The average or False if there are no numbers.
+
+        Raises:
+            TypeError: If field is not str or query is invalid.
+        """
+        return self._aggregate("avg", field, query)
+
+    def _aggregate(self, function, field, query):
+        """
+        Compute a single aggregate over the documents matching the query,
+        reading the field index when there is no query.
+        """
+        self._purge()
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        aggregate = _Aggregate(function, field)
+        column = self.columns.get(field)
+        index = self.indexes.get(field)
+        if query is None and column is not None:
+            numbers = column.present()
+            if function in ("min", "max"):
+                if not numbers:
+                    return False
+                return min(numbers) if function == "min" else max(numbers)
+            for number in numbers:
+                aggregate.add_number(number)
+            return aggregate.result()
+        if query is None and index is not None:
+            if function in ("min", "max"):
+                _, values = index.number_values_view()
+                if not values:
+                    return False
+                return _to_number(values[0] if function == "min" else values[-1])
+            for value, keys in index.postings.items():
+                aggregate.add_number(_to_number(value), len(keys))
+            return aggregate.result()
+        for _, document in self._iterquery(query):
+            aggregate.add(document)
+        return aggregate.result()
+
+    def _projection(self, fields):
+        """
+        Validate the fields list and return the projection function.
+        """
+        if not isinstance(fields, list) or not all(self._isstr(field) for field in fields):
+            raise TypeError("fields must be a list of strings")
+        return _compile_projection(fields)
+
+    def _compile_query(self, query, sens=False, asc=True):
+        """
+        Parse the query string and return the query tree.
+        """
+        if not self._isstr(query):
+            raise TypeError("query must be string")
+        tokens = self._parse_query(query)
+        if len(tokens) < 2:
+            raise TypeError('invalid query: "{}"'.format(query))
+        return _QueryParser(query, tokens, sens, asc).parse()
+
+    def _iterquery(self, query, sens=False, asc=True):
+        """
+        Iterate over (key, document) of the documents matching the query
+        string, all documents if query is None.
+        """
+        if query is None:
+            return iter(self._items())
+        node = self._compile_query(query, sens, asc)
+        keys, exact = self._lookup(node)
+        if exact:
+            return self._items(keys)
+        return self._select(node, keys)
+
+    def _parse_query(self, query):
+        """
+        Parse the query string and return a tokens list.
+
+        Tokens are separated by spaces, parentheses and commas are tokens by
+        themselves. Strings are enclosed by quotes and may contain spaces,
+        using double quotes as delimiter allows quotes inside the string.
+        """
+        tokens = []
+        separators = "(),"
+        length = len(query)
+        i = 0
+        while i < length:
+            char = query[i]
+            if char.isspace():
+                i += 1
+            elif char in separators:
+                tokens.append(char)
+                i += 1
+            elif char == '"':
+                delimiter = '""' if query[i : i + 2] == '""' else '"'
+                end = i + 2 if delimiter == '""' and self._token_end(query, i + 2) else None
+                search = i + len(delimiter)
+                while end is None:
+                    found = query.find(delimiter, search)
+                    if found == -1:
+                        raise TypeError('unterminated string: "{}"'.format(query))
+                    if self._token_end(query, found + len(delimiter)):
+                        end = found + len(delimiter)
+                    search = found + 1
+                tokens.append(query[i:end])
+                i = end
+            else:
+                start = i
+                while i < length and not query[i].isspace() and query[i] not in separators:
+                    i += 1
+                tokens.append(query[start:i])
+        return tokens
+
+    def _token_end(self, query, i):
+        """
+        Check if a token can end at the provided query position.
+        """
+        return i == len(query) or query[i].isspace() or query[i] in "),"
+
+    def _execute(self, node):
+        """
+        Return the keys of the documents matching the query tree.
+
+        Conditions on indexed fields are answered by the indexes, the
+        remaining ones are evaluated for every candidate document in a
+        single pass.
+        """
+        keys, exact = self._lookup(node)
+        if exact:
+            match_list = keys
+        else:
+            match_list = [key for key, _ in self._select(node, keys)]
+        if self.metrics is not None:
+            if exact:
+                scanned = 0
+            else:
+                scanned = len(self.db) if keys is None else len(keys)
+            self.metrics.record_query(scanned, len(match_list))
+        return match_list
+
+    def _select(self, node, keys=None):
+        """
+        Iterate over (key, document) of the documents matching the query
+        tree, checking only the candidate keys if provided.
+        """
+        for key, document in self._items(keys):
+            if node.match(document):
+                yield key, document
+
+    def _lookup(self, node, plan=None):
+        """
+        Use the indexes to resolve the query tree.
+
+        Args:
+            node: The query tree.
+            plan (dict, optional): Filled with the access path, number of keys
+                and timing of each node, used by explain.
+
+        Returns:
+            A tuple (keys, exact), keys is None if the indexes can not narrow
+            the search and exact is False if the keys are only candidates
+            that must still be checked against the query.
+        """
+        start = time.perf_counter() if plan is not None else 0
+        if isinstance(node, _Clause):
+            access, keys, exact = self._lookup_clause(node)
+            if plan is not None:
+                plan.update(node.describe())
+                plan.update(access=access, keys=None if keys is None else len(keys))
+                plan["time"] = time.perf_counter() - start
+            return keys, exact
+        children = []
+        results = []
+        exact = True
+        resolved = True
+        for child in node.children:
+            child_plan = None if plan is None else {}
+            keys, child_exact = self._lookup(child, child_plan)
+            children.append(child_plan)
+            if node.operator == "or" and not child_exact:
+                resolved = False
+                if plan is None:
+                    break
+                continue
+            if keys is None:
+                exact = False
+                continue
+            exact = exact and child_exact
+            results.append(keys)
+        if plan is not None:
+            plan.update(operator=node.operator, access="full scan", keys=None, children=children)
+        if not resolved or not results:
+            return None, False
+        start = time.perf_counter() if plan is not None else 0
+        if node.operator == "or":
+            keys = list(dict.fromkeys(chain.from_iterable(results)))
+        else:
+            results.sort(key=len)
+            others = [set(keys) for keys in results[1:]]
+            keys = [key for key in results[0] if all(key in other for other in others)]
+        if plan is not None:
+            plan.update(access="index" if exact else "index candidates", keys=len(keys))
+            plan.update(inputs=[len(result) for result in results], time=time.perf_counter() - start)
+        return keys, exact
+
+    def _lookup_clause(self, node):
+        """
+        Choose the access path of a single condition.
+
+        Returns:
+            A tuple (access, keys, exact), see _lookup.
+        """
+        column = self.columns.get(node.field)
+        if column is not None and node.numeric():
+            return "column", node.lookup_column(column), True
+        index = self.indexes.get(node.field)
+        textindex = self.textindexes.get(node.field)
+        if textindex is not None and node.substring() and (index is None or node.operator == "?="):
+            return "text index", textindex.candidates(node.value), False
+        if index is None:
+            return "full scan", None, False
+        return "index", node.lookup(index), True
+
+    def explain(self, query, sens=False, asc=True, sortby=None, reverse=False):
+        """
+        Run a query like find and describe how it was executed.
+
+        Args:
+            query (str): The query to use, see find.
+            sens (bool, optional): Case sensitive. Defaults to False.
+            asc (bool, optional): Ascii conversion before matching. Defaults
+                to True.
+            sortby (str or list, optional): Sort using the provided fields.
+            reverse (bool, optional): Reverse sort. Defaults to False.
+
+        Returns:
+            Dict with the query plan tree, where each condition has its
+            access path (column, index, text index or full scan), keys
+            returned by the index, lookup time, documents evaluated and
+            matched during the scan and evaluation time, plus the overall
+            access path, estimated and actual documents examined, matched
+            documents and the time spent planning, scanning and sorting.
+
+        Raises:
+            TypeError: If query or sortby is invalid.
+        """
+        self._purge()
+        if sortby is not None:
+            self._sortspec(sortby)
+        node = self._compile_query(query, sens, asc)
+        plan = {}
+        start = time.perf_counter()
+        keys, exact = self._lookup(node, plan)
+        planning = time.perf_counter() - start
+        estimated = self._explain_estimate(plan, len(self.db))
+        if exact:
+            access = "index"
+            source = []
+        elif keys is None:
+            access = "full scan"
+            source = list(self.db)
+        else:
+            access = "index candidates"
+            source = keys
+        stats = {}
+        start = time.perf_counter()
+        if exact:
+            result = keys
+        else:
+            result = [key for key in source if self._explain_match(node, self._document(key), stats)]
+        scanning = time.perf_counter() - start
+        self._explain_annotate(node, plan, stats)
+        sorting = 0.0
+        if sortby is not None:
+            start = time.perf_counter()
+            result = self.sort(result, sortby, reverse=reverse)
+            sorting = time.perf_counter() - start
+        return {
+            "query": query,
+            "plan": plan,
+            "access": access,
+            "estimated": estimated,
+            "examined": len(source),
+            "matched": len(result),
+            "time": {"plan": planning, "scan": scanning, "sort": sorting, "total": planning + scanning + sorting},
+        }
+
+    def _explain_estimate(self, plan, total):
+        """
+        Estimate the documents yielded by the access path of the plan tree
+        from the index, column and text index key counts, before scanning.
+        """
+        if "children" not in plan:
+            return total if plan["keys"] is None else plan["keys"]
+        estimates = [self._explain_estimate(child, total) for child in plan["children"]]
+        if plan["operator"] == "and":
+            return min(estimates)
+        if any(child["access"] not in ("index", "column") for child in plan["children"]):
+            return total
+        return min(total, sum(estimates))
+
+    def _explain_match(self, node, document, stats):
+        """
+        Match the document like node.match, counting and timing the
+        evaluations of each node.
+        """
+        start = time.perf_counter()
+        if isinstance(node, _Clause):
+            matched = node.match(document)
+        elif node.operator == "and":
+            matched = True
+            for child in node.children:
+                if not self._explain_match(child, document, stats):
+                    matched = False
+                    break
+        else:
+            matched = False
+            for child in node.children:
+                if self._explain_match(child, document, stats):
+                    matched = True
+                    break
+        node_stats = stats.setdefault(id(node), [0, 0, 0.0])
+        node_stats[0] += 1
+        node_stats[1] += matched
+        node_stats[2] += time.perf_counter() - start
+        return matched
+
+    def _explain_annotate(self, node, plan, stats):
+        """
+        Add the scan statistics of each node to the plan tree.
+        """
+        evaluated, matched, elapsed = stats.get(id(node), (0, 0, 0.0))
+        plan.update(evaluated=evaluated, matched=matched, eval_time=elapsed)
+        if isinstance(node, _Logic):
+            for child, child_plan in zip(node.children, plan["children"]):
+                self._explain_annotate(child, child_plan, stats)
+
+    def createindex(self, field):
+        """
+        Create a hash index on the provided field.
+
+        Searches on an indexed field test each distinct value once instead of
+        every document.
+
+        Args:
+            field (str): Field to index, nested fields can be accessed using
+                dots, e.g., "address.city".
+
+        Returns:
+            True or False if the index already exists.
+
+        Raises:
+            TypeError: If field is not str.
+        """
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        if field in self.indexes:
+            return False
+        index = FieldIndex(field)
+        self._build_index(index)
+        self.indexes[field] = index
+        return True
+
+    def dropindex(self, field):
+        """
+        Remove the index of the provided field.
+
+        Args:
+            field (str): The indexed field.
+
+        Returns:
+            True or False if the index does not exist.
+
+        Raises:
+            TypeError: If field is not str.
+        """
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        try:
+            del self.indexes[field]
+        except KeyError:
+            return False
+        return True
+
+    def getindexes(self):
+        """
+        Return a list containing all indexed fields.
+        """
+        return list(self.indexes.keys())
+
+    def createcolumn(self, field):
+        """
+        Create a numeric column on the provided field.
+
+        The field numbers are cached in a compact array, number comparisons,
+        sort and aggregates on the field do not need to read the documents.
+
+        Args:
+            field (str): Field to cache, nested fields can be accessed using
+                dots, e.g., "stats.score".
+
+        Returns:
+            True or False if the column already exists.
+
+        Raises:
+            TypeError: If field is not str.
+        """
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        if field in self.columns:
+            return False
+        column = NumericColumn(field)
+        self._build_index(column)
+        self.columns[field] = column
+        return True
+
+    def dropcolumn(self, field):
+        """
+        Remove the numeric column of the provided field.
+
+        Args:
+            field (str): The cached field.
+
+        Returns:
+            True or False if the column does not exist.
+
+        Raises:
+            TypeError: If field is not str.
+        """
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        try:
+            del self.columns[field]
+        except KeyError:
+            return False
+        return True
+
+    def getcolumns(self):
+        """
+        Return a list containing all fields with a numeric column.
+        """
+        return list(self.columns.keys())
+
+    def createtextindex(self, field):
+        """
+        Create a full text index on the provided field.
+
+        Substring searches (findtext and the "?=", "==" and "startswith"
+        query operators) only check the documents containing all the
+        trigrams of the searched text. The index is saved next to the
+        database file and reused on load if the database did not change.
+
+        Args:
+            field (str): Field to index, nested fields can be accessed using
+                dots, e.g., "product.description".
+
+        Returns:
+            True or False if the text index already exists.
+
+        Raises:
+            TypeError: If field is not str.
+        """
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        if field in self.textindexes:
+            return False
+        index = TextIndex(field)
+        self._build_index(index)
+        self.textindexes[field] = index
+        return True
+
+    def droptextindex(self, field):
+        """
+        Remove the full text index of the provided field.
+
+        Args:
+            field (str): The indexed field.
+
+        Returns:
+            True or False if the text index does not exist.
+
+        Raises:
+            TypeError: If field is not str.
+        """
+        if not self._isstr(field):
+            raise TypeError("field must be string")
+        try:
+            del self.textindexes[field]
+        except KeyError:
+            return False
+        return True
+
+    def gettextindexes(self):
+        """
+        Return a list containing all fields with a full text index.
+        """
+        return list(self.textindexes.keys())
+
+    def _textindexes_path(self):
+        return self.path + ".text"
+
+    def _signature(self):
+        """
+        Identify the current database file content by its size and
+        modification time.
+        """
+        stat = os.stat(self.path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _save_textindexes(self):
+        """
+        Save the text indexes next to the database file.
+        """
+        data = {
+            "signature": self._signature(),
+            "fields": {field: index.dump() for field, index in self.textindexes.items()},
+        }
+        with open(self._textindexes_path(), "wt") as f:
+            with KillProtected():
+                json.dump(data, f)
+
+    def _load_textindexes(self, expired=()):
+        """
+        Load the saved text indexes if they match the database file, without
+        the expired keys dropped while loading, build them otherwise.
+        """
+        if not self.textindexes:
+            return
+        saved = {}
+        try:
+            with open(self._textindexes_path(), "rt") as f:
+                data = json.load(f)
+            if data["signature"] == self._signature():
+                saved = data["fields"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        for field, index in self.textindexes.items():
+            if field in saved:
+                index.restore(saved[field])
+                for key in expired:
+                    index.remove(key)
+            else:
+                self._build_index(index)
 
-    def __exit__(self, type, value, traceback):
-        if self.killed:
-            sys.exit(0)
-        signal.signal(signal.SIGINT, self.prev_sigint)
-        signal.signal(signal.SIGTERM, self.prev_sigterm)
+    def _share(self, text):
+        """
+        Return the shared string equal to text.
+        """
+        shared = self.strings.setdefault(text, text)
+        if shared is not text:
+            self.interned["replaced"] += 1
+            self.interned["bytes_saved"] += sys.getsizeof(text)
+        return shared
 
+    def _intern(self, document):
+        """
+        Return a copy of the document using shared strings for the field
+        names and the values of the interned fields.
+        """
+        document = self._intern_names(document)
+        if self.intern_fields:
+            self._intern_values(document)
+        return document
 
-class dbj:
-    """
-    Documentation on: https://github.com/pdrb/dbj
-    """
+    def _intern_names(self, value):
+        """
+        Return a copy of the value using shared strings for the field names.
+        """
+        if isinstance(value, dict):
+            share = self._share
+            intern = self._intern_names
+            return {share(name): intern(item) for name, item in value.items()}
+        if isinstance(value, list):
+            return [self._intern_names(item) for item in value]
+        return value
 
-    document_type_error = TypeError("document must be dict")
-    key_type_error = TypeError("document key must be string")
-    keys_type_error = TypeError("keys must be a list")
+    def _intern_values(self, document):
+        """
+        Replace the string values, or strings on list values, of the interned
+        fields by shared strings. Field names are not changed, json.load
+        already shares the equal names of a file.
+        """
+        share = self._share
+        strings = self.strings
+        interned = self.interned
+        for field in self.intern_fields:
+            parent, name = document, field
+            if field not in document and "." in field:
+                *steps, name = field.split(".")
+                for step in steps:
+                    parent = parent.get(step) if isinstance(parent, dict) else None
+                if not isinstance(parent, dict):
+                    continue
+            value = parent.get(name)
+            if value.__class__ is str:
+                shared = strings.setdefault(value, value)
+                if shared is not value:
+                    parent[name] = shared
+                    interned["replaced"] += 1
+                    interned["bytes_saved"] += sys.getsizeof(value)
+            elif isinstance(value, list):
+                parent[name] = [share(item) if isinstance(item, str) else item for item in value]
 
-    def __init__(self, path, autosave=False):
-        self.path = path
-        self.autosave = autosave
-        self.load()
+    def _delta(self, document, values):
+        """
+        Validate the update values against the document and return the new
+        value of each changed field, _MISSING for removed fields. Pushed
+        values are appended to the document lists.
+        """
+        operators = sum(1 for field in values if self._isstr(field) and field.startswith("$"))
+        if not operators:
+            values = {"$set": values}
+        elif operators != len(values):
+            raise ValueError("update operators can not be mixed with plain fields")
+        changes = {}
+        pushes = []
+        for operator, fields in values.items():
+            if operator not in _UPDATE_OPERATORS:
+                raise TypeError('invalid update operator: "{}"'.format(operator))
+            if operator == "$unset":
+                if not isinstance(fields, (list, dict)):
+                    raise TypeError("$unset fields must be a list")
+                fields = dict.fromkeys(fields, _MISSING)
+            elif not isinstance(fields, dict):
+                raise TypeError("{} fields must be dict".format(operator))
+            for field, value in fields.items():
+                if not self._isstr(field):
+                    raise TypeError("document field (dict key) must be string")
+                if field == _COMPRESSED:
+                    raise self.reserved_field_error
+                if operator in ("$set", "$push", "$max") and not self._is_serializable(value):
+                    raise TypeError("document is not json serializable")
+                current = changes[field] if field in changes else document.get(field, _MISSING)
+                if operator in ("$set", "$unset"):
+                    changes[field] = value
+                elif operator == "$inc":
+                    if type(value) not in (int, float):
+                        raise TypeError('$inc value must be a number: "{}"'.format(field))
+                    if current is _MISSING:
+                        changes[field] = value
+                    elif type(current) not in (int, float):
+                        raise TypeError('$inc field is not a number: "{}"'.format(field))
+                    else:
+                        changes[field] = current + value
+                elif operator == "$push":
+                    if current is _MISSING:
+                        changes[field] = [value]
+                    elif not isinstance(current, list):
+                        raise TypeError('$push field is not a list: "{}"'.format(field))
+                    else:
+                        changes[field] = current
+                        pushes.append((current, value))
+                else:
+                    try:
+                        if current is _MISSING or value > current:
+                            changes[field] = value
+                    except TypeError:
+                        raise TypeError('$max value is not comparable: "{}"'.format(field)) from None
+        if "$unset" in values:
+            removed = sum(value is _MISSING and field in document for field, value in changes.items())
+            added = sum(value is not _MISSING and field not in document for field, value in changes.items())
+            if len(document) - removed + added == 0:
+                raise TypeError("document must not be empty")
+        # Every change is valid, only now the lists are changed in place
+        if self.schema is not None:
+            for field, value in changes.items():
+                self.schema.check(field, value)
+        for items, value in pushes:
+            items.append(value)
+        return changes
 
-    def load(self):
+    def _reindex(self, key, document, fields):
         """
-        Load the database or create a new one if the file does not exists.
+        Update the document on the indexes and columns of the changed fields.
         """
-        if os.path.exists(self.path):
-            with open(self.path, "rt") as f:
-                db_data = json.load(f)
-        else:
-            db_data = dict()
-        self.db = db_data
+        for index in chain(self.indexes.values(), self.columns.values(), self.textindexes.values()):
+            if any(index.field == field or index.field.startswith(field + ".") for field in fields):
+                index.remove(key)
+                index.add(key, document)
 
-    def save(self, indent=None):
+    def _index(self, key, document):
         """
-        Save database to disk protecting from kill signals.
+        Add the document to the indexes and columns.
+        """
+        for index in self.indexes.values():
+            index.add(key, document)
+        for column in self.columns.values():
+            column.add(key, document)
+        for index in self.textindexes.values():
+            index.add(key, document)
 
-        Args:
-            indent (int or str, optional): If provided, save a prettified json
-                with that indent level. 0, negative or "" will only insert
-                newlines.
+    def _unindex(self, key):
+        """
+        Remove the document from the indexes and columns.
+        """
+        for index in self.indexes.values():
+            index.remove(key)
+        for column in self.columns.values():
+            column.remove(key)
+        for index in self.textindexes.values():
+            index.remove(key)
 
-        Returns:
-            True if saved successful.
+    def _build_index(self, index):
         """
-        with open(self.path, "wt") as f:
-            with KillProtected():
-                json.dump(self.db, f, indent=indent)
-        return True
+        Index all documents on database.
+        """
+        index.clear()
+        for key, document in self._items():
+            index.add(key, document)
 
-    def insert(self, document, key=None):
+    def _rank(self, field, keys, text):
         """
-        Create a new document on database.
+        Sort the keys by relevance for the searched text, using the text
+        index if available or the frequency of the searched words otherwise.
+        """
+        index = self.textindexes.get(field)
+        if index is not None:
+            return index.rank(keys, text)
+        getter = _compile_path(field)
+        words = set(_WORD.findall(_ascii_lower(text)))
 
-        Args:
-            document (dict): The document to be created.
-            key (str, optional): The document unique key. Defaults to uuid1.
+        def score(key):
+            counts = Counter(_WORD.findall(_ascii_lower(getter(self._document(key)))))
+            return sum(counts[word] for word in words)
 
-        Returns:
-            The document key.
+        return sorted(keys, key=score, reverse=True)
 
-        Raises:
-            TypeError: If document is not dict, document is empty, the optional
-                key is not str, document field (dict key) is not str or
-                document is not json serializable.
+    def _match(self, field, predicate):
         """
-        if not isinstance(document, dict):
-            raise self.document_type_error
-        if not document:
-            raise TypeError("document must not be empty")
-        if key is not None and not self._isstr(key):
-            raise self.key_type_error
-        if key is None:
-            key = uuid.uuid1().hex
-        for field in document:
-            if not self._isstr(field):
-                raise TypeError("document field (dict key) must be string")
-        if not self._is_serializable(document):
-            raise TypeError("document is not json serializable")
-        self.db[key] = document
-        self._autosave()
-        return key
+        Return the keys of the documents whose field value satisfies the
+        predicate, using the field index if available.
+        """
+        index = self.indexes.get(field)
+        if index is not None:
+            return index.match(predicate)
+        getter = _compile_path(field)
+        return [key for key, document in self._items() if predicate(getter(document))]
 
-    def insertmany(self, documents):
+    def _document(self, key):
         """
-        Insert multiple documents on database.
+        Return a document, spilled documents are read without caching them
+        so scans do not evict the recently used ones.
+        """
+        document = self.db[key]
+        if document is _SPILLED:
+            document = self._stored(self.cache.read(key))
+        if isinstance(document, Compressed):
+            return document.decode()
+        return document
 
-        The documents list will be validated before the insertion, so all the
-        documents will be inserted or none.
+    def _check_import(self, key, workers):
+        if key is not None and not self._isstr(key):
+            raise TypeError("key must be string")
+        if workers is not None and (type(workers) is not int or workers < 1):
+            raise TypeError("workers must be a positive integer")
 
-        Args:
-            documents (list): List containing the documents to insert.
+    def _workers(self, path, workers):
+        if workers is not None:
+            return workers
+        if os.path.getsize(path) < self.import_parallel_size:
+            return 1
+        return os.cpu_count() or 1
 
-        Returns:
-            Number of inserted documents.
+    def _chunks(self, lines, start):
+        """
+        Iterate over (first line number, lines) chunks of import_chunk_size
+        lines.
+        """
+        lines = iter(lines)
+        while True:
+            chunk = list(islice(lines, self.import_chunk_size))
+            if not chunk:
+                return
+            yield start, chunk
+            start += len(chunk)
 
-        Raises:
-            TypeError: If keys is not a list or a document is not dict.
+    def _parse(self, parse, chunks, workers):
         """
-        if not isinstance(documents, list):
-            raise TypeError("documents must be a list")
-        for doc in documents:
-            if not isinstance(doc, dict):
-                raise TypeError('invalid dict: "{}"'.format(doc))
-        for doc in documents:
-            self.insert(doc)
-        return len(documents)
+        Parse the chunks in order, on worker processes if more than one. At
+        most two chunks per worker are pending, bounding the memory used by
+        the file contents.
+        """
+        if workers == 1:
+            return [pair for chunk in chunks for pair in parse(chunk)]
+        import multiprocessing
+
+        pairs = []
+        pending = deque()
+        with multiprocessing.Pool(workers) as pool:
+            for chunk in chunks:
+                pending.append(pool.apply_async(parse, (chunk,)))
+                if len(pending) >= workers * 2:
+                    pairs.extend(pending.popleft().get())
+            while pending:
+                pairs.extend(pending.popleft().get())
+        return pairs
 
-    def get(self, key):
+    def _schemaspec(self):
         """
-        Get a document on database.
+        Return the schema declaration, picklable for the import workers.
+        """
+        if self.schema is None:
+            return None
+        return {field: (kind, field in self.schema.required) for field, kind in self.schema.types.items()}
 
-        Args:
-            key (str): The document key.
+    def _import(self, pairs):
+        """
+        Insert the parsed and checked (key, document) pairs, autosave saves
+        once.
+        """
+        import uuid
 
-        Returns:
-            The document or False if it does not exist.
+        self._purge()
+        for key, document in pairs:
+            self._put(document, uuid.uuid1().hex if key is None else key, None)
+        self._autosave()
+        return len(pairs)
 
-        Raises:
-            TypeError: If key is not str.
+    def _export_keys(self, query, key):
+        self._purge()
+        if key is not None and not self._isstr(key):
+            raise TypeError("key must be string")
+        return list(self.db) if query is None else self.find(query)
+
+    def _export_documents(self, keys, key):
+        for name, document in self._items(keys):
+            if key is not None:
+                document = dict(chain(((key, name),), document.items()))
+            yield document
+
+    def _items(self, keys=None):
         """
-        if not self._isstr(key):
-            raise self.key_type_error
-        try:
-            return self.db[key]
-        except KeyError:
-            return False
+        Iterate over (key, document) of all documents or the provided keys.
+        """
+        if not self.compressed and (self.cache is None or not self.cache.spilled):
+            if keys is None:
+                return self.db.items()
+            return ((key, self.db[key]) for key in keys)
+        return ((key, self._document(key)) for key in (self.db if keys is None else keys))
 
-    def getmany(self, keys):
+    def _dump(self, f, indent):
         """
-        Get multiple documents from database.
+        Write the database json like json.dump, one document at a time. The
+        spilled documents are copied from the segment.
+        """
+        if indent is None:
+            newline, separator = "", ", "
+        else:
+            if isinstance(indent, int):
+                indent = " " * indent
+            newline, separator = "\n" + indent, ","
+        f.write("{")
+        for position, (key, document) in enumerate(self.db.items()):
+            if position:
+                f.write(separator)
+            if document is not _SPILLED:
+                data = json.dumps(document, indent=indent, default=_encode)
+            elif indent is None:
+                data = self.cache.raw(key).decode()
+            else:
+                data = json.dumps(json.loads(self.cache.raw(key)), indent=indent)
+            f.write(newline + json.dumps(key) + ": " + data.replace("\n", newline))
+        if self.db and indent is not None:
+            f.write("\n")
+        f.write("}")
 
-        Args:
-            keys (list): List containing the keys of the documents to retrieve.
+    def _dump_blocks(self, f):
+        """
+        Write the database in the block format: the magic header, blocks of
+        {length: 4 bytes, crc: 4, json object of about block_size bytes},
+        the json index of [offset, length, crc, keys] lists and the footer.
+        """
+        import zlib
 
-        Returns:
-            List of documents.
+        f.write(_BLOCKS_MAGIC)
+        offset = len(_BLOCKS_MAGIC)
+        index = []
+        keys = []
+        parts = []
+        size = 0
+        for key, document in self.db.items():
+            if document is _SPILLED:
+                data = self.cache.raw(key).decode()
+            else:
+                data = json.dumps(document, default=_encode)
+            keys.append(key)
+            parts.append(json.dumps(key) + ": " + data)
+            size += len(data)
+            if size >= self.block_size:
+                offset = self._write_block(f, offset, index, keys, parts)
+                keys = []
+                parts = []
+                size = 0
+        if parts:
+            offset = self._write_block(f, offset, index, keys, parts)
+        data = json.dumps(index).encode()
+        f.write(data)
+        f.write(offset.to_bytes(8, "big") + len(data).to_bytes(4, "big") + zlib.crc32(data).to_bytes(4, "big"))
+        f.write(_INDEX_MAGIC)
 
-        Raises:
-            TypeError: If keys is not a list.
+    def _write_block(self, f, offset, index, keys, parts):
         """
-        if not isinstance(keys, list):
-            raise self.keys_type_error
-        docs_list = []
-        for key in keys:
-            doc = self.get(key)
-            if not doc:
-                continue
-            docs_list.append(doc)
-        return docs_list
+        Write a block of documents json and add it to the index, returning
+        the offset of the next block.
+        """
+        import zlib
+
+        payload = ("{" + ", ".join(parts) + "}").encode()
+        crc = zlib.crc32(payload)
+        f.write(len(payload).to_bytes(4, "big") + crc.to_bytes(4, "big"))
+        f.write(payload)
+        index.append([offset, len(payload), crc, keys])
+        return offset + 8 + len(payload)
 
-    def getall(self):
+    def _pack(self, document):
         """
-        Return a list containing all documents on database.
+        Return the stored form of a document, compressed if its json is at
+        least compression_threshold long or a record if it follows the
+        schema.
         """
-        return self.getmany(self.getallkeys())
+        if self.codec is not None:
+            data = json.dumps(document).encode()
+            if len(data) >= self.compression_threshold:
+                self.compressed = True
+                return Compressed(self.codec, self.codec.compress(data))
+        if self.schema is not None:
+            return self.schema.pack(document) or document
+        return document
 
-    def getallkeys(self):
+    def _stored(self, document):
         """
-        Return a list containing all keys on database.
+        Return the stored form of a document read from json, the compressed
+        documents are saved as {"$compressed": codec name, "data": base64}.
         """
-        return list(self.db.keys())
+        if not (len(document) == 2 and _COMPRESSED in document and "data" in document):
+            if self.schema is not None:
+                return self.schema.pack(document) or document
+            return document
+        import base64
 
-    def getrandom(self):
+        name = document[_COMPRESSED]
+        codec = self.codec if self.codec is not None and self.codec.name == name else _codec(name)
+        self.compressed = True
+        return Compressed(codec, base64.b64decode(document["data"]))
+
+    def _isstr(self, obj):
         """
-        Get a random document on database.
+        Check if object is a string.
+        """
+        return isinstance(obj, str)
 
-        Returns:
-            A document or False if database is empty.
+    def _is_serializable(self, obj):
+        """
+        Check if the object is json serializable.
         """
         try:
-            key = random.choice(self.getallkeys())
-        except IndexError:
+            json.dumps(obj)
+        except (TypeError, OverflowError):
             return False
-        return self.get(key)
+        return True
 
-    def getfirst(self):
+    def stats(self):
         """
-        Get the first inserted document on database.
+        Return the operation metrics, enable them with dbj(path, metrics=True).
 
         Returns:
-            The first inserted document or False if database is empty.
+            Dict with the calls count, total, average and max latency and
+            latency histogram (upper bound in seconds: count) of each
+            method, the number of saves, bytes written, autosaves and
+            queries with the documents scanned and matched, the memory cache
+            counters when bounded, or False if metrics are disabled.
         """
-        first_doc_key = self.getfirstkey()
-        if not first_doc_key:
+        if self.metrics is None:
             return False
-        return self.get(first_doc_key)
+        stats = self.metrics.snapshot()
+        if self.cache is not None:
+            stats["cache"] = self.cache.snapshot()
+        return stats
 
-    def getlast(self):
+    def resetstats(self):
         """
-        Get the last inserted document on database.
+        Reset the operation metrics.
 
         Returns:
-            The last inserted document or False if database is empty.
+            True or False if metrics are disabled.
         """
-        last_doc_key = self.getlastkey()
-        if not last_doc_key:
+        if self.metrics is None:
             return False
-        return self.get(last_doc_key)
+        self.metrics.reset()
+        return True
 
-    def getfirstkey(self):
+    def internstats(self):
         """
-        Get the first key on database.
+        Return the string interning report, enable it with
+        dbj(path, intern=True or fields).
 
         Returns:
-            The first key or False if database is empty.
+            Dict with the number of shared strings, the strings replaced by a
+            shared one and the bytes saved, or False if interning is
+            disabled.
         """
-        try:
-            key = next(iter(self.db))
-        except StopIteration:
+        if self.strings is None:
             return False
-        return key
+        return dict(self.interned, strings=len(self.strings))
 
-    def getlastkey(self):
+    def addhook(self, when, callback):
         """
-        Get the last key on database.
+        Register a callback called before or after each database operation.
+
+        Pre hooks are called as callback(method, args, kwargs) and post
+        hooks as callback(method, args, kwargs, elapsed, result), elapsed
+        in seconds. Useful to forward the metrics to a monitoring system.
+
+        Args:
+            when (str): "pre" or "post".
+            callback (callable): The function to call.
 
         Returns:
-            The last key or False if database is empty.
+            True if successful.
+
+        Raises:
+            TypeError: If when is not "pre" or "post" or callback is not
+                callable.
+        """
+        if when not in self.hooks:
+            raise TypeError('when must be "pre" or "post"')
+        if not callable(callback):
+            raise TypeError("callback must be callable")
+        self.hooks[when].append(callback)
+        self._instrument()
+        return True
+
+    def removehook(self, when, callback):
+        """
+        Remove a registered callback.
+
+        Args:
+            when (str): "pre" or "post".
+            callback (callable): The registered function.
+
+        Returns:
+            True or False if the callback is not registered.
         """
         try:
-            key = next(reversed(self.db))
-        except StopIteration:
+            self.hooks[when].remove(callback)
+        except (KeyError, ValueError):
             return False
-        return key
+        return True
 
-    def pop(self, key):
+    def subscribe(self, callback):
         """
-        Get the document from database and remove it.
+        Register a callback called after each change with the change event.
+
+        Events are dicts with the sequence number ("seq"), the operation
+        ("op": "insert", "update", "delete", "expire" or "clear"), the
+        document "key" and the new "document" for inserts and updates.
 
         Args:
-            key (str): The document key.
+            callback (callable): The function to call.
 
         Returns:
-            The document or False if it does not exist.
+            True if successful.
 
         Raises:
-            TypeError: If key is not str.
+            TypeError: If callback is not callable.
         """
-        if not self._isstr(key):
-            raise self.key_type_error
-        document = self.get(key)
-        if not document:
-            return False
-        self.delete(key)
-        return document
+        if not callable(callback):
+            raise TypeError("callback must be callable")
+        self.subscribers.append(callback)
+        return True
 
-    def popfirst(self):
+    def unsubscribe(self, callback):
         """
-        Get the first inserted document on database and remove it.
+        Remove a registered change callback.
+
+        Args:
+            callback (callable): The registered function.
 
         Returns:
-            The first inserted document or False if database is empty.
+            True or False if the callback is not registered.
         """
-        document = self.getfirst()
-        if not document:
+        try:
+            self.subscribers.remove(callback)
+        except ValueError:
             return False
-        self.delete(self.getfirstkey())
-        return document
+        return True
 
-    def poplast(self):
+    def changes(self, since=0):
         """
-        Get the last inserted document on database and remove it.
+        Return the changes made after a sequence number, sequence numbers
+        start at 1 when the database is opened.
+
+        Args:
+            since (int, optional): The last sequence number seen. Defaults
+                to 0.
 
         Returns:
-            The last inserted document or False if database is empty.
+            List of change events or False if some of the changes are no
+            longer kept (changelog_size), the consumer must read the whole
+            database again.
+
+        Raises:
+            TypeError: If since is not int.
         """
-        document = self.getlast()
-        if not document:
+        if type(since) is not int:
+            raise TypeError("since must be int")
+        changelog = self.changelog
+        if since < self.seq - len(changelog):
             return False
-        self.delete(self.getlastkey())
-        return document
+        skip = len(changelog) - (self.seq - since)
+        return [self._event(*change) for change in islice(changelog, max(skip, 0), None)]
 
-    def delete(self, key):
+    async def watch(self, since=None):
         """
-        Delete a document on database.
+        Asynchronously iterate over the change events, the changes made after
+        since are yielded first when provided.
+
+        Args:
+            since (int, optional): The last sequence number seen. Defaults to
+                only the new changes.
+
+        Raises:
+            TypeError: If since is not int.
+            ValueError: If the changes after since are no longer kept.
+        """
+        import asyncio
+
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+
+        def callback(event):
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+        self.subscribe(callback)
+        try:
+            last = self.seq
+            if since is not None:
+                backlog = self.changes(since)
+                if backlog is False:
+                    raise ValueError("changes after {} are no longer available".format(since))
+                for event in backlog:
+                    yield event
+                last = max(last, since)
+            while True:
+                event = await queue.get()
+                if event["seq"] > last:
+                    yield event
+        finally:
+            self.unsubscribe(callback)
+
+    def serve(self, path):
+        """
+        Serve the database on a Unix domain socket until SIGINT or SIGTERM,
+        then save it (unless autosave is enabled) and remove the socket. Must
+        be called from the main thread.
+
+        Each message is a 4 bytes big endian length followed by the json of
+        a request {"id": 1, "method": "get", "args": ["key"], "kwargs": {}}
+        or a list of requests (a batch). The replies {"id": 1, "result": ...}
+        or {"id": 1, "error": "TypeError", "message": "..."} are sent in the
+        request order, so requests can be pipelined. A single thread runs
+        the requests one at a time, see DbjClient.
 
         Args:
-            key (str): The document key.
+            path (str): The socket file, a stale one is replaced.
+        """
+        import selectors
+        import signal
+        import socket
+        import stat
 
-        Returns:
-            True or False if it does not exist.
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        # Bound to a temporary name and renamed when listening, so clients
+        # can connect once the socket file exists
+        staging = "{}.{}".format(path, os.getpid())
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(staging)
+        server.listen()
+        os.replace(staging, path)
+        server.setblocking(False)
+        # The signals only stop the loop between requests, their handler
+        # wakes up the selector by writing to the socket pair
+        wakeup, notify = socket.socketpair()
+        wakeup.setblocking(False)
+        notify.setblocking(False)
+        stop = []
+        handlers = {}
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            handlers[signum] = signal.signal(signum, lambda *args: stop.append(args))
+        wakeup_fd = signal.set_wakeup_fd(notify.fileno())
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        selector.register(wakeup, selectors.EVENT_READ)
+        try:
+            while not stop:
+                for key, events in selector.select():
+                    if key.fileobj is server:
+                        try:
+                            connection, _ = server.accept()
+                        except BlockingIOError:
+                            continue
+                        connection.setblocking(False)
+                        # Received data and replies not sent yet
+                        selector.register(connection, selectors.EVENT_READ, (bytearray(), bytearray()))
+                    elif key.fileobj is wakeup:
+                        wakeup.recv(4096)
+                    else:
+                        self._connection(selector, key, events)
+        finally:
+            signal.set_wakeup_fd(wakeup_fd)
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+            notify.close()
+            os.remove(path)
+            if not self.autosave:
+                self.save()
 
-        Raises:
-            TypeError: If key is not str.
+    def _connection(self, selector, key, events):
+        """
+        Answer the complete requests received on a client connection, the
+        replies of pipelined requests are sent together.
+        """
+        import selectors
+
+        connection = key.fileobj
+        received, replies = key.data
+        if events & selectors.EVENT_READ:
+            try:
+                data = connection.recv(65536)
+            except BlockingIOError:
+                data = None
+            except ConnectionError:
+                data = b""
+            if data == b"":
+                selector.unregister(connection)
+                connection.close()
+                return
+            if data:
+                received += data
+                start = 0
+                while len(received) - start >= 4:
+                    size = int.from_bytes(received[start : start + 4], "big")
+                    if len(received) - start - 4 < size:
+                        break
+                    reply = self._answer(bytes(received[start + 4 : start + 4 + size]))
+                    replies += len(reply).to_bytes(4, "big") + reply
+                    start += 4 + size
+                del received[:start]
+        if replies:
+            try:
+                sent = connection.send(replies)
+            except BlockingIOError:
+                sent = 0
+            except ConnectionError:
+                selector.unregister(connection)
+                connection.close()
+                return
+            del replies[:sent]
+        # Wait until the client reads the replies left
+        wanted = selectors.EVENT_READ | selectors.EVENT_WRITE if replies else selectors.EVENT_READ
+        if key.events != wanted:
+            selector.modify(connection, wanted, key.data)
+
+    def _answer(self, data):
+        """
+        Run a request or a batch, returning the reply json.
         """
-        if not self._isstr(key):
-            raise self.key_type_error
         try:
-            del self.db[key]
-        except KeyError:
-            return False
-        self._autosave()
-        return True
+            request = json.loads(data)
+        except ValueError as e:
+            return self._reply({"id": None, "error": "ValueError", "message": str(e)})
+        if isinstance(request, list):
+            return b"[" + b",".join(self._reply(self._call(item)) for item in request) + b"]"
+        return self._reply(self._call(request))
 
-    def deletemany(self, keys):
+    def _call(self, request):
         """
-        Delete multiple documents on database.
+        Run a request, returning its reply.
+        """
+        request_id = request.get("id") if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict):
+                raise TypeError("request must be dict")
+            method = request.get("method")
+            if method not in _SERVED:
+                raise TypeError('invalid method: "{}"'.format(method))
+            result = getattr(self, method)(*request.get("args", ()), **request.get("kwargs", {}))
+        except Exception as e:
+            return {"id": request_id, "error": type(e).__name__, "message": str(e)}
+        return {"id": request_id, "result": result}
 
-        Args:
-            keys (list): List containing the keys of the documents to delete.
+    def _reply(self, reply):
+        try:
+            return json.dumps(reply, default=_encode).encode()
+        except (TypeError, ValueError) as e:
+            return json.dumps({"id": reply["id"], "error": type(e).__name__, "message": str(e)}).encode()
 
-        Returns:
-            Number of deleted documents.
+    def _emit(self, op, key=None, document=None):
+        """
+        Record a change and notify the subscribers. The changelog keeps the
+        stored document itself, copied by _unshare before it is changed in
+        place.
+        """
+        seq = self.seq = self.seq + 1
+        changelog = self.changelog
+        if changelog.maxlen:
+            changelog.append((seq, op, key, document))
+            if document is not None:
+                shared = self.shared
+                shared[key] = seq
+                if len(shared) > 2 * changelog.maxlen:
+                    oldest = seq - len(changelog)
+                    self.shared = {key: seq for key, seq in shared.items() if seq > oldest}
+        if self.subscribers:
+            event = self._event(seq, op, key, document)
+            for callback in list(self.subscribers):
+                callback(event)
 
-        Raises:
-            TypeError: If keys is not a list.
+    def _unshare(self, key):
         """
-        if not isinstance(keys, list):
-            raise self.keys_type_error
-        deleted = 0
-        for key in keys:
-            if not self.delete(key):
-                continue
-            deleted += 1
-        return deleted
+        Replace the stored document held by the changelog with a copy, before
+        it is changed in place. Updates only replace fields or append to list
+        fields, so copying the lists is enough.
+        """
+        seq = self.shared.pop(key, None)
+        if seq is None:
+            return
+        position = len(self.changelog) - 1 - (self.seq - seq)
+        if position < 0:
+            return
+        _, op, key, document = self.changelog[position]
+        document = {field: value[:] if type(value) is list else value for field, value in document.items()}
+        self.changelog[position] = (seq, op, key, document)
 
-    def clear(self):
+    def _event(self, seq, op, key, document):
         """
-        Remove all documents from database.
+        Return a change event, with a new copy of the recorded document.
         """
-        self.db.clear()
-        self._autosave()
-        return True
+        if document is not None:
+            document = json.loads(json.dumps(document, default=_encode))
+        return {"seq": seq, "op": op, "key": key, "document": document}
 
-    def size(self):
+    def _instrument(self):
         """
-        Return the number of documents on database.
+        Replace the public methods of this instance by timed wrappers, so
+        there is no overhead at all while metrics and hooks are unused.
         """
-        return len(self.db.keys())
+        if "insert" in self.__dict__:
+            return
+        for method in _METERED:
+            setattr(self, method, self._metered(method, getattr(self, method)))
 
-    def exists(self, key):
+    def _metered(self, method, func):
         """
-        Check if a document exists on database.
+        Wrap a method to record its latency, call the hooks and log the slow
+        queries. Calls made by another metered method, like getmany calling
+        get, are not recorded.
+        """
+        is_query = method in _QUERIES
+
+        def metered(*args, **kwargs):
+            if self.depth:
+                return func(*args, **kwargs)
+            self.depth = 1
+            try:
+                for hook in self.hooks["pre"]:
+                    hook(method, args, kwargs)
+                start = time.perf_counter()
+                result = func(*args, **kwargs)
+                elapsed = time.perf_counter() - start
+                if self.metrics is not None:
+                    self.metrics.record(method, elapsed)
+                if is_query and self.slow_query is not None and elapsed >= self.slow_query:
+                    if self.metrics is not None:
+                        self.metrics.slow_queries += 1
+                    import logging
+
+                    logging.getLogger("dbj").warning(
+                        "slow %s (%.6fs): args=%r kwargs=%r", method, elapsed, args, kwargs
+                    )
+                for hook in self.hooks["post"]:
+                    hook(method, args, kwargs, elapsed, result)
+            finally:
+                self.depth = 0
+            return result
+
+        metered.__doc__ = func.__doc__
+        metered.__name__ = method
+        return metered
+
+    def getttl(self, key):
+        """
+        Get the remaining time to live of a document.
 
         Args:
             key (str): The document key.
 
         Returns:
-            True or False if it does not exist.
+            The remaining seconds or False if the document does not exist or
+            does not expire.
 
         Raises:
             TypeError: If key is not str.
         """
         if not self._isstr(key):
             raise self.key_type_error
-        if key in self.db:
-            return True
-        return False
+        self._purge(self.purge_batch, key)
+        expires = self.expires.get(key)
+        if expires is None:
+            return False
+        return max(expires - time.time(), 0.0)
 
-    def update(self, key, values):
+    def setttl(self, key, ttl):
         """
-        dd/update values on a document.
+        Set or remove the time to live of a document.
 
         Args:
             key (str): The document key.
-            values (dict): The values to be added/updated.
+            ttl (int or float): Remove the document after this many seconds,
+                None removes the expiration.
 
         Returns:
-            True or False if document does not exist.
+            True or False if the document does not exist.
 
         Raises:
-            TypeError: If values is not dict or key is not str.
+            TypeError: If key is not str or ttl is not a positive number.
         """
-        if not isinstance(values, dict):
-            raise self.document_type_error
         if not self._isstr(key):
             raise self.key_type_error
-        document = self.get(key)
-        if not document:
+        if ttl is not None:
+            self._check_ttl(ttl)
+        self._purge(self.purge_batch, key)
+        if key not in self.db:
             return False
-        document.update(values)
-        self.insert(document, key)
+        if ttl is None:
+            self.expires.pop(key, None)
+        else:
+            self._set_expiry(key, ttl)
         return True
 
-    def updatemany(self, keys, values):
-        """
-        Add/update values on multiple documents.
+    def _check_ttl(self, ttl):
+        if type(ttl) not in (int, float) or not ttl > 0:
+            raise TypeError("ttl must be a positive number")
 
-        Args:
-            keys (list): List containing the keys of the documents to update.
-            values (dict): The values to be added/updated.
+    def _set_expiry(self, key, ttl=None, expires=None):
+        """
+        Schedule the document removal after ttl seconds or at the expires
+        timestamp.
+        """
+        if expires is None:
+            expires = time.time() + ttl
+        self.expires[key] = expires
+        heapq.heappush(self.expiry_heap, (expires, key))
+        # Drop the outdated heap entries left by deletes and new ttls
+        if len(self.expiry_heap) > 2 * len(self.expires) + 64:
+            self.expiry_heap = [(expires, key) for key, expires in self.expires.items()]
+            heapq.heapify(self.expiry_heap)
 
-        Returns:
-            Number of updated documents.
+    def _purge(self, limit=None, key=None):
+        """
+        Remove the expired documents using the expiration heap, the store is
+        never scanned.
 
-        Raises:
-            TypeError: If keys is not a list or values is not dict.
+        Args:
+            limit (int, optional): Remove at most this many documents, used to
+                amortize the work on single key operations. Defaults to all.
+            key (str, optional): Always check this document, even if the
+                limit is reached.
         """
-        if not isinstance(values, dict):
-            raise self.document_type_error
-        if not isinstance(keys, list):
-            raise self.keys_type_error
-        updated = 0
-        for key in keys:
-            if not self.update(key, values):
+        heap = self.expiry_heap
+        if not heap:
+            return
+        now = time.time()
+        if key is not None and self.expires.get(key, now + 1) <= now:
+            self._expire(key)
+        purged = 0
+        while heap and heap[0][0] <= now and (limit is None or purged < limit):
+            expires, expired_key = heapq.heappop(heap)
+            if self.expires.get(expired_key) != expires:
                 continue
-            updated += 1
-        return updated
+            self._expire(expired_key)
+            purged += 1
 
-    def sort(self, keys, field, reverse=False):
+    def _expire(self, key):
         """
-        Sort the documents using the field provided.
-
-        Args:
-            keys (list): List containing the keys of the documents to sort.
-            field (str): Field to sort.
-            reverse (bool, optional): Reverse sort. Defaults to False.
+        Remove an expired document, without autosave.
+        """
+        del self.expires[key]
+        if self.db.pop(key, None) is None:
+            return
+        if self.indexes or self.columns or self.textindexes:
+            self._unindex(key)
+        if self.cache is not None:
+            self.cache.discard(key)
+        self._emit("expire", key)
+        if self.metrics is not None:
+            self.metrics.expired += 1
 
-        Returns:
-            Sorted list with the documents keys.
+    def _expires_path(self):
+        return self.path + ".ttl"
 
-        Raises:
-            TypeError: If keys is not a list or field is not string.
+    def _save_expires(self):
         """
-        if not isinstance(keys, list):
-            raise self.keys_type_error
-        if not self._isstr(field):
-            raise TypeError("field must be string")
-        sorted_list = []
-        for key in keys:
-            try:
-                sorted_list.append((self.db[key][field], key))
-            except KeyError:
-                pass
-        sorted_list.sort(reverse=reverse)
-        sorted_keys = [elem[1] for elem in sorted_list]
-        return sorted_keys
-
-    def findtext(self, field, text, exact=False, sens=False, inverse=False, asc=True):
+        Save the expiration timestamps next to the database file, remove the
+        file if no document expires.
         """
-        Simple text search on the provided field.
+        if not self.expires:
+            os.remove(self._expires_path())
+            return
+        with open(self._expires_path(), "wt") as f:
+            with KillProtected():
+                json.dump(self.expires, f)
 
-        Args:
-            field (str): The field to search.
-            text (str): The value to be searched.
-            exact (bool, optional): Exact text match. Defaults to False.
-            sens (bool, optional): Case sensitive. Defaults to False.
-            inverse (bool, optional): Inverse search, return the documents that
-                do not match the search. Defaults to False.
-            asc (bool, optional): Ascii conversion before matching, this
-                matches text like 'cafe' and 'café'. Defaults to True.
+    def _load_expires(self):
+        """
+        Load the expiration timestamps and drop the documents that expired
+        while the database was closed.
 
         Returns:
-            List with the keys of the documents that matched the search.
-
-        Raises:
-            TypeError: If field is not str, text is not str, exact is not
-                bool, sens is not bool, inverse is not bool or asc is not bool.
+            List with the keys of the dropped documents.
         """
-        if not self._isstr(field) or not self._isstr(text):
-            raise TypeError("field and text must be string")
-        if (
-            not isinstance(exact, bool)
-            or not isinstance(sens, bool)
-            or not isinstance(inverse, bool)
-            or not isinstance(asc, bool)
-        ):
-            raise TypeError("exact, sens, inverse and asc must be boolean")
-        match_list = []
-        not_match_list = []
-        for doc_key in self.db.keys():
-            try:
-                field_value = self.db[doc_key][field]
-            except KeyError:
+        self.expires = {}
+        self.expiry_heap = []
+        try:
+            with open(self._expires_path(), "rt") as f:
+                expires = json.load(f)
+        except (OSError, ValueError):
+            return []
+        now = time.time()
+        expired = []
+        for key, timestamp in expires.items():
+            if key not in self.db:
                 continue
-            if not isinstance(field_value, str):
+            if timestamp <= now:
+                del self.db[key]
+                expired.append(key)
                 continue
-            if asc:
-                fv_nfkd = unicodedata.normalize("NFKD", field_value)
-                field_value = fv_nfkd.encode("ASCII", "ignore").decode()
-                text_nfkd = unicodedata.normalize("NFKD", text)
-                text = text_nfkd.encode("ASCII", "ignore").decode()
-            if not exact and not sens:
-                if text.lower() in field_value.lower():
-                    match_list.append(doc_key)
-                else:
-                    not_match_list.append(doc_key)
-            elif exact and not sens:
-                if text.lower() == field_value.lower():
-                    match_list.append(doc_key)
-                else:
-                    not_match_list.append(doc_key)
-            elif not exact and sens:
-                if text in field_value:
-                    match_list.append(doc_key)
-                else:
-                    not_match_list.append(doc_key)
-            else:
-                if text == field_value:
-                    match_list.append(doc_key)
-                else:
-                    not_match_list.append(doc_key)
-        if inverse:
-            return not_match_list
-        return match_list
+            self.expires[key] = timestamp
+            self.expiry_heap.append((timestamp, key))
+        heapq.heapify(self.expiry_heap)
+        return expired
 
-    def findnum(self, expression):
+    def _autosave(self):
         """
-        Simple number comparison search on provided field.
+        Save if autosave is enabled.
+        """
+        if self.autosave:
+            if self.metrics is not None:
+                self.metrics.autosaves += 1
+            self.save()
+
+
+def _send(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(len(data).to_bytes(4, "big") + data)
+
+
+def _receive(reader):
+    header = reader.read(4)
+    if len(header) == 4:
+        size = int.from_bytes(header, "big")
+        data = reader.read(size)
+        if len(data) == size:
+            return json.loads(data)
+    raise ConnectionError("connection closed by the server")
+
+
+class DbjClient:
+    """
+    Client of a database served by dbj.serve, with the same method names.
+
+    Connections are opened when needed and kept on a pool for reuse, so the
+    client can be shared by threads. Errors raised by the server are raised
+    again, as RuntimeError when not a TypeError, ValueError or KeyError.
+
+    Args:
+        path (str): The server socket file.
+        pool_size (int, optional): Idle connections kept open. Defaults to 4.
+        timeout (float, optional): Socket timeout in seconds. Defaults to
+            None (blocking).
+    """
+
+    def __init__(self, path, pool_size=4, timeout=None):
+        import threading
+
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pool = []
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def __getattr__(self, name):
+        if name not in _SERVED:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+        def method(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        method.__name__ = name
+        # Cached on the instance, __getattr__ is not called again
+        setattr(self, name, method)
+        return method
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call a database method on the server.
 
         Args:
-            expression (str): The comparison expression to use, e.g.,
-                "age >= 18". The pattern is 'field operator number'.
+            method (str): The method name, e.g., "get".
+            *args, **kwargs: The method arguments.
 
         Returns:
-            List with the keys of the documents that matched the search.
+            The method result.
 
         Raises:
-            TypeError: If expression is invalid.
+            TypeError: If the method is invalid or raised TypeError.
         """
-        if not self._isstr(expression):
-            raise TypeError("expression must be string")
-        operators = ("==", "!=", "<", "<=", ">", ">=")
-        tokens = expression.split(" ")
-        if len(tokens) != 3:
-            raise TypeError('invalid expression: "{}"'.format(expression))
-        field = tokens[0]
-        operator = tokens[1]
-        if operator not in operators:
-            raise TypeError('invalid number operator: "{}"'.format(operator))
-        try:
-            number = float(tokens[2])
-        except ValueError:
-            raise TypeError('invalid number: "{}"'.format(tokens[2]))
-        match_list = []
-        for doc_key in self.db.keys():
-            try:
-                field_value = float(self.db[doc_key][field])
-            except (KeyError, ValueError):
-                continue
-            if operator == "==":
-                if field_value == number:
-                    match_list.append(doc_key)
-            elif operator == "!=":
-                if field_value != number:
-                    match_list.append(doc_key)
-            elif operator == "<":
-                if field_value < number:
-                    match_list.append(doc_key)
-            elif operator == "<=":
-                if field_value <= number:
-                    match_list.append(doc_key)
-            elif operator == ">":
-                if field_value > number:
-                    match_list.append(doc_key)
-            elif operator == ">=":
-                if field_value >= number:
-                    match_list.append(doc_key)
-        return match_list
+        return self._result(self._request(self._message(method, args, kwargs)))
 
-    def find(self, query, sens=False, asc=True, sortby=None, reverse=False):
+    def batch(self, calls):
         """
-        Simple query like search.
+        Call several database methods on a single round trip, they are run in
+        order without other clients requests in between.
 
         Args:
-            query (str): The query to use, examples:
-                1. age >= 18
-                2. description ?= "dbj is a"
-                3. name != "John" and age < 18
-                4. name == "Ana" or name == ""Bob "B" Lee"" and age >= 30
-                The pattern is:
-                    'field operator value and/or field operator value...'
-            sens (bool, optional): Case sensitive. Defaults to False.
-            asc (bool, optional): Ascii conversion before matching, this
-                matches text like 'cafe' and 'café'. Defaults to True.
-            sortby (string, optional): Sort using the provided field.
-            reverse (bool, optional): Reverse sort. Defaults to False.
+            calls (list): List of (method, args) or (method, args, kwargs).
 
         Returns:
-            List with the keys of the documents that matched the search.
+            List with the results.
 
         Raises:
-            TypeError: If query is invalid or sortby is not a string.
+            TypeError: If calls is invalid or the first failed call error,
+                after all calls ran.
         """
-        if not self._isstr(query):
-            raise TypeError("query must be string")
-        if sortby is not None and not self._isstr(sortby):
-            raise TypeError("sortby must be string")
-        tokens = self._parse_query(query)
-        if len(tokens) < 3:
-            raise TypeError('invalid query: "{}"'.format(query))
-        ops = []
-        lops = []
-        sets = []
-        for i in range(0, len(tokens), 4):
-            try:
-                ops.append(tokens[i])
-                ops.append(tokens[i + 1])
-                ops.append(tokens[i + 2])
-                lops.append(tokens[i + 3])
-            except IndexError:
-                pass
-        if len(ops) % 3 != 0:
-            raise TypeError('invalid query: "{}"'.format(query))
-        for lop in lops:
-            if lop.lower() not in ("and", "or"):
-                raise TypeError('invalid logical operator: "{}"'.format(lop))
-        if len(lops) > 0 and len(ops) / 3 != len(lops) + 1:
-            raise TypeError('invalid query: "{}"'.format(query))
-        for i in range(0, len(ops), 3):
-            field = ops[i]
-            operator = ops[i + 1]
-            value = ops[i + 2]
-            if value[0] == '"':
-                if value[:2] == '""':
-                    value = value[2:-2]
-                else:
-                    value = value[1:-1]
-                if operator == "==":
-                    result = self.findtext(field, value, sens=sens, asc=asc, exact=True)
-                elif operator == "!=":
-                    result = self.findtext(field, value, sens=sens, asc=asc, inverse=True)
-                elif operator == "?=":
-                    result = self.findtext(field, value, sens=sens, asc=asc)
-                else:
-                    raise TypeError('invalid string operator: "{}"'.format(operator))
-            else:
-                result = self.findnum("{} {} {}".format(field, operator, value))
-            sets.append(set(result))
-        for i in range(len(lops)):
-            if i == 0:
-                if lops[i] == "and":
-                    result = sets[i] & sets[i + 1]
-                elif lops[i] == "or":
-                    result = sets[i] | sets[i + 1]
-            else:
-                if lops[i] == "and":
-                    result = result & sets[i + 1]
-                elif lops[i] == "or":
-                    result = result | sets[i + 1]
-        if sortby is not None:
-            result = self.sort(list(result), sortby, reverse=reverse)
-        return list(result)
+        if not isinstance(calls, list):
+            raise TypeError("calls must be list")
+        messages = []
+        for item in calls:
+            if not isinstance(item, (list, tuple)) or len(item) not in (2, 3):
+                raise TypeError("call must be (method, args) or (method, args, kwargs)")
+            messages.append(self._message(item[0], item[1], item[2] if len(item) == 3 else {}))
+        if not messages:
+            return []
+        return [self._result(reply) for reply in self._request(messages)]
 
-    def _parse_query(self, query):
+    def close(self):
         """
-        Parse the query string and return a tokens list.
+        Close the idle connections.
         """
-        tokens = query.split(" ")
-        parsed_tokens = []
-        string_open = False
-        value_str = ""
-        string_delimiter = '"'
-        i = 0
-        while i < len(tokens):
-            if tokens[i][:2] == '""':
-                string_delimiter = '""'
-            if (
-                tokens[i][: len(string_delimiter)] == string_delimiter
-                and tokens[i][-len(string_delimiter) :] == string_delimiter
-            ):
-                parsed_tokens.append(tokens[i])
-                i += 1
-            elif tokens[i][: len(string_delimiter)] == string_delimiter:
-                string_open = True
-                value_str = tokens[i] + " "
-                i += 1
-            elif string_open:
-                if tokens[i][-len(string_delimiter) :] == string_delimiter:
-                    string_open = False
-                    value_str += tokens[i]
-                    parsed_tokens.append(value_str)
-                    value_str = ""
-                    string_delimiter = '"'
-                    i += 1
-                else:
-                    value_str += tokens[i] + " "
-                    i += 1
-            else:
-                parsed_tokens.append(tokens[i])
-                i += 1
-        return parsed_tokens
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for connection in pool:
+            self._disconnect(connection)
 
-    def _isstr(self, obj):
-        """
-        Check if object is a string.
-        """
-        return isinstance(obj, str)
+    def _message(self, method, args, kwargs):
+        self.requests += 1
+        return {"id": self.requests, "method": method, "args": list(args), "kwargs": kwargs}
 
-    def _is_serializable(self, obj):
+    def _request(self, message):
         """
-        Check if the object is json serializable.
+        Send a message on a pooled connection and return the reply.
         """
+        connection = None
+        with self.lock:
+            if self.pool:
+                connection = self.pool.pop()
+        if connection is None:
+            import socket
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            connection = (sock, sock.makefile("rb"))
         try:
-            json.dumps(obj)
-        except (TypeError, OverflowError):
-            return False
-        return True
+            _send(connection[0], message)
+            reply = _receive(connection[1])
+        except BaseException:
+            self._disconnect(connection)
+            raise
+        with self.lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(connection)
+                connection = None
+        if connection is not None:
+            self._disconnect(connection)
+        return reply
 
-    def _autosave(self):
-        """
-        Save if autosave is enabled.
-        """
-        if self.autosave:
-            self.save()
+    def _disconnect(self, connection):
+        connection[1].close()
+        connection[0].close()
+
+    def _result(self, reply):
+        if "error" in reply:
+            raise _SERVER_ERRORS.get(reply["error"], RuntimeError)(reply["message"])
+        return reply["result"]
+
+
+def main(argv=None):
+    """
+    Command line entry point, python -m dbj serve path --socket file.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m dbj", description="dbj database tools")
+    parser.add_argument("--version", action="version", version=__version__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve a database on a Unix domain socket")
+    serve.add_argument("path", help="the database file")
+    serve.add_argument("--socket", required=True, help="the socket file")
+    serve.add_argument("--autosave", action="store_true", help="save after every change")
+    for name in ("indexes", "columns", "textindexes"):
+        serve.add_argument("--" + name, type=lambda value: value.split(","), help="comma separated fields")
+    args = parser.parse_args(argv)
+    db = dbj(
+        args.path, autosave=args.autosave, indexes=args.indexes, columns=args.columns, textindexes=args.textindexes
+    )
+    db.serve(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
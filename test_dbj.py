@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import collections
+import json
 import os
+import signal
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
-from dbj import dbj
+from dbj import Codec, Compressed, DbjClient, Record, dbj
 
 
 class testdbj(unittest.TestCase):
@@ -17,6 +25,9 @@ class testdbj(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         os.remove("tests_dbj.db")
+        for sidecar in ("tests_dbj.db.text", "tests_dbj.db.ttl"):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
 
     def test_load(self):
         self.assertEqual(self.db.size(), 0)
@@ -27,6 +38,38 @@ class testdbj(unittest.TestCase):
         self.db.load()
         self.assertEqual(self.db.size(), 1)
 
+    def test_lazy(self):
+        self.db.insert({"name": "Ana"}, "1")
+        self.db.save()
+        db = dbj("tests_dbj.db", lazy=True, indexes=["name"])
+        self.assertNotIn("db", db.__dict__)
+        self.assertEqual(db.peek(), ["1"])
+        self.assertNotIn("db", db.__dict__)
+        self.assertEqual(db.find('name == "ana"'), ["1"])
+        self.assertIn("db", db.__dict__)
+        # Loaded databases use the plain attribute lookup again
+        self.assertIs(type(db), dbj)
+        self.assertFalse(hasattr(dbj, "__getattr__"))
+        with self.assertRaises(AttributeError):
+            db.missing
+        db = dbj("tests_dbj.db", lazy=True)
+        self.assertIsInstance(db, dbj)
+        with self.assertRaises(AttributeError):
+            db.missing
+        self.assertNotIn("db", db.__dict__)
+        db = dbj("tests_dbj.db", lazy=True)
+        db.insert({"name": "Bia"}, "2")
+        self.assertEqual(db.getallkeys(), ["1", "2"])
+
+    def test_peek(self):
+        self.assertEqual(dbj("missing_dbj.db", lazy=True).peek(), [])
+        self.db.insert({"name": "Ana", "address": {"city": "x"}}, "1")
+        self.db.insert({"name": "Bia"}, "2", ttl=0.01)
+        self.assertEqual(self.db.peek(), ["1", "2"])
+        self.db.save()
+        time.sleep(0.02)
+        self.assertEqual(dbj("tests_dbj.db", lazy=True).peek(), ["1"])
+
     def test_save(self):
         self.db.insert({"test": "testing"})
         self.assertTrue(self.db.save())
@@ -64,6 +107,19 @@ class testdbj(unittest.TestCase):
         self.assertFalse(self.db.get("1"))
         self.assertEqual(self.db.get("1000"), doc)
 
+    def test_get_fields(self):
+        doc = {"name": "Ana", "blob": "x" * 100, "address": {"city": "Porto", "zip": "4000"}, "a.b": 1}
+        self.db.insert(doc, "1")
+        with self.assertRaises(TypeError):
+            self.db.get("1", fields="name")
+        with self.assertRaises(TypeError):
+            self.db.get("1", fields=[1])
+        self.assertEqual(self.db.get("1", fields=["name"]), {"name": "Ana"})
+        self.assertEqual(self.db.get("1", fields=["address.city", "a.b"]), {"address": {"city": "Porto"}, "a.b": 1})
+        self.assertEqual(self.db.get("1", fields=["missing"]), {})
+        self.assertFalse(self.db.get("2", fields=["name"]))
+        self.assertEqual(self.db.get("1"), doc)
+
     def test_getmany(self):
         docs = [{"test": "testing"}, {"test2": "testing2"}]
         self.db.insert(docs[0], "1")
@@ -78,6 +134,25 @@ class testdbj(unittest.TestCase):
         self.db.insert(docs[1])
         self.assertEqual(self.db.getall(), docs)
 
+    def test_getall_fields(self):
+        self.db.insert({"name": "Ana", "age": 10})
+        self.db.insert({"age": 30})
+        self.assertEqual(self.db.getall(fields=["name"]), [{"name": "Ana"}, {}])
+        self.assertEqual(self.db.getmany(self.db.getallkeys(), fields=["age"]), [{"age": 10}, {"age": 30}])
+
+    def test_findall(self):
+        with self.assertRaises(TypeError):
+            self.db.findall(1)
+        with self.assertRaises(TypeError):
+            self.db.findall("age > 1", fields="age")
+        self.db.insert({"name": "Ana", "age": 30, "blob": "x"}, "1")
+        self.db.insert({"name": "Bia", "age": 10, "blob": "y"}, "2")
+        self.db.insert({"name": "Eva", "age": 20, "blob": "z"}, "3")
+        self.assertEqual(self.db.findall("age > 15"), [self.db.get("1"), self.db.get("3")])
+        self.assertEqual(self.db.findall("age > 15", fields=["name"]), [{"name": "Ana"}, {"name": "Eva"}])
+        r = self.db.findall("age > 5", fields=["name"], sortby="age", reverse=True)
+        self.assertEqual(r, [{"name": "Ana"}, {"name": "Eva"}, {"name": "Bia"}])
+
     def test_getallkeys(self):
         docs = [{"test": "testing"}, {"test2": "testing2"}]
         self.db.insert(docs[0], "1")
@@ -192,6 +267,47 @@ class testdbj(unittest.TestCase):
         self.assertEqual(doc["test"], "test update")
         self.assertEqual(doc["new"], "new field")
 
+    def test_update_operators(self):
+        self.db.createindex("views")
+        self.db.createcolumn("score")
+        self.db.insert({"name": "Ana", "views": 1, "tags": ["a"], "score": 5}, "1")
+        ops = {"$inc": {"views": 2, "hits": 1}, "$push": {"tags": "b"}, "$max": {"score": 3}, "$unset": ["name"]}
+        self.assertTrue(self.db.update("1", ops))
+        self.assertEqual(self.db.get("1"), {"views": 3, "tags": ["a", "b"], "score": 5, "hits": 1})
+        self.assertTrue(self.db.update("1", {"$max": {"score": 7}, "$set": {"name": "Bia"}}))
+        self.assertEqual(self.db.find("views == 3"), ["1"])
+        self.assertEqual(self.db.find("score > 6"), ["1"])
+        self.assertEqual(self.db.get("1")["name"], "Bia")
+        self.assertFalse(self.db.update("2", {"$inc": {"views": 1}}))
+        self.assertTrue(self.db.update("2", {"$inc": {"views": 1}}, upsert=True))
+        self.assertEqual(self.db.get("2"), {"views": 1})
+        self.assertEqual(self.db.find("views == 1"), ["2"])
+        with self.assertRaises(TypeError):
+            self.db.update("1", {"$rename": {"a": "b"}})
+        with self.assertRaises(TypeError):
+            self.db.update("1", {"$inc": {"tags": 1}})
+        with self.assertRaises(TypeError):
+            self.db.update("1", {"$inc": {"views": "1"}})
+        with self.assertRaises(TypeError):
+            self.db.update("1", {"$push": {"views": 1}})
+        with self.assertRaises(TypeError):
+            self.db.update("1", {"$max": {"name": 1}})
+        with self.assertRaises(TypeError):
+            self.db.update("2", {"$unset": ["views"]})
+        with self.assertRaises(TypeError):
+            self.db.update("1", {"$set": {"a": 1}, "$push": {"tags": 1 + 1j}})
+        # Operators and plain fields can not be mixed, in any order
+        with self.assertRaises(ValueError):
+            self.db.update("1", {"views": 5, "$inc": {"views": 1}})
+        with self.assertRaises(ValueError):
+            self.db.update("1", {"$inc": {"views": 1}, "views": 5})
+        with self.assertRaises(ValueError):
+            self.db.update("3", {"views": 5, "$inc": {"views": 1}}, upsert=True)
+        self.assertFalse(self.db.exists("3"))
+        # Invalid updates do not change the document
+        self.assertEqual(self.db.get("1"), {"views": 3, "tags": ["a", "b"], "score": 7, "hits": 1, "name": "Bia"})
+        self.assertEqual(self.db.get("2"), {"views": 1})
+
     def test_updatemany(self):
         with self.assertRaises(TypeError):
             self.db.updatemany("1", "test")
@@ -226,6 +342,66 @@ class testdbj(unittest.TestCase):
         self.assertEqual(self.db.sort(keys, "age", reverse=True), ["3", "1", "2", "4"])
         self.assertEqual(self.db.sort(keys, "country"), ["5"])
         self.assertEqual(self.db.sort(["3", "4"], "age"), ["4", "3"])
+        self.db.insert({"stats": {"score": 5}}, "6")
+        self.db.insert({"stats": {"score": 2}}, "7")
+        self.db.insert({"stats": 1}, "8")
+        self.assertEqual(self.db.sort(self.db.getallkeys(), "stats.score"), ["7", "6"])
+
+    def test_sort_fields(self):
+        with self.assertRaises(TypeError):
+            self.db.sort([], [])
+        with self.assertRaises(TypeError):
+            self.db.sort([], [("city", "up")])
+        with self.assertRaises(TypeError):
+            self.db.find("age > 1", sortby=[("city",)])
+        docs = [
+            {"city": "porto", "age": 20},
+            {"city": "lisbon", "age": 30},
+            {"city": "porto", "age": 40},
+            {"city": "lisbon", "age": 10},
+            {"city": "braga"},
+        ]
+        for key, doc in enumerate(docs, 1):
+            self.db.insert(doc, str(key))
+        keys = self.db.getallkeys()
+        sortby = [("city", "asc"), ("age", "desc")]
+        self.assertEqual(self.db.sort(keys, sortby), ["2", "4", "3", "1"])
+        self.assertEqual(self.db.sort(keys, sortby, reverse=True), ["1", "3", "4", "2"])
+        self.assertEqual(self.db.sort(keys, ["city", "age"]), ["4", "2", "1", "3"])
+        self.assertEqual(self.db.sort(keys, [("age", "desc")]), ["3", "2", "1", "4"])
+        self.assertEqual(self.db.find("age > 15", sortby=sortby), ["2", "3", "1"])
+        # Cached permutation, invalidated by changes
+        self.assertEqual(self.db.sort(["1", "4"], sortby), ["4", "1"])
+        self.assertEqual(self.db.sorts[(("city", False), ("age", True))], ["2", "4", "3", "1"])
+        # Sorts of a few keys never build a permutation
+        self.assertEqual(self.db.sort(["3"], "age"), ["3"])
+        self.assertEqual(self.db.sort(["3"], "age"), ["3"])
+        self.assertIsNone(self.db.sorts.get((("age", False),)))
+        # The cached permutations hold at most sort_cache_keys keys
+        self.db.sort_cache_keys = 6
+        self.assertEqual(self.db.sort(keys, "age"), ["4", "1", "2", "3"])
+        self.assertEqual(self.db.sort(keys, "age"), ["4", "1", "2", "3"])
+        self.assertEqual(self.db.sorts[(("age", False),)], ["4", "1", "2", "3"])
+        self.assertNotIn((("city", False), ("age", True)), self.db.sorts)
+        self.db.update("4", {"city": "viseu"})
+        self.assertEqual(self.db.sort(keys, sortby), ["2", "3", "1", "4"])
+        self.assertEqual(self.db.sort(keys, sortby), ["2", "3", "1", "4"])
+        # Returned documents are read-only, in place changes are not seen
+        # until they go through update
+        self.db.get("4")["city"] = "aveiro"
+        self.assertEqual(self.db.sort(keys, sortby), ["2", "3", "1", "4"])
+        self.db.update("4", {"city": "aveiro"})
+        self.assertEqual(self.db.sort(keys, sortby), ["4", "2", "3", "1"])
+        # Mixed types never raise
+        self.db.clear()
+        values = ["b", 2, None, [1, "a"], {"x": 1}, True, "a", 1.5, [1]]
+        for key, value in enumerate(values):
+            self.db.insert({"value": value}, str(key))
+        keys = self.db.getallkeys()
+        expected = ["2", "5", "7", "1", "6", "0", "8", "3", "4"]
+        self.assertEqual(self.db.sort(keys, "value"), expected)
+        self.assertEqual(self.db.sort(keys, "value", reverse=True), expected[::-1])
+        self.assertEqual(self.db.sort(keys, [("value", "asc"), ("other", "asc")]), [])
 
     def test_findtext(self):
         with self.assertRaises(TypeError):
@@ -250,6 +426,23 @@ class testdbj(unittest.TestCase):
         self.assertEqual(self.db.findtext("name", "andre", inverse=True), [])
         self.assertEqual(self.db.findtext("name", "andré", asc=False), ["1"])
         self.assertEqual(self.db.findtext("name", "André", exact=True, sens=True), ["1"])
+        self.db.insert({"address": {"city": "Porto"}}, "5")
+        self.db.insert({"address": {"city": "Lisboa"}}, "6")
+        self.assertEqual(self.db.findtext("address.city", "porto", exact=True), ["5"])
+        self.assertEqual(self.db.findtext("address.city", "porto", inverse=True), ["6"])
+
+    def test_findtext_rank(self):
+        with self.assertRaises(TypeError):
+            self.db.findtext("text", "test", rank=1)
+        self.db.insert({"text": "red shoes and a red hat"}, "1")
+        self.db.insert({"text": "blue shoes"}, "2")
+        self.db.insert({"text": "red red red car"}, "3")
+        self.db.insert({"text": "shoes"}, "4")
+        self.assertEqual(self.db.findtext("text", "red", rank=True), ["3", "1"])
+        self.assertEqual(self.db.findtext("text", "shoes", rank=True), ["1", "2", "4"])
+        self.db.createtextindex("text")
+        self.assertEqual(self.db.findtext("text", "red", rank=True), ["3", "1"])
+        self.assertEqual(self.db.findtext("text", "red shoes", rank=True), ["1"])
 
     def test_findnum(self):
         with self.assertRaises(TypeError):
@@ -270,6 +463,10 @@ class testdbj(unittest.TestCase):
         self.assertEqual(self.db.findnum("age >= 18"), ["1"])
         self.assertEqual(self.db.findnum("salary == 10000"), [])
         self.assertEqual(self.db.findnum("age > 10"), ["1"])
+        self.db.insert({"age": None}, "3")
+        self.db.insert({"stats": {"score": 7}}, "4")
+        self.assertEqual(self.db.findnum("age < 18"), ["2"])
+        self.assertEqual(self.db.findnum("stats.score >= 7"), ["4"])
 
     def test_find(self):
         with self.assertRaises(TypeError):
@@ -315,6 +512,8 @@ class testdbj(unittest.TestCase):
         query = 'name ?= ""Bob "B""" and age >= 30'
         self.assertEqual(self.db.find(query), ["3"])
         query = 'name == "andre" or name ?= "bob" and age > 18'
+        self.assertEqual(self.db.find(query), ["1", "3"])
+        query = '(name == "andre" or name ?= "bob") and age > 18'
         self.assertEqual(self.db.find(query), ["3"])
         query = 'name == "andre" or name == "ana" or name == "bob"'
         self.assertEqual(self.db.find(query), ["1"])
@@ -323,6 +522,906 @@ class testdbj(unittest.TestCase):
         self.assertEqual(self.db.find(query, sortby="age"), ["2", "4", "3"])
         self.assertEqual(self.db.find(query, sortby="age", reverse=True), ["3", "4", "2"])
 
+    def test_find_operators(self):
+        with self.assertRaises(TypeError):
+            self.db.find('(name == "Ana"')
+        with self.assertRaises(TypeError):
+            self.db.find('name == "Ana")')
+        with self.assertRaises(TypeError):
+            self.db.find('name in "Ana"')
+        with self.assertRaises(TypeError):
+            self.db.find("age between 1 or 2")
+        with self.assertRaises(TypeError):
+            self.db.find('age between "1" and 2')
+        with self.assertRaises(TypeError):
+            self.db.find('name regex "("')
+        with self.assertRaises(TypeError):
+            self.db.find("name startswith 1")
+        with self.assertRaises(TypeError):
+            self.db.find('name == "Ana')
+        docs = [
+            {"name": "André", "age": 10, "status": "new"},
+            {"name": "andre silva", "age": 18, "status": "open"},
+            {"name": "Bob", "age": 30, "status": "closed"},
+            {"name": "Emma", "age": "20"},
+        ]
+        for i, doc in enumerate(docs):
+            self.db.insert(doc, str(i + 1))
+        self.assertEqual(self.db.find('status in ("NEW", "open")'), ["1", "2"])
+        self.assertEqual(self.db.find("age in (10, 20)"), ["1", "4"])
+        self.assertEqual(self.db.find("age between 18 and 20"), ["2", "4"])
+        self.assertEqual(self.db.find("status exists"), ["1", "2", "3"])
+        self.assertEqual(self.db.find('name startswith "andre"'), ["1", "2"])
+        self.assertEqual(self.db.find('name startswith "andre"', asc=False), ["2"])
+        self.assertEqual(self.db.find('name regex "^b.b$"'), ["3"])
+        self.assertEqual(self.db.find('name regex "^b.b$"', sens=True), [])
+        query = '(age < 15 or age > 25) and (status == "new" or status == "closed")'
+        self.assertEqual(self.db.find(query), ["1", "3"])
+        query = 'name == "emma" or (age >= 18 and (status exists and status != "open"))'
+        self.assertEqual(self.db.find(query), ["3", "4"])
+        self.assertEqual(self.db.find('(name == "bob")'), ["3"])
+
+    def test_find_indexed(self):
+        docs = [
+            {"name": "André", "age": 10, "status": "new"},
+            {"name": "andre silva", "age": 18, "status": "open"},
+            {"name": "Bob", "age": 30, "status": "closed"},
+            {"name": "Emma", "age": "20", "tags": ["a"]},
+        ]
+        queries = [
+            ('status in ("NEW", "open", "New")', False),
+            ("age in (10, 20)", False),
+            ("age between 18 and 20", False),
+            ("age < 18 or age >= 30", False),
+            ("age == 18", False),
+            ("age != 18", False),
+            ("tags exists", False),
+            ('name startswith "andre"', False),
+            ('name startswith "andre"', True),
+            ('name == "andre"', False),
+            ('name == "andre"', True),
+            ('name regex "^b.b$"', False),
+            ('age > 15 and status != "open"', False),
+            ('age > 15 and name ?= "e"', False),
+            ('(age > 15 or name ?= "e") and status exists', False),
+            ("age == nan", False),
+            ("age < nan", False),
+            ("age != nan", False),
+            ("age between nan and 50", False),
+            ("age in (nan, 10)", False),
+        ]
+        for i, doc in enumerate(docs):
+            self.db.insert(doc, str(i + 1))
+        expected = [sorted(self.db.find(query, sens=sens)) for query, sens in queries]
+        for field in ("name", "age", "status", "tags"):
+            self.db.createindex(field)
+        for (query, sens), keys in zip(queries, expected):
+            self.assertEqual(sorted(self.db.find(query, sens=sens)), keys, query)
+
+    def _insert_people(self):
+        docs = [
+            {"name": "Ana", "age": 10, "city": "Porto", "stats": {"score": 3}},
+            {"name": "Bia", "age": 30, "city": "Lisboa", "stats": {"score": 9}},
+            {"name": "Eva", "age": "20", "city": "Porto"},
+            {"name": "Leo", "age": "unknown", "city": ["Porto"]},
+        ]
+        for i, doc in enumerate(docs):
+            self.db.insert(doc, str(i + 1))
+
+    def test_count(self):
+        self.assertEqual(self.db.count(), 0)
+        self._insert_people()
+        with self.assertRaises(TypeError):
+            self.db.count(1)
+        self.assertEqual(self.db.count(), 4)
+        self.assertEqual(self.db.count('city == "porto"'), 2)
+        self.db.createindex("city")
+        self.assertEqual(self.db.count('city == "porto"'), 2)
+        self.assertEqual(self.db.count('city == "porto" and age > 15'), 1)
+
+    def test_distinct(self):
+        with self.assertRaises(TypeError):
+            self.db.distinct(1)
+        self._insert_people()
+        self.assertEqual(self.db.distinct("city"), ["Porto", "Lisboa", ["Porto"]])
+        self.assertEqual(self.db.distinct("city", "age < 25"), ["Porto"])
+        self.assertEqual(self.db.distinct("stats.score"), [3, 9])
+        self.db.createindex("city")
+        self.assertEqual(self.db.distinct("city"), ["Porto", "Lisboa", ["Porto"]])
+
+    def test_groupby(self):
+        with self.assertRaises(TypeError):
+            self.db.groupby(1)
+        with self.assertRaises(TypeError):
+            self.db.groupby("city", agg=[])
+        with self.assertRaises(TypeError):
+            self.db.groupby("city", agg={"x": ("median", "age")})
+        with self.assertRaises(TypeError):
+            self.db.groupby("city", agg={"x": "sum"})
+        self._insert_people()
+        self.assertEqual(self.db.groupby("city"), {"Porto": {"count": 2}, "Lisboa": {"count": 1}})
+        agg = {"n": "count", "avg": ("avg", "age"), "max": ("max", "age"), "scores": ("count", "stats")}
+        expected = {
+            "Porto": {"n": 2, "avg": 15.0, "max": 20.0, "scores": 1},
+            "Lisboa": {"n": 1, "avg": 30, "max": 30, "scores": 1},
+        }
+        self.assertEqual(self.db.groupby("city", agg), expected)
+        self.assertEqual(self.db.groupby("city", query="age > 15"), {"Porto": {"count": 1}, "Lisboa": {"count": 1}})
+        self.db.createindex("city")
+        self.assertEqual(self.db.groupby("city"), {"Porto": {"count": 2}, "Lisboa": {"count": 1}})
+
+    def test_min(self):
+        self.assertFalse(self.db.min("age"))
+        self._insert_people()
+        self.assertEqual(self.db.min("age"), 10)
+        self.assertEqual(self.db.min("age", 'city == "lisboa"'), 30)
+        self.db.createindex("age")
+        self.assertEqual(self.db.min("age"), 10)
+
+    def test_max(self):
+        self.assertFalse(self.db.max("age"))
+        self._insert_people()
+        self.assertEqual(self.db.max("stats.score"), 9)
+        self.assertEqual(self.db.max("age", 'city == "porto"'), 20.0)
+        self.db.createindex("age")
+        self.assertEqual(self.db.max("age"), 30)
+
+    def test_sum(self):
+        with self.assertRaises(TypeError):
+            self.db.sum(1)
+        self.assertEqual(self.db.sum("age"), 0)
+        self._insert_people()
+        self.assertEqual(self.db.sum("age"), 60.0)
+        self.db.createindex("age")
+        self.assertEqual(self.db.sum("age"), 60.0)
+
+    def test_avg(self):
+        self.assertFalse(self.db.avg("age"))
+        self._insert_people()
+        self.assertEqual(self.db.avg("age"), 20.0)
+        self.assertEqual(self.db.avg("age", "age < 25"), 15.0)
+        self.db.createindex("age")
+        self.assertEqual(self.db.avg("age"), 20.0)
+
+    def test_createcolumn(self):
+        with self.assertRaises(TypeError):
+            self.db.createcolumn(1)
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", columns=[1])
+        docs = [
+            {"age": 18, "stats": {"score": 2.5}},
+            {"age": 10, "stats": {"score": 9}},
+            {"age": 30},
+            {"age": 10},
+            {"name": "none"},
+        ]
+        for i, doc in enumerate(docs):
+            self.db.insert(doc, str(i + 1))
+        queries = ["age > 10", "age <= 18", "age == 10", "age != 10", "age in (10, 30)", "age between 11 and 30"]
+        queries += ["stats.score < 5", "age > 10 and stats.score > 1"]
+        expected = [sorted(self.db.find(query)) for query in queries]
+        sorted_keys = self.db.sort(self.db.getallkeys(), "age")
+        self.assertTrue(self.db.createcolumn("age"))
+        self.assertFalse(self.db.createcolumn("age"))
+        self.assertTrue(self.db.createcolumn("stats.score"))
+        for _ in range(2):
+            for query, keys in zip(queries, expected):
+                self.assertEqual(sorted(self.db.find(query)), keys, query)
+        self.assertEqual(self.db.sort(self.db.getallkeys(), "age"), sorted_keys)
+        self.assertEqual(self.db.sort(self.db.getallkeys(), "age", reverse=True), sorted_keys[::-1])
+        self.assertEqual(self.db.sort(["3", "1"], "age"), ["1", "3"])
+        self.assertEqual(self.db.min("age"), 10)
+        self.assertEqual(self.db.max("age"), 30)
+        self.assertEqual(self.db.sum("age"), 68)
+        self.db.update("3", {"age": 5})
+        self.db.delete("1")
+        self.db.insert({"age": 40}, "6")
+        self.assertEqual(sorted(self.db.findnum("age > 8")), ["2", "4", "6"])
+        self.assertEqual(self.db.sort(self.db.getallkeys(), "age"), ["3", "2", "4", "6"])
+        self.db.insert({"age": "7"}, "7")
+        self.assertEqual(sorted(self.db.findnum("age < 8")), ["3", "7"])
+        # NaN is not equal to any number, like in the scan
+        self.db.insert({"age": "nan"}, "8")
+        self.assertEqual(sorted(self.db.findnum("age != 5")), ["2", "4", "6", "7", "8"])
+        self.assertEqual(self.db.count("age != 5"), 5)
+        self.db.dropcolumn("age")
+        self.assertEqual(sorted(self.db.findnum("age != 5")), ["2", "4", "6", "7", "8"])
+        self.assertEqual(self.db.count("age != 5"), 5)
+        self.db.createcolumn("age")
+        self.db.update("8", {"age": 5})
+        self.assertEqual(sorted(self.db.findnum("age != 5")), ["2", "4", "6", "7"])
+        # NaN bounds match like in the scan
+        queries = ["age == nan", "age < nan", "age >= nan", "age != nan", "age between nan and 50", "age in (nan, 4)"]
+        self.db.dropcolumn("age")
+        expected = [sorted(self.db.find(query)) for query in queries]
+        self.assertEqual(expected[3], ["2", "3", "4", "6", "7", "8"])
+        self.db.createcolumn("age")
+        for _ in range(2):
+            for query, keys in zip(queries, expected):
+                self.assertEqual(sorted(self.db.find(query)), keys, query)
+        self.db.clear()
+        self.assertEqual(self.db.findnum("age > 0"), [])
+        db = dbj("tests_dbj.db", columns=["age"])
+        db.insert({"age": 18}, "1")
+        self.assertEqual(db.findnum("age >= 18"), ["1"])
+
+    def test_dropcolumn(self):
+        with self.assertRaises(TypeError):
+            self.db.dropcolumn(1)
+        self.db.createcolumn("age")
+        self.assertTrue(self.db.dropcolumn("age"))
+        self.assertFalse(self.db.dropcolumn("age"))
+
+    def test_getcolumns(self):
+        self.assertEqual(self.db.getcolumns(), [])
+        self.db.createcolumn("age")
+        self.assertEqual(self.db.getcolumns(), ["age"])
+
+    def test_createtextindex(self):
+        with self.assertRaises(TypeError):
+            self.db.createtextindex(1)
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", textindexes=[1])
+        docs = [
+            {"name": "André", "info": {"text": "Café com leite"}},
+            {"name": "andre silva", "info": {"text": "CAFE"}},
+            {"name": "Bob", "info": {"text": "no coffee"}},
+            {"name": 30},
+            {"name": "Ana"},
+        ]
+        for i, doc in enumerate(docs):
+            self.db.insert(doc, str(i + 1))
+        searches = [
+            ("name", "andre", False, False, False),
+            ("name", "andré", False, False, False),
+            ("name", "andré", False, False, True),
+            ("name", "Andre", False, True, True),
+            ("name", "an", False, False, False),
+            ("name", "andre", True, False, False),
+            ("name", "andre", False, False, True),
+            ("info.text", "cafe", True, False, False),
+            ("info.text", "café com", False, True, False),
+            ("info.text", "xyz", False, False, False),
+        ]
+        queries = ['name ?= "silva"', 'name startswith "and"', 'name == "ana"', 'name != "an"']
+        expected = [sorted(self.db.findtext(f, t, exact=e, sens=s, asc=not a)) for f, t, e, s, a in searches]
+        expected_find = [sorted(self.db.find(query)) for query in queries]
+        self.assertTrue(self.db.createtextindex("name"))
+        self.assertFalse(self.db.createtextindex("name"))
+        self.assertTrue(self.db.createtextindex("info.text"))
+        for (f, t, e, s, a), keys in zip(searches, expected):
+            self.assertEqual(sorted(self.db.findtext(f, t, exact=e, sens=s, asc=not a)), keys, t)
+        for query, keys in zip(queries, expected_find):
+            self.assertEqual(sorted(self.db.find(query)), keys, query)
+        self.db.update("2", {"name": "Bia"})
+        self.db.delete("1")
+        self.assertEqual(self.db.findtext("name", "andre"), [])
+        self.assertEqual(self.db.findtext("name", "bi"), ["2"])
+        self.db.save()
+        db = dbj("tests_dbj.db", textindexes=["name"])
+        self.assertEqual(db.textindexes["name"].texts, self.db.textindexes["name"].texts)
+        self.assertEqual(db.findtext("name", "bob"), ["3"])
+        self.db.insert({"name": "Bobby"}, "6")
+        self.db.save()
+        self.db.clear()
+        self.assertEqual(self.db.findtext("name", "bob"), [])
+        db = dbj("tests_dbj.db", textindexes=["name"])
+        self.assertEqual(sorted(db.findtext("name", "bob")), ["3", "6"])
+
+    def test_droptextindex(self):
+        with self.assertRaises(TypeError):
+            self.db.droptextindex(1)
+        self.db.createtextindex("name")
+        self.assertTrue(self.db.droptextindex("name"))
+        self.assertFalse(self.db.droptextindex("name"))
+
+    def test_gettextindexes(self):
+        self.assertEqual(self.db.gettextindexes(), [])
+        self.db.createtextindex("name")
+        self.assertEqual(self.db.gettextindexes(), ["name"])
+
+    def test_explain(self):
+        with self.assertRaises(TypeError):
+            self.db.explain(1)
+        with self.assertRaises(TypeError):
+            self.db.explain("age > 1", sortby=1)
+        self._insert_people()
+        r = self.db.explain('city == "porto" and age > 15', sortby="age")
+        self.assertEqual(r["access"], "full scan")
+        self.assertEqual((r["estimated"], r["examined"], r["matched"]), (4, 4, 1))
+        self.assertEqual(r["plan"]["operator"], "and")
+        city, age = r["plan"]["children"]
+        self.assertEqual(city["field"], "city")
+        self.assertEqual((city["access"], city["evaluated"], city["matched"]), ("full scan", 4, 2))
+        self.assertEqual((age["access"], age["evaluated"], age["matched"]), ("full scan", 2, 1))
+        self.assertEqual(r["plan"]["evaluated"], 4)
+        self.assertEqual(set(r["time"]), {"plan", "scan", "sort", "total"})
+        self.db.createindex("city")
+        r = self.db.explain('city == "porto" and age > 15')
+        self.assertEqual(r["access"], "index candidates")
+        self.assertEqual((r["estimated"], r["examined"], r["matched"]), (2, 2, 1))
+        city, age = r["plan"]["children"]
+        self.assertEqual((city["access"], city["keys"]), ("index", 2))
+        self.assertEqual(r["plan"]["inputs"], [2])
+        self.db.createcolumn("age")
+        r = self.db.explain('city == "porto" and age between 15 and 25')
+        self.assertEqual(r["access"], "index")
+        self.assertEqual((r["estimated"], r["examined"], r["matched"]), (1, 0, 1))
+        self.assertEqual(r["plan"]["children"][1]["access"], "column")
+        self.assertEqual(r["plan"]["children"][1]["value"], [15, 25])
+        self.assertEqual(r["plan"]["inputs"], [1, 2])
+        r = self.db.explain('name ?= "a" or age > 15')
+        self.assertEqual(r["access"], "full scan")
+        self.assertEqual(r["plan"]["children"][1]["keys"], 2)
+        self.assertEqual((r["estimated"], r["examined"]), (4, 4))
+        # The estimate comes from the key counts, before the scan
+        r = self.db.explain('(city == "porto" or age < 15) and name ?= "a"')
+        self.assertEqual(r["access"], "index candidates")
+        self.assertEqual(r["plan"]["children"][0]["inputs"], [2, 1])
+        self.assertEqual(r["estimated"], 3)
+        self.assertEqual(r["plan"]["children"][1]["evaluated"], r["examined"])
+        self.assertEqual(self.db.explain("age > 15")["matched"], len(self.db.find("age > 15")))
+
+    def test_find_nested(self):
+        self.db.insert({"name": "Ana", "address": {"city": "Porto"}, "stats": {"score": 3}}, "1")
+        self.db.insert({"name": "Bia", "address": {"city": "Lisboa"}, "stats": {"score": 9}}, "2")
+        self.db.insert({"name": "Eva", "address": {"city": "Porto"}, "stats": {"score": 5}}, "3")
+        self.db.insert({"name": "Leo", "address": "Porto"}, "4")
+        self.db.insert({"a.b": "literal"}, "5")
+        r = self.db.find('address.city == "porto"')
+        r.sort()
+        self.assertEqual(r, ["1", "3"])
+        query = 'address.city == "porto" and stats.score > 3'
+        self.assertEqual(self.db.find(query), ["3"])
+        self.assertEqual(self.db.find("stats.score > 0", sortby="stats.score"), ["1", "3", "2"])
+        self.assertEqual(self.db.find('a.b == "literal"'), ["5"])
+
+    def test_createindex(self):
+        with self.assertRaises(TypeError):
+            self.db.createindex(1)
+        self.db.insert({"name": "Ana", "address": {"city": "Porto"}}, "1")
+        self.db.insert({"name": "Bia", "address": {"city": "Lisboa"}, "tags": ["a"]}, "2")
+        self.assertTrue(self.db.createindex("address.city"))
+        self.assertFalse(self.db.createindex("address.city"))
+        self.assertTrue(self.db.createindex("tags"))
+        self.db.insert({"name": "Eva", "address": {"city": "Porto"}}, "3")
+        r = self.db.find('address.city == "porto"')
+        r.sort()
+        self.assertEqual(r, ["1", "3"])
+        self.db.update("1", {"address": {"city": "Braga"}})
+        self.assertEqual(self.db.find('address.city == "porto"'), ["3"])
+        self.assertEqual(self.db.findtext("address.city", "braga"), ["1"])
+        self.db.delete("3")
+        self.assertEqual(self.db.find('address.city == "porto"'), [])
+        self.assertEqual(self.db.findtext("tags", "a"), [])
+        self.db.clear()
+        self.assertEqual(self.db.findtext("address.city", "braga"), [])
+        db = dbj("tests_dbj.db", indexes=["age"])
+        db.insert({"age": 18}, "1")
+        db.insert({"age": "30"}, "2")
+        self.assertEqual(db.findnum("age > 10"), ["1", "2"])
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", indexes=[1])
+
+    def test_dropindex(self):
+        with self.assertRaises(TypeError):
+            self.db.dropindex(1)
+        self.db.createindex("name")
+        self.assertTrue(self.db.dropindex("name"))
+        self.assertFalse(self.db.dropindex("name"))
+
+    def test_getindexes(self):
+        self.assertEqual(self.db.getindexes(), [])
+        self.db.createindex("name")
+        self.db.createindex("address.city")
+        self.assertEqual(self.db.getindexes(), ["name", "address.city"])
+
+    def test_ttl(self):
+        with self.assertRaises(TypeError):
+            self.db.insert({"a": 1}, ttl=0)
+        with self.assertRaises(TypeError):
+            self.db.insert({"a": 1}, ttl=True)
+        with self.assertRaises(TypeError):
+            self.db.insertmany([{"a": 1}], ttl="1")
+        self.assertEqual(self.db.size(), 0)
+        self.db.createindex("a")
+        self.db.insert({"a": 1}, "1", ttl=0.05)
+        self.db.insert({"a": 1}, "2", ttl=60)
+        self.db.insert({"a": 1}, "3")
+        self.assertTrue(0 < self.db.getttl("1") <= 0.05)
+        self.assertFalse(self.db.getttl("3"))
+        self.assertFalse(self.db.getttl("4"))
+        self.assertTrue(self.db.update("2", {"b": 2}))
+        self.assertTrue(self.db.getttl("2") > 59)
+        self.db.save()
+        time.sleep(0.06)
+        # Reloading drops the documents expired while closed
+        self.assertEqual(dbj("tests_dbj.db").getallkeys(), ["2", "3"])
+        self.assertFalse(self.db.get("1"))
+        self.assertEqual(sorted(self.db.find("a == 1")), ["2", "3"])
+        self.assertEqual(self.db.size(), 2)
+        self.assertTrue(self.db.setttl("3", 0.01))
+        self.assertTrue(self.db.setttl("2", None))
+        self.assertFalse(self.db.getttl("2"))
+        self.assertFalse(self.db.setttl("4", 1))
+        time.sleep(0.02)
+        self.assertEqual(self.db.getallkeys(), ["2"])
+        self.db.insert({"a": 1}, "5", ttl=60)
+        self.db.save()
+        self.db = dbj("tests_dbj.db")
+        self.assertTrue(self.db.getttl("5") > 59)
+        self.db.insert({"a": 1}, "5")
+        self.assertFalse(self.db.getttl("5"))
+        self.db.save()
+        self.assertFalse(os.path.exists("tests_dbj.db.ttl"))
+        # The saved text index does not keep the documents expired while closed
+        db = dbj("tests_dbj.db", textindexes=["name"])
+        db.insert({"name": "Ana Lima"}, "6", ttl=0.05)
+        db.insert({"name": "Bia Lima"}, "7")
+        db.save()
+        time.sleep(0.06)
+        db = dbj("tests_dbj.db", textindexes=["name"])
+        self.assertEqual(db.findtext("name", "lima"), ["7"])
+        self.assertEqual(db.find('name ?= "lima"'), ["7"])
+
+    def test_max_documents(self):
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", max_documents=0)
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", max_memory=1.5)
+        db = dbj("tests_dbj.db", max_documents=2, indexes=["name"], metrics=True)
+        for i in range(5):
+            db.insert({"name": "user{}".format(i), "age": i, "tags": ["a\nb"]}, str(i))
+        self.assertEqual(list(db.cache.resident), ["3", "4"])
+        self.assertEqual(db.get("0")["age"], 0)
+        self.assertEqual(list(db.cache.resident), ["4", "0"])
+        self.assertEqual(db.getfirst()["name"], "user0")
+        self.assertEqual(db.getlast()["name"], "user4")
+        self.assertEqual(db.getallkeys(), ["0", "1", "2", "3", "4"])
+        self.assertEqual(db.find("age >= 2"), ["2", "3", "4"])
+        self.assertEqual(db.find('name == "user1"'), ["1"])
+        self.assertEqual(db.sort(["3", "1", "2"], "age", reverse=True), ["3", "2", "1"])
+        self.assertEqual(db.sum("age"), 10)
+        self.assertTrue(db.update("1", {"age": 10}))
+        self.assertEqual(db.findall("age > 5"), [{"name": "user1", "age": 10, "tags": ["a\nb"]}])
+        self.assertEqual(db.popfirst()["name"], "user0")
+        self.assertTrue(db.delete("2"))
+        cache = db.stats()["cache"]
+        self.assertEqual(cache["resident"], 1)
+        self.assertEqual(cache["spilled"], 2)
+        self.assertTrue(cache["hits"] > 0)
+        self.assertTrue(cache["misses"] > 0)
+        # The saved file is the same as without the memory limit
+        for indent in (None, 2):
+            db.save(indent=indent)
+            with open("tests_dbj.db") as f:
+                bounded = f.read()
+            json.dump(dict(dbj("tests_dbj.db").db), open("tests_dbj.db", "w"), indent=indent)
+            with open("tests_dbj.db") as f:
+                self.assertEqual(bounded, f.read())
+        db = dbj("tests_dbj.db", max_memory=80)
+        self.assertEqual(len(db.cache.resident), 1)
+        self.assertEqual(db.size(), 3)
+        # A document larger than max_memory is updated without being lost
+        big = dbj("tests_dbj.db", max_memory=10)
+        self.assertTrue(big.update("4", {"$push": {"tags": "c"}, "$set": {"age": 40}}))
+        self.assertEqual(big.get("4"), {"name": "user4", "age": 40, "tags": ["a\nb", "c"]})
+        self.assertEqual(big.cache.snapshot()["resident"], 0)
+        self.assertEqual(big.find("age == 40"), ["4"])
+        big.cache.close()
+        # Each instance has its own segment, never left on disk
+        other = dbj("tests_dbj.db", max_documents=1)
+        other.update("3", {"age": 30})
+        self.assertEqual([doc["age"] for doc in db.getall()], [10, 3, 4])
+        self.assertEqual([doc["age"] for doc in other.getall()], [10, 30, 4])
+        self.assertFalse([name for name in os.listdir(".") if name.endswith(".spill")])
+        self.assertTrue(db.clear())
+        other.cache.close()
+        self.assertIsNone(other.cache.file)
+
+    def test_changes(self):
+        with self.assertRaises(TypeError):
+            self.db.subscribe(1)
+        with self.assertRaises(TypeError):
+            self.db.changes("1")
+        events = []
+        self.assertTrue(self.db.subscribe(events.append))
+        self.db.insert({"name": "Ana"}, "1")
+        self.db.update("1", {"age": 10})
+        self.db.insert({"name": "Bia"}, "2")
+        self.db.pop("2")
+        self.db.clear()
+        changes = [(1, "insert", "1"), (2, "update", "1"), (3, "insert", "2"), (4, "delete", "2"), (5, "clear", None)]
+        self.assertEqual([(e["seq"], e["op"], e["key"]) for e in events], changes)
+        self.assertEqual(events[1]["document"], {"name": "Ana", "age": 10})
+        self.assertEqual(self.db.changes(3), events[3:])
+        self.assertEqual(self.db.changes(5), [])
+        self.assertTrue(self.db.unsubscribe(events.append))
+        self.assertFalse(self.db.unsubscribe(events.append))
+        self.db.insert({"name": "Ana"}, "1")
+        self.assertEqual(len(events), 5)
+        self.db.changelog = collections.deque(self.db.changelog, maxlen=2)
+        self.db.delete("1")
+        self.assertEqual([e["seq"] for e in self.db.changes(5)], [6, 7])
+        self.assertFalse(self.db.changes(4))
+
+    def test_changes_snapshot(self):
+        events = []
+        self.db.subscribe(events.append)
+        self.db.insert({"n": 1, "tags": ["a"]}, "k")
+        self.db.update("k", {"$inc": {"n": 1}})
+        self.db.update("k", {"$inc": {"n": 1}, "$push": {"tags": "b"}})
+        self.db.update("k", {"$push": {"tags": "c"}})
+        expected = [
+            {"n": 1, "tags": ["a"]},
+            {"n": 2, "tags": ["a"]},
+            {"n": 3, "tags": ["a", "b"]},
+            {"n": 3, "tags": ["a", "b", "c"]},
+        ]
+        self.assertEqual([e["document"] for e in self.db.changes(0)], expected)
+        self.assertEqual([e["document"] for e in events], expected)
+        # Events are copies, changing one does not change the history
+        events[0]["document"]["tags"].append("x")
+        self.assertEqual(self.db.changes(0)[0]["document"], expected[0])
+        # No copies are kept without a changelog
+        db = dbj("tests_dbj.db")
+        db.changelog = collections.deque(maxlen=0)
+        db.insert({"n": 1}, "k")
+        db.update("k", {"n": 2})
+        self.assertEqual((db.seq, db.changes(2), db.shared), (2, [], {}))
+
+    def test_watch(self):
+        self.db.insert({"name": "Ana"}, "1")
+
+        async def consume():
+            watch = self.db.watch(since=0)
+            first = await watch.__anext__()
+            self.db.delete("1")
+            second = await watch.__anext__()
+            await watch.aclose()
+            return first, second
+
+        first, second = asyncio.run(consume())
+        self.assertEqual((first["seq"], first["op"]), (1, "insert"))
+        self.assertEqual((second["seq"], second["op"]), (2, "delete"))
+        self.assertEqual(self.db.subscribers, [])
+
+    def test_serve(self):
+        self.db.insert({"name": "Ana", "age": 18}, "1")
+        self.db.save()
+        command = [sys.executable, "-m", "dbj", "serve", "tests_dbj.db", "--socket", "tests_dbj.sock"]
+        if os.path.exists("tests_dbj.sock"):
+            os.remove("tests_dbj.sock")
+        server = subprocess.Popen(command + ["--indexes", "name"])
+        try:
+            for _ in range(500):
+                if os.path.exists("tests_dbj.sock"):
+                    break
+                time.sleep(0.01)
+            with DbjClient("tests_dbj.sock", pool_size=2) as client:
+                self.assertEqual(client.get("1"), {"name": "Ana", "age": 18})
+                self.assertEqual(client.insert({"name": "Bia", "age": 30}, "2"), "2")
+                self.assertEqual(client.find('name == "bia"'), ["2"])
+                self.assertEqual(client.getindexes(), ["name"])
+                self.assertFalse(client.get("3"))
+                with self.assertRaises(TypeError):
+                    client.insert("Ana")
+                with self.assertRaises(TypeError):
+                    client.call("addhook", "pre", "print")
+                with self.assertRaises(AttributeError):
+                    client.subscribe
+                results = client.batch([("update", ["1", {"$inc": {"age": 1}}]), ("get", ["1"], {"fields": ["age"]})])
+                self.assertEqual(results, [True, {"age": 19}])
+                with self.assertRaises(TypeError):
+                    client.batch([("delete", ["2"]), ("get", [])])
+                self.assertFalse(client.exists("2"))
+                # Concurrent clients share the pooled connections
+                threads = [
+                    threading.Thread(target=lambda i=i: client.insert({"name": "T", "age": i}, "t" + str(i)))
+                    for i in range(8)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(client.count('name == "t"'), 8)
+                self.assertLessEqual(len(client.pool), 2)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(10)
+        self.assertFalse(os.path.exists("tests_dbj.sock"))
+        self.db.load()
+        self.assertEqual(self.db.size(), 9)
+        self.assertEqual(self.db.get("1")["age"], 19)
+
+    def test_import_export(self):
+        with open("tests_dbj.jsonl", "w") as f:
+            f.write('{"id": "1", "name": "Ana", "age": 18}\n\n{"id": "2", "name": "Bia", "tags": ["a"]}\n')
+        with self.assertRaises(TypeError):
+            self.db.import_jsonl("tests_dbj.jsonl", key=1)
+        with self.assertRaises(TypeError):
+            self.db.import_jsonl("tests_dbj.jsonl", workers=0)
+        with self.assertRaises(TypeError):
+            self.db.import_jsonl("tests_dbj.jsonl", key="name2")
+        self.assertEqual(self.db.size(), 0)
+        self.db.autosave = True
+        self.assertEqual(self.db.import_jsonl("tests_dbj.jsonl", key="id"), 2)
+        self.db.autosave = False
+        self.assertEqual(self.db.get("2"), {"name": "Bia", "tags": ["a"]})
+        self.assertEqual(dbj("tests_dbj.db").size(), 2)
+        # Parallel parsing keeps the order, errors report the line
+        self.db.clear()
+        self.db.import_chunk_size = 1
+        self.assertEqual(self.db.import_jsonl("tests_dbj.jsonl", key="id", workers=2), 2)
+        self.assertEqual(self.db.getallkeys(), ["1", "2"])
+        with open("tests_dbj.jsonl", "a") as f:
+            f.write("[1]\n")
+        with self.assertRaisesRegex(TypeError, "line 4"):
+            self.db.import_jsonl("tests_dbj.jsonl", workers=2)
+        self.assertEqual(self.db.export_jsonl("tests_dbj.jsonl", query="age > 1", key="id"), 1)
+        with open("tests_dbj.jsonl") as f:
+            self.assertEqual([json.loads(line) for line in f], [{"id": "1", "name": "Ana", "age": 18}])
+        # Csv
+        self.assertEqual(self.db.export_csv("tests_dbj.csv", key="id"), 2)
+        with open("tests_dbj.csv") as f:
+            self.assertEqual(f.read().splitlines(), ["id,name,age,tags", "1,Ana,18,", '2,Bia,,"[""a""]"'])
+        self.db.clear()
+        with self.assertRaisesRegex(TypeError, "row 2"):
+            self.db.import_csv("tests_dbj.csv", key="id", types={"age": int, "name": int})
+        self.assertEqual(self.db.import_csv("tests_dbj.csv", key="id", types={"age": int}), 2)
+        self.assertEqual(self.db.get("1"), {"name": "Ana", "age": 18})
+        self.assertEqual(self.db.get("2"), {"name": "Bia", "tags": '["a"]'})
+        db = dbj("tests_dbj.db", schema={"name": str, "age": (int, False), "tags": (str, False)})
+        self.assertEqual(db.import_csv("tests_dbj.csv", key="id"), 2)
+        self.assertEqual(db.get("1"), {"name": "Ana", "age": 18})
+        self.assertEqual(db.export_csv("tests_dbj.csv", fields=["age"]), 2)
+        with open("tests_dbj.csv") as f:
+            self.assertEqual(f.read().splitlines(), ["age", "18", '""'])
+        os.remove("tests_dbj.jsonl")
+        os.remove("tests_dbj.csv")
+
+    def test_blocks(self):
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", blocks="yes")
+        self.assertFalse(dbj("tests_dbj_missing.db", lazy=True).verify())
+        self.db.save()
+        self.assertEqual(self.db.verify(), {"format": "json", "ok": True})
+        db = dbj("tests_dbj.db", blocks=True, compression="zlib")
+        db.block_size = 100
+        for i in range(10):
+            db.insert({"name": "user{}".format(i), "text": "x" * (50 if i else 2000)}, str(i))
+        db.save()
+        keys = [str(i) for i in range(10)]
+        report = db.verify()
+        self.assertTrue(report["ok"])
+        self.assertEqual(report["blocks"], 6)
+        # The format is kept when opening
+        db = dbj("tests_dbj.db", lazy=True)
+        self.assertEqual(db.peek(), keys)
+        self.assertEqual(db.get("0")["text"], "x" * 2000)
+        self.assertTrue(db.blocks)
+        # Damage the second block
+        with open("tests_dbj.db", "rb") as f:
+            data = bytearray(f.read())
+        offset = json.loads(data[int.from_bytes(data[-20:-12], "big") : -20])[1][0]
+        data[offset + 20] ^= 1
+        with open("tests_dbj.db", "wb") as f:
+            f.write(data)
+        report = db.verify()
+        self.assertEqual(
+            (report["ok"], report["index"], report["damaged"], report["keys"]), (False, True, [1], ["1", "2"])
+        )
+        with self.assertRaises(ValueError):
+            dbj("tests_dbj.db")
+        db = dbj("tests_dbj.db", lazy=True)
+        self.assertEqual(db.peek(), keys)
+        self.assertEqual(db.load(recover=True), ["1", "2"])
+        self.assertEqual(db.getallkeys(), ["0", "3", "4", "5", "6", "7", "8", "9"])
+        # Damaged index, the blocks before the first damaged one are found
+        data[-10] ^= 1
+        with open("tests_dbj.db", "wb") as f:
+            f.write(data)
+        report = db.verify()
+        self.assertEqual((report["ok"], report["index"], report["blocks"]), (False, False, 1))
+        with self.assertRaises(ValueError):
+            db.load()
+        self.assertEqual(dbj("tests_dbj.db", lazy=True).peek(), ["0"])
+        self.assertEqual(db.load(recover=True), [])
+        self.assertEqual(db.getallkeys(), ["0"])
+        # The recovered documents saved back as json
+        db.blocks = False
+        db.save()
+        self.assertEqual(db.verify(), {"format": "json", "ok": True})
+        self.assertEqual(dbj("tests_dbj.db").get("0")["text"], "x" * 2000)
+
+    def test_compression(self):
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", compression="gzip")
+        db = dbj("tests_dbj.db", compression="zlib", indexes=["name"])
+        text = "lorem ipsum " * 200
+        db.insert({"name": "Ana", "text": text}, "1")
+        db.insert({"name": "Bia", "text": "short"}, "2")
+        self.assertIsInstance(db.db["1"], Compressed)
+        self.assertIsInstance(db.db["2"], dict)
+        self.assertEqual(db.get("1"), {"name": "Ana", "text": text})
+        self.assertEqual(db.find('text ?= "lorem"'), ["1"])
+        self.assertEqual(db.find('name == "ana"'), ["1"])
+        self.assertEqual(db.sort(["2", "1"], "name"), ["1", "2"])
+        self.assertTrue(db.update("1", {"$set": {"age": 10}}))
+        self.assertEqual(db.get("1")["age"], 10)
+        db.save()
+        self.assertLess(os.path.getsize("tests_dbj.db"), len(text))
+        # Compressed documents are read back without the codec option
+        db = dbj("tests_dbj.db")
+        self.assertIsInstance(db.db["1"], Compressed)
+        self.assertEqual(db.get("1")["text"], text)
+        self.assertTrue(db.update("1", {"text": "short"}))
+        self.assertIsInstance(db.db["1"], dict)
+        db.save()
+        codec = Codec("reverse", lambda data: data[::-1], lambda data: data[::-1])
+        db = dbj("tests_dbj.db", compression=codec, max_documents=1)
+        db.insert({"name": "Caio", "text": text}, "3")
+        documents = [{"name": "Ana", "text": "short", "age": 10}, {"name": "Bia", "text": "short"}]
+        self.assertEqual(db.getall(), documents + [{"name": "Caio", "text": text}])
+        db.save()
+        self.assertEqual(dbj("tests_dbj.db", compression=codec).get("3")["text"], text)
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db")
+        # A document can not look like a compressed one once saved
+        self.db.insert({"data": "eJwDAAAAAAE="}, "1")
+        with self.assertRaises(TypeError):
+            self.db.insert({"$compressed": "zlib", "data": "eJwDAAAAAAE="}, "2")
+        with self.assertRaises(TypeError):
+            self.db.update("1", {"$set": {"$compressed": "zlib"}})
+        with open("tests_dbj.jsonl", "w") as f:
+            f.write('{"$compressed": "zlib", "data": "eJwDAAAAAAE="}\n')
+        with self.assertRaises(TypeError):
+            self.db.import_jsonl("tests_dbj.jsonl", workers=1)
+        os.remove("tests_dbj.jsonl")
+        self.assertEqual(self.db.getall(), [{"data": "eJwDAAAAAAE="}])
+
+    def test_intern(self):
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", intern=["status", 1])
+        self.assertFalse(self.db.internstats())
+        db = dbj("tests_dbj.db", intern=["status", "address.city"])
+        for i in range(3):
+            document = json.loads('{"status": "open", "address": {"city": "Porto"}, "name": "n%d"}' % i)
+            db.insert(document, str(i))
+        first, second = db.get("0"), db.get("1")
+        self.assertIs(first["status"], second["status"])
+        self.assertIs(first["address"]["city"], second["address"]["city"])
+        self.assertIsNot(first["name"], second["name"])
+        self.assertIs(next(iter(first)), next(iter(second)))
+        stats = db.internstats()
+        self.assertEqual(stats["strings"], 6)
+        self.assertEqual(stats["replaced"], 2 * 6)
+        self.assertTrue(stats["bytes_saved"] > 0)
+        db.update("2", {"status": "".join(["clo", "sed"])})
+        db.update("1", {"status": "".join(["clo", "sed"])})
+        self.assertIs(db.get("1")["status"], db.get("2")["status"])
+        db.save()
+        db = dbj("tests_dbj.db", intern=["status"])
+        self.assertIs(db.get("1")["status"], db.get("2")["status"])
+        self.assertEqual(db.find('status == "closed"'), ["1", "2"])
+
+    def test_schema(self):
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", schema={"name": bytes})
+        with self.assertRaises(TypeError):
+            dbj("tests_dbj.db", schema={"name": (str, "yes")})
+        schema = {"name": str, "age": int, "score": (float, False), "tags": (list, False)}
+        db = dbj("tests_dbj.db", schema=schema)
+        self.assertEqual(db.getcolumns(), ["age", "score"])
+        with self.assertRaises(TypeError):
+            db.insert({"name": "Ana"})
+        with self.assertRaises(TypeError):
+            db.insert({"name": "Ana", "age": True})
+        with self.assertRaises(TypeError):
+            db.insert({"name": "Ana", "age": 1, "tags": [1 + 1j]})
+        with self.assertRaises(TypeError):
+            db.insert({"name": "Ana", "age": 1, 2: "extra"})
+        db.insert({"name": "Ana", "age": 30, "score": 7}, "1")
+        db.insert({"name": "Bia", "age": 20, "nick": "B"}, "2")
+        self.assertIsInstance(db.db["1"], Record)
+        self.assertIsInstance(db.db["2"], dict)
+        self.assertEqual(len(db.db["1"]), 3)
+        self.assertNotIn("tags", db.db["1"])
+        self.assertEqual(db.get("1"), {"name": "Ana", "age": 30, "score": 7})
+        self.assertIs(type(db.get("1")), dict)
+        self.assertEqual(db.findall("age > 25"), [{"name": "Ana", "age": 30, "score": 7}])
+        self.assertEqual(db.findnum("score > 5"), ["1"])
+        self.assertEqual(db.find('name == "ana"'), ["1"])
+        self.assertEqual(db.sort(["1", "2"], "name", reverse=True), ["2", "1"])
+        with self.assertRaises(TypeError):
+            db.update("1", {"age": "old"})
+        with self.assertRaises(TypeError):
+            db.update("1", {"$unset": ["name"]})
+        self.assertTrue(db.update("1", {"$inc": {"age": 1}, "$push": {"tags": "x"}}))
+        self.assertEqual(db.get("1"), {"name": "Ana", "age": 31, "score": 7, "tags": ["x"]})
+        # A rejected update does not push to the stored list
+        with self.assertRaises(TypeError):
+            db.update("1", {"$push": {"tags": "y"}, "$set": {"age": "bad"}})
+        self.assertEqual(db.get("1"), {"name": "Ana", "age": 31, "score": 7, "tags": ["x"]})
+        self.assertEqual(db.findnum("age > 30"), ["1"])
+        self.assertTrue(db.update("2", {"$unset": ["nick"]}))
+        self.assertIsInstance(db.db["2"], Record)
+        db.save()
+        db = dbj("tests_dbj.db", schema=schema)
+        self.assertIsInstance(db.db["1"], Record)
+        self.assertEqual(db.get("2"), {"name": "Bia", "age": 20})
+        self.assertEqual(dbj("tests_dbj.db").get("1"), {"name": "Ana", "age": 31, "score": 7, "tags": ["x"]})
+
+    def test_stats(self):
+        self.assertFalse(self.db.stats())
+        db = dbj("tests_dbj.db", metrics=True, autosave=True)
+        db.insert({"name": "Ana", "age": 10}, "1")
+        db.insertmany([{"name": "Bia", "age": 30}])
+        db.get("1")
+        db.find("age > 15")
+        db.createindex("name")
+        db.find('name == "ana"')
+        stats = db.stats()
+        # Only the outermost call is recorded, not the inserts of insertmany
+        self.assertEqual(stats["calls"]["insert"]["count"], 1)
+        self.assertEqual(stats["calls"]["insertmany"]["count"], 1)
+        self.assertEqual(stats["calls"]["get"]["count"], 1)
+        self.assertEqual(stats["calls"]["find"]["count"], 2)
+        self.assertEqual(sum(stats["calls"]["get"]["histogram"].values()), 1)
+        self.assertEqual(stats["calls"]["load"]["count"], 1)
+        self.assertEqual(stats["autosaves"], 2)
+        self.assertEqual(stats["saves"], 2)
+        self.assertEqual(stats["last_save_bytes"], os.path.getsize("tests_dbj.db"))
+        self.assertEqual(stats["queries"], 2)
+        self.assertEqual(stats["scanned"], 2)
+        self.assertEqual(stats["matched"], 2)
+        db.resetstats()
+        db.getmany(["1", "2", "3"])
+        self.assertEqual(list(db.stats()["calls"]), ["getmany"])
+        self.assertEqual(db.stats()["calls"]["getmany"]["count"], 1)
+
+    def test_resetstats(self):
+        self.assertFalse(self.db.resetstats())
+        db = dbj("tests_dbj.db", metrics=True)
+        db.get("1")
+        self.assertTrue(db.resetstats())
+        self.assertEqual(db.stats()["calls"], {})
+
+    def test_slow_query(self):
+        db = dbj("tests_dbj.db", slow_query=0)
+        db.insert({"age": 10})
+        with self.assertLogs("dbj", level="WARNING") as logs:
+            db.findnum("age > 1")
+        self.assertIn("slow findnum", logs.output[0])
+        db = dbj("tests_dbj.db", metrics=True, slow_query=0)
+        with self.assertLogs("dbj", level="WARNING"):
+            db.count()
+        self.assertEqual(db.stats()["slow_queries"], 1)
+
+    def test_addhook(self):
+        with self.assertRaises(TypeError):
+            self.db.addhook("during", print)
+        with self.assertRaises(TypeError):
+            self.db.addhook("pre", 1)
+        calls = []
+        self.assertTrue(self.db.addhook("pre", lambda *args: calls.append(("pre",) + args)))
+        self.assertTrue(self.db.addhook("post", lambda *args: calls.append(("post",) + args)))
+        self.db.insert({"test": "testing"}, "1")
+        self.assertEqual(calls[0], ("pre", "insert", ({"test": "testing"}, "1"), {}))
+        self.assertEqual(calls[1][:3], ("post", "insert", ({"test": "testing"}, "1")))
+        self.assertEqual(calls[1][-1], "1")
+        self.assertFalse(self.db.stats())
+
+    def test_removehook(self):
+        calls = []
+        hook = calls.append
+        self.db.addhook("pre", hook)
+        self.assertTrue(self.db.removehook("pre", hook))
+        self.assertFalse(self.db.removehook("pre", hook))
+        self.assertFalse(self.db.removehook("during", hook))
+        self.db.get("1")
+        self.assertEqual(calls, [])
+
     def test__parse_query(self):
         query = "age <= 18"
         parsed = ["age", "<=", "18"]
@@ -333,6 +1432,10 @@ class testdbj(unittest.TestCase):
         query = 'name == ""john j"" or name == "bob"'
         parsed = ["name", "==", '""john j""', "or", "name", "==", '"bob"']
         self.assertEqual(self.db._parse_query(query), parsed)
+        query = '(name == "(a, b)" or age in (1,2)) and name == ""'
+        parsed = ["(", "name", "==", '"(a, b)"', "or", "age", "in", "(", "1", ",", "2", ")", ")"]
+        parsed += ["and", "name", "==", '""']
+        self.assertEqual(self.db._parse_query(query), parsed)
         query = 'name == "John John" or name == ""Bob "B" Lee"" and age >= 18'
         parsed = ["name", "==", '"John John"', "or", "name", "==", '""Bob "B" Lee""', "and", "age", ">=", "18"]
         self.assertEqual(self.db._parse_query(query), parsed)